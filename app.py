@@ -1,5 +1,6 @@
 # app.py (FastAPI version)
 import os, sys
+from contextlib import asynccontextmanager
 from huggingface_hub import HfFolder
 
 # Intentamos leer el token (CLI login o variable de entorno)
@@ -21,24 +22,73 @@ from fastapi import FastAPI
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 
-import gradio as gr
+from utils.lazy_mount import LazyMounts, LazyMountMiddleware
 
-from chatbot.app import create_chatbot_interface
-from images.app import create_image_interface
-from spch_to_text.app import create_whisper_interface
 
+# Las mini-apps (torch, transformers, diffusers, whisper...) se importan y montan
+# en segundo plano: el servidor responde a "/" y a "/status" desde el primer momento
+def _chatbot_ui():
+    from chatbot.app import create_chatbot_interface
+    return create_chatbot_interface()
 
-app = FastAPI()
+def _chatbot_api():
+    from chatbot.api import router
+    return router
+
+def _images_ui():
+    from images.app import create_image_interface
+    return create_image_interface()
+
+def _whisper_ui():
+    from spch_to_text.app import create_whisper_interface
+    return create_whisper_interface()
+
+def _chatbot_artifacts():
+    from chatbot.app import check_artifacts
+    check_artifacts()
+
+def _images_artifacts():
+    from images.app import check_artifacts
+    check_artifacts()
+
+def _whisper_artifacts():
+    from spch_to_text.app import check_artifacts
+    check_artifacts()
+
+
+mounts = LazyMounts()
+# Monta tus apps de Gradio…
+mounts.gradio("/chatbot", "🤖 Chatbot", _chatbot_ui)
+# API REST compatible con OpenAI para el chatbot (/v1/chat/completions, /v1/models)
+mounts.router("/v1", "🤖 Chatbot API", _chatbot_api)
+mounts.gradio("/images", "🖼️ Imágenes", _images_ui)
+mounts.gradio("/whisper", "🎤 Transcriptor", _whisper_ui)
+# Comprobación/descarga de modelos, tras montar las interfaces
+mounts.check("chatbot", _chatbot_artifacts)
+mounts.check("images", _images_artifacts)
+mounts.check("whisper", _whisper_artifacts)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    mounts.start()
+    yield
+    await mounts.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(LazyMountMiddleware, mounts=mounts)
 
 
 # Monta la carpeta static en /static
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
-# Monta tus apps de Gradio…
-gr.mount_gradio_app(app, create_chatbot_interface(), path="/chatbot")
-gr.mount_gradio_app(app, create_image_interface(),   path="/images")
-gr.mount_gradio_app(app, create_whisper_interface(),  path="/whisper")
+@app.get("/status")
+async def status():
+    """Qué mini-apps están listas, cuáles siguen calentando y cuánto cómputo ahorró cancelar."""
+    from utils.cancellation import STATS
+    return dict(mounts.status(), cancellations=STATS)
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -0,0 +1,177 @@
+# chatbot/api.py
+
+import asyncio
+import json
+import time
+import uuid
+from contextlib import ExitStack
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from transformers import StoppingCriteriaList
+
+from .config import MODEL_CONFIGS
+from .context import get_context_window
+from .prompts import system_prompt_for
+from .model import MODEL_PATHS, load_model, generate_stream, model_in_use
+from .streaming import (
+    CancelStoppingCriteria, IncrementalTextStreamer, RoleMarkerStoppingCriteria, TurnStreamFilter
+)
+from utils.cancellation import track
+
+router = APIRouter(prefix="/v1")
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class ChatCompletionRequest(BaseModel):
+    model: str
+    messages: List[ChatMessage]
+    max_tokens: int = 1024
+    temperature: float = 0.7
+    top_p: Optional[float] = None
+    stream: bool = False
+
+
+def _system_prompt(internal, messages):
+    """El prompt de sistema del cliente si lo manda; si no, el mismo que usa la interfaz."""
+    system = [m.content for m in messages if m.role == "system"]
+    if system:
+        return "\n".join(system) + "\n\n"
+    return system_prompt_for(internal)
+
+
+def _start_generation(req, cancel):
+    """Carga el modelo, construye el prompt y lanza la generación. Devuelve el streamer."""
+    if req.model not in MODEL_PATHS:
+        raise HTTPException(status_code=404, detail=f"Modelo desconocido: {req.model}")
+    chat = [m for m in req.messages if m.role != "system"]
+    if not chat or chat[-1].role != "user":
+        raise HTTPException(status_code=400, detail="El último mensaje debe ser del usuario")
+
+    pipe = load_model(req.model)
+    tokenizer = pipe.tokenizer
+    model = pipe.model
+    internal = MODEL_PATHS[req.model]
+
+    history = [{"role": m.role, "content": m.content} for m in chat[:-1]]
+    prompt, _, _ = get_context_window(tokenizer).build_prompt(
+        _system_prompt(internal, req.messages), history, chat[-1].content,
+        MODEL_CONFIGS[internal]["context_budget"]
+    )
+
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    eos = tokenizer.eos_token_id
+    streamer = IncrementalTextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    turn_stop = RoleMarkerStoppingCriteria(tokenizer, prompt_length=inputs["input_ids"].shape[1])
+    # Si el cliente cierra la conexión la generación se corta en el modelo
+    cancel_stop = CancelStoppingCriteria(cancel, inputs["input_ids"].shape[1], req.max_tokens)
+
+    generation_kwargs = dict(
+        max_new_tokens=req.max_tokens,
+        eos_token_id=eos,
+        pad_token_id=eos,
+        stopping_criteria=StoppingCriteriaList([turn_stop, cancel_stop]),
+    )
+    if req.temperature > 0:
+        generation_kwargs.update(do_sample=True, temperature=req.temperature)
+        if req.top_p is not None:
+            generation_kwargs["top_p"] = req.top_p
+    else:
+        generation_kwargs["do_sample"] = False
+
+    generate_stream(req.model, model, inputs["input_ids"], inputs["attention_mask"], streamer,
+                    **generation_kwargs)
+    return streamer
+
+
+def _chunk(completion_id, created, model, delta, finish_reason=None):
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def _sse_stream(req, streamer, cancel, lease):
+    """Eventos SSE con solo el texto nuevo de cada paso (formato OpenAI)."""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    # Solo se corta en el turno del usuario: lo ya enviado no se puede reescribir
+    turn = TurnStreamFilter(strip_markers=())
+
+    with lease:
+        try:
+            yield _chunk(completion_id, created, req.model, {"role": "assistant"})
+            async for token in iterate_in_threadpool(streamer):
+                delta, _ = turn.feed(token)
+                if delta:
+                    yield _chunk(completion_id, created, req.model, {"content": delta})
+        except (asyncio.CancelledError, GeneratorExit):
+            cancel.cancel()
+            raise
+        tail = turn.finish()
+        if tail:
+            yield _chunk(completion_id, created, req.model, {"content": tail})
+        yield _chunk(completion_id, created, req.model, {}, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+
+
+@router.get("/models")
+async def list_models():
+    return {
+        "object": "list",
+        "data": [
+            {"id": name, "object": "model", "owned_by": "local", "root": internal}
+            for name, internal in MODEL_PATHS.items()
+        ],
+    }
+
+
+@router.post("/chat/completions")
+async def chat_completions(req: ChatCompletionRequest):
+    # El modelo no sale de la GPU hasta terminar la respuesta (también en streaming)
+    lease = ExitStack()
+    lease.enter_context(model_in_use(req.model))
+    cancel = lease.enter_context(track("chat"))
+    try:
+        # La carga del modelo y la tokenización bloquean: fuera del event loop
+        streamer = await run_in_threadpool(_start_generation, req, cancel)
+    except BaseException:
+        lease.close()
+        raise
+
+    if req.stream:
+        return StreamingResponse(
+            _sse_stream(req, streamer, cancel, lease),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    turn = TurnStreamFilter(strip_markers=())
+    with lease:
+        try:
+            async for token in iterate_in_threadpool(streamer):
+                turn.feed(token)
+        except asyncio.CancelledError:
+            cancel.cancel()
+            raise
+        turn.finish()
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": req.model,
+        "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": turn.text}, "finish_reason": "stop"}
+        ],
+    }
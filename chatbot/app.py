@@ -1,169 +1,311 @@
-from transformers import TextIteratorStreamer
-from threading import Thread
+from transformers import StoppingCriteriaList
 import os
 import json
 import gradio as gr
 import time
+import uuid
 import asyncio
-from chatbot.model import load_model, MODEL_PATHS, unload_model
+from chatbot.model import (
+    load_model, MODEL_PATHS, unload_model, generate_stream, generate_alternatives, get_prefix_cache,
+    scheduler_summary, model_in_use
+)
+from chatbot.config import BATCHING, MODEL_CONFIGS, RESPONSE_CACHE
+from chatbot.context import get_context_window
+from chatbot.prompts import system_prompt_for
 from chatbot.model_downloader import ensure_models_downloaded
+from chatbot.chat_journal import ChatJournal, JOURNAL_DIR, recover_sessions
+from chatbot.chat_store import ChatStore
+from chatbot.response_cache import ResponseCache, is_cacheable, replay_chunks
+from utils.cancellation import track, session_of, on_unload
+from chatbot.streaming import (
+    AdaptiveFlusher, CancelStoppingCriteria, IncrementalTextStreamer, MultiSequenceStreamer, RoleMarkerStoppingCriteria,
+    TurnStreamFilter
+)
 
 
-# Forzar descarga si hace falta
-ensure_models_downloaded()
-
-#SYSTEM_PROMPT = "Eres un asistente que siempre es útil y ayuda con todo lo que sabe, pero a menos que te pidan ayuda con idiomas solo podrás responder en ESPAÑOL."
+def check_artifacts():
+    """Fuerza la descarga de los modelos si hace falta (el servidor lo lanza en segundo plano)."""
+    ensure_models_downloaded()
 
-DEFAULT_SYSTEM_PROMPT = (
-    "Eres un asistente que siempre es útil y ayuda con todo lo que sabe, "
-    "pero a menos que te pidan ayuda con idiomas solo podrás responder en ESPAÑOL."
-)
 
-PER_MODEL_PROMPT = {
-    "Llama-3.2-3B-Instruct": (
-        "Eres un experto en IA con un amplio conocimiento de los conceptos de IA débil y fuerte. "
-        "Proporciona respuestas detalladas, usa ejemplos y clarifica por qué cada término recibe ese nombre."
-    ),
-    "Instella-3B-Instruct": (
-        "Eres un asistente optimizado por AMD, excelente explicando procesos y cadenas de razonamiento "
-        "de forma clara y fluida. Aprovecha tu fuerza en coherencia para estructurar bien las respuestas."
-    ),
-    "Qwen2.5-3B-Instruct": (
-        "Eres un especialista en respuestas estructuradas. Ofrece esquemas, listas y subtítulos cuando sea útil."
-    ),
-    "Stable-Code-Instruct-3B": (
-        "Eres un asistente de programación: explica paso a paso la corrección de errores y genera código limpio."
-    ),
-}
-
-TEMP_CHAT_PATH = "chatbot/saved_chats/_temp.json"
 CHAT_DIR = "chatbot/saved_chats"
 
+# Chats que se muestran en el desplegable y mensajes por página al cargar un chat
+CHAT_LIST_PAGE = 50
+HISTORY_PAGE = 40
+
+# Índice SQLite de los chats guardados (metadatos + búsqueda de texto completo)
+store = ChatStore(CHAT_DIR, "chatbot/chat_index.sqlite3")
+store.sync(force=True)
+
+# Recupera los chats con trabajo sin guardar si el servidor se cerró de golpe
+recover_sessions(JOURNAL_DIR, CHAT_DIR, store=store)
+journal = ChatJournal(JOURNAL_DIR)
+
+# Journals abiertos por cada pestaña de Gradio (session_hash): se descartan al cerrarla
+_tab_journals = {}
 
 
+def _track_journal(request, session_id):
+    tab = session_of(request)
+    if tab is not None:
+        _tab_journals.setdefault(tab, set()).add(session_id)
 
-def respond_stream(message, chat_history, model_choice):
-    import threading
 
-    timeout_timer = threading.Timer(120, lambda: unload_model_chatbot())
+def _discard_tab_journals(tab):
+    """Pestaña cerrada: sus chats sin guardar no se van a recuperar, se borran sus journals."""
+    for session_id in _tab_journals.pop(tab, ()):
+        journal.discard(session_id)
 
-    def unload_model_chatbot():
-        from chatbot.model import state
-        if "pipe" in state:
-            print("⏱️ Chatbot: modelo superó los 2 minutos. Descargando de VRAM...")
-            del state["pipe"]
-            del state["model_name"]
-            import torch, gc
-            torch.cuda.empty_cache()
-            gc.collect()
+response_cache = ResponseCache(RESPONSE_CACHE["path"], RESPONSE_CACHE["max_mb"] * 1024**2)
 
+
+# Máximo de respuestas alternativas que se generan a la vez
+MAX_ALTERNATIVES = 3
+
+
+def build_chat_prompt(tokenizer, internal, chat_history, message):
+    """Devuelve (prompt_de_sistema, prompt, mensajes_incluidos) dentro del presupuesto del modelo."""
+    system_prompt = system_prompt_for(internal)
+    # Solo entran en el prompt los mensajes más recientes que caben en el presupuesto del modelo
+    budget = MODEL_CONFIGS[internal]["context_budget"]
+    prompt, kept, used = get_context_window(tokenizer).build_prompt(
+        system_prompt, chat_history, message, budget
+    )
+    if kept < len(chat_history):
+        print(f"✂️ Contexto: se omiten {len(chat_history) - kept} mensajes antiguos (~{used}/{budget} tokens)")
+    return system_prompt, prompt, kept
+
+
+def respond_stream(message, chat_history, model_choice, session_id, visible_from=0, deterministic=False,
+                   cancel=None):
     pipe = load_model(model_choice)
     tokenizer = pipe.tokenizer
     model = pipe.model
 
     internal = MODEL_PATHS.get(model_choice, model_choice)
-    prompt = DEFAULT_SYSTEM_PROMPT
-    if internal in PER_MODEL_PROMPT:
-        prompt += "\n" + PER_MODEL_PROMPT[internal]
-    prompt += "\n\n"
     chat_history = chat_history or []
-    for msg in chat_history:
-        prompt += f"{msg['role'].capitalize()}: {msg['content']}\n"
-    prompt += f"User: {message}\nAssistant:"
-
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    eos = tokenizer.eos_token_id
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-    
-    generation_kwargs = dict(
-        inputs=inputs["input_ids"],
-        attention_mask=inputs["attention_mask"],
-        streamer=streamer,
-        max_new_tokens=1024,
-        temperature=0.7,
-        eos_token_id=eos,
-        pad_token_id=eos
-    )
+    system_prompt, prompt, kept = build_chat_prompt(tokenizer, internal, chat_history, message)
+
+    generation_params = dict(max_new_tokens=1024, temperature=0.7)
+    if deterministic:
+        generation_params = dict(max_new_tokens=1024, do_sample=False)
+
+    # Respuestas deterministas ya generadas se reproducen desde la caché
+    cache_key = None
+    cached = None
+    if RESPONSE_CACHE["enabled"] and is_cacheable(generation_params):
+        cache_key = response_cache.make_key(
+            internal, system_prompt, chat_history[len(chat_history) - kept:] if kept else [], message,
+            generation_params
+        )
+        cached = response_cache.get(cache_key)
+        print(f"🗃️ Caché de respuestas: {'HIT' if cached is not None else 'MISS'} | {response_cache.summary()}")
+
+    start_time = time.time()
+    if cached is not None:
+        source = replay_chunks(cached)
+        first_token = False
+    else:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        eos = tokenizer.eos_token_id
+        streamer = IncrementalTextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        # Corta la generación en cuanto el modelo empieza a escribir el turno del usuario
+        turn_stop = RoleMarkerStoppingCriteria(tokenizer, prompt_length=inputs["input_ids"].shape[1])
+        criteria = [turn_stop]
+        if cancel is not None:
+            # Si el cliente se va, la generación se corta también en el modelo
+            criteria.append(CancelStoppingCriteria(cancel, inputs["input_ids"].shape[1],
+                                                   generation_params["max_new_tokens"]))
+
+        generation_kwargs = dict(
+            generation_params,
+            eos_token_id=eos,
+            pad_token_id=eos,
+            stopping_criteria=StoppingCriteriaList(criteria),
+        )
 
-    thread = Thread(target=model.generate, kwargs=generation_kwargs)
-    thread.start()
+        handle, reused = generate_stream(
+            model_choice, model, inputs["input_ids"], inputs["attention_mask"], streamer, **generation_kwargs
+        )
+        prefix_cache = get_prefix_cache(model_choice)
+        source = streamer
+        first_token = True
 
+    journal.sync(session_id, model_choice, chat_history)
     chat_history.append({"role": "user", "content": message})
     chat_history.append({"role": "assistant", "content": ""})
+    journal.append(session_id, "user", message)
+    journal.append(session_id, "assistant", "")
 
-    partial = ""
-    last_yield = time.time()
+    turn = TurnStreamFilter()
+
+    # Los mensajes anteriores no cambian durante la respuesta: se copian una sola
+    # vez y en cada envío solo se sustituye el mensaje del asistente
+    visible = [{"role": m["role"], "content": m["content"]} for m in chat_history[visible_from:]]
+    flusher = AdaptiveFlusher(static_bytes=sum(len(m["content"].encode("utf-8")) for m in visible))
+    replaced = False
 
     try:
-        for token in streamer:
-            partial += token
-            clean = partial.split("User:")[0].split("Assistant:")[-1].strip()
-            chat_history[-1]["content"] = clean
-
-            # 🔐 Guardar en _temp.json
-            with open(TEMP_CHAT_PATH, "w", encoding="utf-8") as f:
-                json.dump({
-                    "model": model_choice,
-                    "history": chat_history
-                }, f, ensure_ascii=False, indent=2)
-
-            # 🔁 Enviar actualizaciones al frontend
-            if time.time() - last_yield > 0.5:
-                yield None, [
-                    {"role": m["role"], "content": m["content"]}
-                    for m in chat_history
-                ], chat_history
-                
-    except asyncio.CancelledError:
-        #el cliente cerró la conexión; dejamos el generator
+        for token in source:
+            if first_token:
+                first_token = False
+                ttft = time.time() - start_time
+                prefix_cache.record_ttft(ttft, hit=reused > 0)
+                print(f"⚡ TTFT {ttft:.2f}s ({reused}/{inputs['input_ids'].shape[1]} tokens de prefijo reutilizados)")
+                print(f"🧠 Cache de prefijos: {prefix_cache.summary()}")
+            delta, reset = turn.feed(token)
+            if not delta and not reset:
+                continue
+            chat_history[-1]["content"] = turn.text
+
+            # 🔐 Registrar el cambio en el journal de la sesión (se vuelca en segundo plano)
+            if reset:
+                journal.set_last(session_id, turn.text)
+            else:
+                journal.delta(session_id, delta)
+
+            # 🔁 Enviar al frontend solo el mensaje que cambia, agrupando según el ritmo de tokens
+            flusher.token()
+            replaced = replaced or reset
+            if flusher.should_flush(turn.text):
+                visible[-1] = {"role": "assistant", "content": turn.text}
+                flusher.flushed(turn.text, replaced)
+                replaced = False
+                yield None, visible, chat_history
+                flusher.resumed()
+
+    except (asyncio.CancelledError, GeneratorExit):
+        #el cliente cerró la conexión; dejamos el generator y paramos la generación
+        if cancel is not None:
+            cancel.cancel()
         return
 
+    tail = turn.finish()
+    if tail:
+        chat_history[-1]["content"] = turn.text
+        journal.delta(session_id, tail)
+
+    if cache_key is not None and cached is None:
+        response_cache.put(cache_key, internal, turn.text)
+
+    summary = scheduler_summary(model_choice)
+    if summary:
+        print(f"🧵 Scheduler: {summary}")
+
     # última actualización
-    yield None, [
-        {"role": m["role"], "content": m["content"]}
-        for m in chat_history
-    ], chat_history
-    timeout_timer.cancel()
-
-def save_chat(_, __, name):
-    if not os.path.exists(TEMP_CHAT_PATH):
-        return gr.update()
-    with open(TEMP_CHAT_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    title = name.strip()
-    if not title:
-        for m in data["history"]:
-            if m["role"] == "user" and len(m["content"]) > 10:
-                title = m["content"][:50].strip().replace(" ", "_").replace("?", "").replace(".", "")
-                break
-        else:
-            title = "chat"
-    fname = f"{title}.json"
-    path = f"{CHAT_DIR}/{fname}"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    return gr.update(choices=get_chat_list())
-
-def load_chat(fname):
-    path = f"{CHAT_DIR}/{fname}"
-    if not os.path.exists(path):
-        return [], [], "Llama-3.2"
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data["history"], data["history"], data.get("model", "Llama-3.2")
-
-def delete_chat(fname):
-    path = f"{CHAT_DIR}/{fname}"
-    if os.path.exists(path):
-        os.remove(path)
-    return gr.update(choices=get_chat_list())
-
-def clear_chat():
-    # Borra el archivo temporal
-    if os.path.exists(TEMP_CHAT_PATH):
-        os.remove(TEMP_CHAT_PATH)
-    return "", [], [] # Limmpia input, historial visual y estado
+    visible[-1] = {"role": "assistant", "content": turn.text}
+    flusher.flushed(turn.text, replaced)
+    print(f"📡 Streaming: {flusher.summary()}")
+    yield None, visible, chat_history
+
+def respond_alternatives(message, chat_history, model_choice, session_id, visible_from, n, cancel=None):
+    """
+    Genera `n` respuestas muestreadas en un único batch (el prompt se procesa
+    una sola vez) y las va mostrando cada una en su propia caja. La primera
+    se usa como respuesta del chat hasta que se elija otra.
+    """
+    pipe = load_model(model_choice)
+    tokenizer = pipe.tokenizer
+    model = pipe.model
+    internal = MODEL_PATHS.get(model_choice, model_choice)
+    chat_history = chat_history or []
+    _, prompt, _ = build_chat_prompt(tokenizer, internal, chat_history, message)
+
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    eos = tokenizer.eos_token_id
+    streamer = MultiSequenceStreamer(tokenizer, n, skip_prompt=True, skip_special_tokens=True)
+    turn_stop = RoleMarkerStoppingCriteria(tokenizer, prompt_length=inputs["input_ids"].shape[1])
+    criteria = [turn_stop]
+    if cancel is not None:
+        criteria.append(CancelStoppingCriteria(cancel, inputs["input_ids"].shape[1], 1024))
+    generate_alternatives(
+        model_choice, model, inputs["input_ids"], inputs["attention_mask"], streamer, n,
+        max_new_tokens=1024,
+        temperature=0.7,
+        eos_token_id=eos,
+        pad_token_id=eos,
+        stopping_criteria=StoppingCriteriaList(criteria),
+    )
+
+    journal.sync(session_id, model_choice, chat_history)
+    chat_history.append({"role": "user", "content": message})
+    chat_history.append({"role": "assistant", "content": ""})
+    journal.append(session_id, "user", message)
+    journal.append(session_id, "assistant", "")
+
+    turns = [TurnStreamFilter() for _ in range(n)]
+    visible = [{"role": m["role"], "content": m["content"]} for m in chat_history[visible_from:]]
+    flusher = AdaptiveFlusher()
+
+    def outputs():
+        texts = [t.text for t in turns]
+        boxes = [gr.update(visible=i < n, value=texts[i] if i < n else "") for i in range(MAX_ALTERNATIVES)]
+        choice = gr.update(visible=True, choices=[str(i + 1) for i in range(n)], value="1")
+        return (None, visible, chat_history, *boxes, texts, choice)
+
+    for row, chunk in streamer:
+        delta, reset = turns[row].feed(chunk)
+        if not delta and not reset:
+            continue
+        if row == 0:
+            chat_history[-1]["content"] = turns[0].text
+            if reset:
+                journal.set_last(session_id, turns[0].text)
+            else:
+                journal.delta(session_id, delta)
+        flusher.token()
+        if flusher.should_flush(turns[row].text):
+            visible[-1] = {"role": "assistant", "content": turns[0].text}
+            flusher.flushed(turns[row].text, replaced=True)
+            yield outputs()
+            flusher.resumed()
+
+    for i, turn in enumerate(turns):
+        tail = turn.finish()
+        if i == 0 and tail:
+            chat_history[-1]["content"] = turn.text
+            journal.delta(session_id, tail)
+    visible[-1] = {"role": "assistant", "content": turns[0].text}
+    print(f"📡 Streaming de alternativas: {flusher.summary()}")
+    yield outputs()
+
+
+def respond(message, chat_history, model_choice, session_id, visible_from, deterministic, n_alternatives,
+            request: gr.Request = None):
+    """Punto de entrada del botón de enviar: una respuesta normal o varias alternativas."""
+    n = int(n_alternatives)
+    # El modelo no sale de la GPU (inactividad o presupuesto de VRAM) mientras se responde
+    _track_journal(request, session_id)
+    with model_in_use(model_choice), track("chat", session_of(request)) as cancel:
+        try:
+            if n > 1:
+                yield from respond_alternatives(message, chat_history, model_choice, session_id, visible_from, n,
+                                                cancel)
+                return
+            hidden = [gr.update(visible=False, value="") for _ in range(MAX_ALTERNATIVES)]
+            for out in respond_stream(message, chat_history, model_choice, session_id, visible_from,
+                                      deterministic, cancel):
+                yield (*out, *hidden, [], gr.update(visible=False))
+        except (asyncio.CancelledError, GeneratorExit):
+            # Gradio deja de pedir actualizaciones: se corta la generación en el modelo
+            cancel.cancel()
+            raise
+
+
+def choose_alternative(choice, alternatives, chat_history, visible_from, session_id):
+    """Sustituye la última respuesta del chat por la alternativa elegida."""
+    if not choice or not alternatives or not chat_history or chat_history[-1]["role"] != "assistant":
+        return gr.update(), chat_history
+    chat_history[-1]["content"] = alternatives[int(choice) - 1]
+    journal.set_last(session_id, chat_history[-1]["content"])
+    return chat_history[visible_from:], chat_history
+
+
+def clear_chat(session_id):
+    # Borra el journal de la sesión
+    journal.discard(session_id)
+    return "", [], [], 0 # Limmpia input, historial visual, estado y paginación
 
 def disable_input():
     return gr.update(interactive=False, placeholder="⏳ Esperando respuesta..."), gr.update(interactive=False)
@@ -172,13 +314,18 @@ def enable_input():
     return gr.update(interactive=True, placeholder="Escribe aquí"), gr.update(interactive=True)
 
 def get_chat_list():
-    return [f for f in sorted(os.listdir(CHAT_DIR), reverse=True) if f.endswith(".json") and not f.startswith("_")]
+    # Los más recientes primero; el resto se encuentra con el buscador
+    return store.list_chats(limit=CHAT_LIST_PAGE)
+
+def search_chats(query):
+    return gr.update(choices=store.search(query, limit=CHAT_LIST_PAGE) if query.strip() else get_chat_list())
+
+def load_older(chat_history, visible_from):
+    visible_from = max(0, visible_from - HISTORY_PAGE)
+    return chat_history[visible_from:], visible_from
 
 def create_chatbot_interface():
     custom_css = open("chatbot/custom_style.css", "r", encoding="utf-8").read()
-    def get_chat_list():
-        files = [f for f in os.listdir("chatbot/saved_chats") if f.endswith(".json") and not f.startswith("_")]
-        return sorted(files, key=lambda f: os.path.getmtime(f"chatbot/saved_chats/{f}"), reverse=True)
 
     with gr.Blocks(css=custom_css, theme = 'Taithrah/Minimal') as demo:
         gr.HTML(
@@ -217,6 +364,7 @@ Interactúa con modelos de lenguaje según tus necesidades. Guarda tus chats, c
         with gr.Row():
             with gr.Column(scale=0, elem_classes=["sidebar"]) as sidebar:
                 #Para que funcione el selector ya que el último que selecciona como que deja de funcionar entonces poniendole un value random como el mismisimo info ya como que lo carga vacío y entonces podemos poner uno de los ejemplos.
+                chat_search = gr.Textbox(label="🔎 Buscar en chats", placeholder="Texto de algún mensaje...")
                 chat_selector = gr.Dropdown(choices=["Elije un chat a cargar..."] + get_chat_list(), label="📂 Chats guardados", value="Elije un chat a cargar...", info="Elije un chat a cargar...")
                 load_btn = gr.Button("🔁 Cargar chat")
                 delete_btn = gr.Button("🗑️ Eliminar chat")
@@ -243,6 +391,24 @@ Interactúa con modelos de lenguaje según tus necesidades. Guarda tus chats, c
                 unload_btn.click(click_unload, outputs=unload_status)
                 chatbot = gr.Chatbot(label="Chat", type="messages", show_copy_button=True,)
                 chat_state = gr.State([])
+                visible_from = gr.State(0)
+                older_btn = gr.Button("⬆️ Cargar mensajes anteriores")
+                deterministic = gr.Checkbox(
+                    label="🎯 Respuesta determinista (greedy, reutiliza respuestas ya generadas)", value=False
+                )
+                n_alternatives = gr.Slider(
+                    1, MAX_ALTERNATIVES, value=1, step=1,
+                    label="🎲 Respuestas alternativas (se generan juntas, el prompt se procesa una vez)"
+                )
+                session_id = gr.State(lambda: uuid.uuid4().hex)
+
+                with gr.Row():
+                    alt_boxes = [
+                        gr.Textbox(label=f"Alternativa {i + 1}", interactive=False, lines=6, visible=False)
+                        for i in range(MAX_ALTERNATIVES)
+                    ]
+                alternatives = gr.State([])
+                alt_choice = gr.Radio(choices=[], label="✅ Quedarse con la alternativa", visible=False)
 
                 with gr.Row():
                     msg = gr.Textbox(label="Mensaje", placeholder="Escribe aquí", scale=4, lines=2, max_lines=10)
@@ -257,18 +423,20 @@ Interactúa con modelos de lenguaje según tus necesidades. Guarda tus chats, c
             disable_input,
             outputs=[msg, send]
         ).then(
-            respond_stream,
-            inputs=[msg, chat_state, model_choice],
-            outputs=[msg, chatbot, chat_state]
+            respond,
+            inputs=[msg, chat_state, model_choice, session_id, visible_from, deterministic, n_alternatives],
+            outputs=[msg, chatbot, chat_state, *alt_boxes, alternatives, alt_choice],
+            # Varias conversaciones a la vez para que el scheduler pueda agruparlas
+            concurrency_limit=BATCHING["max_batch_size"],
         ).then(
             enable_input,
             outputs=[msg, send]
         )
 
         clear_btn.click(
-            lambda: ("", [], []),  # limpia input, historial visual y estado
-            None,
-            [msg, chatbot, chat_state]
+            clear_chat,  # limpia input, historial visual y estado
+            [session_id],
+            [msg, chatbot, chat_state, visible_from]
         ).then(
             lambda: gr.update(choices=get_chat_list()),
             None,
@@ -293,12 +461,12 @@ Interactúa con modelos de lenguaje según tus necesidades. Guarda tus chats, c
             [chat_selector]
         )
         
-        def save_chat(_, __, name):
+        def save_chat(session_id, name):
             try:
-                if not os.path.exists(TEMP_CHAT_PATH):
+                # Compacta el journal de la sesión y lo usa como contenido del chat
+                data = journal.compact(session_id)
+                if not data or not data["history"]:
                     return gr.update()
-                with open(TEMP_CHAT_PATH, "r", encoding="utf-8") as f:
-                    data = json.load(f)
 
                 title = name.strip()
                 if not title:
@@ -309,37 +477,56 @@ Interactúa con modelos de lenguaje según tus necesidades. Guarda tus chats, c
                     else:
                         title = "chat"
                 fname = f"{title}.json"
-                path = f"chatbot/saved_chats/{fname}"
+                path = f"{CHAT_DIR}/{fname}"
                 with open(path, "w", encoding="utf-8") as f:
                     json.dump(data, f, ensure_ascii=False, indent=2)
+                store.upsert(fname, data)
+                # Lo guardado ya no es trabajo pendiente: no se recupera al reiniciar
+                journal.mark_saved(session_id, if_unchanged_since_compact=True)
                 return gr.update(choices=get_chat_list())
             except Exception as e:
                 print("❌ Error al guardar:", e)
                 return gr.update()
 
-        save_btn.click(save_chat, [chatbot, model_choice, save_name], chat_selector)
-
-        def load_chat(fname):
-            path = f"chatbot/saved_chats/{fname}"
-            if not os.path.exists(path):
-                return [], [], "Llama-3.2"
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            history = data["history"]
-            model = data.get("model", "Llama-3.2")
-            return history, history, model
+        save_btn.click(save_chat, [session_id, save_name], chat_selector)
+
+        def load_chat(fname, session_id, request: gr.Request = None):
+            # Los mensajes salen del índice, sin volver a parsear el JSON
+            row = store.get_chat(fname)
+            if row is None:
+                return [], [], "Llama-3.2", 0
+            model, _ = row
+            model = model or "Llama-3.2"
+            history = store.load_messages(fname)
+            # El chat cargado pasa a ser la instantánea inicial del journal
+            journal.reset(session_id, model, history)
+            journal.mark_saved(session_id)
+            _track_journal(request, session_id)
+            # Solo se envía al navegador la última página; el resto bajo demanda
+            visible = max(0, len(history) - HISTORY_PAGE)
+            return history[visible:], history, model, visible
 
         def delete_chat(fname):
             try:
-                os.remove(f"chatbot/saved_chats/{fname}")
+                os.remove(f"{CHAT_DIR}/{fname}")
+                store.delete(fname)
             except:
                 pass
             return gr.update(choices=get_chat_list())
 
         # -- Botones laterales --
-        load_btn.click(load_chat, [chat_selector], [chatbot, chat_state, model_choice])
+        load_btn.click(load_chat, [chat_selector, session_id], [chatbot, chat_state, model_choice, visible_from])
         delete_btn.click(delete_chat, [chat_selector], chat_selector)
         chat_selector.change(lambda: gr.update(choices=get_chat_list()), None, chat_selector)
+        chat_search.submit(search_chats, [chat_search], chat_selector)
+        older_btn.click(load_older, [chat_state, visible_from], [chatbot, visible_from])
+        alt_choice.input(
+            choose_alternative,
+            [alt_choice, alternatives, chat_state, visible_from, session_id],
+            [chatbot, chat_state]
+        )
+
+        # Al cerrar la pestaña se corta la respuesta que siguiera generándose y se descartan sus journals
+        demo.unload(on_unload(then=_discard_tab_journals))
 
-    
     return demo
\ No newline at end of file
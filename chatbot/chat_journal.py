@@ -0,0 +1,226 @@
+# chatbot/chat_journal.py
+
+import json
+import os
+import threading
+import time
+
+JOURNAL_DIR = "chatbot/saved_chats/_journal"
+
+# Umbrales del volcado diferido: lo que ocurra antes
+FLUSH_INTERVAL = 1.0        # segundos
+FLUSH_BYTES = 64 * 1024     # bytes pendientes entre todas las sesiones
+
+
+class ChatJournal:
+    """
+    Journal append-only por sesión con volcado diferido (write-behind).
+
+    Cada cambio del chat es una línea JSON:
+      {"op": "reset", "model": ..., "history": [...]}   instantánea completa
+      {"op": "append", "role": ..., "content": ...}     mensaje nuevo
+      {"op": "delta", "text": ...}                      texto añadido al último mensaje
+      {"op": "set", "content": ...}                     reemplaza el último mensaje
+      {"op": "saved"}                                   lo anterior ya está en un chat guardado
+
+    Solo el trabajo sin guardar cuenta para la recuperación: un journal cuyo
+    último cambio es anterior a una marca "saved" no se recupera.
+
+    Las líneas se acumulan en memoria y un hilo de fondo las escribe en bloque.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._buffers = {}     # session_id -> [líneas pendientes]
+        self._lengths = {}     # session_id -> (nº de mensajes, modelo) que refleja el journal
+        self._versions = {}    # session_id -> nº de líneas escritas (para saber si hubo cambios tras compactar)
+        self._compacted = {}   # session_id -> versión en la última compactación
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._flusher, daemon=True)
+        self._thread.start()
+
+    def path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    # -- Escritura ---------------------------------------------------------
+
+    def _write(self, session_id, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._cond:
+            self._buffers.setdefault(session_id, []).append(line)
+            self._versions[session_id] = self._versions.get(session_id, 0) + 1
+            self._pending += len(line)
+            if self._pending >= self.flush_bytes:
+                self._cond.notify()
+
+    def reset(self, session_id, model, history):
+        """Sustituye el contenido de la sesión por una instantánea."""
+        self._write(session_id, {"op": "reset", "model": model, "history": history})
+        self._lengths[session_id] = (len(history), model)
+
+    def sync(self, session_id, model, history):
+        """Escribe una instantánea solo si el journal no refleja ya `history` y `model`."""
+        if self._lengths.get(session_id) != (len(history), model):
+            self.reset(session_id, model, history)
+
+    def append(self, session_id, role, content):
+        self._write(session_id, {"op": "append", "role": role, "content": content})
+        count, model = self._lengths.get(session_id, (0, None))
+        self._lengths[session_id] = (count + 1, model)
+
+    def mark_saved(self, session_id, if_unchanged_since_compact=False):
+        """
+        El contenido actual del journal ya está guardado (o se acaba de cargar
+        de un chat guardado). Con `if_unchanged_since_compact` solo se marca si
+        no se ha escrito nada desde `compact()`: lo que llegue mientras se
+        guarda (p. ej. una respuesta en curso) sigue contando como sin guardar.
+        """
+        with self._cond:
+            if if_unchanged_since_compact and \
+                    self._versions.get(session_id, 0) != self._compacted.get(session_id):
+                return False
+            self._write(session_id, {"op": "saved"})
+        return True
+
+    def delta(self, session_id, text):
+        self._write(session_id, {"op": "delta", "text": text})
+
+    def set_last(self, session_id, content):
+        self._write(session_id, {"op": "set", "content": content})
+
+    # -- Volcado -----------------------------------------------------------
+
+    def _flusher(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=self.flush_interval)
+            self.flush()
+
+    def flush(self, session_id=None, sync=False):
+        """Escribe en disco las líneas pendientes (de una sesión o de todas)."""
+        with self._cond:
+            if session_id is None:
+                batches, self._buffers = self._buffers, {}
+                self._pending = 0
+            else:
+                lines = self._buffers.pop(session_id, [])
+                self._pending -= sum(len(l) for l in lines)
+                batches = {session_id: lines} if lines else {}
+            # Se escribe con el lock tomado para no desordenar líneas de la misma sesión
+            for sid, lines in batches.items():
+                with open(self.path(sid), "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+                    if sync:
+                        f.flush()
+                        os.fsync(f.fileno())
+
+    # -- Lectura y compactación --------------------------------------------
+
+    def replay(self, session_id):
+        """Reconstruye {"model", "history", "dirty"} aplicando el journal de la sesión."""
+        self.flush(session_id)
+        return replay_file(self.path(session_id))
+
+    def compact(self, session_id):
+        """
+        Reescribe el journal como una única instantánea (escritura atómica).
+
+        Todo ocurre con el lock tomado: ni el hilo de volcado ni otra escritura
+        pueden añadir líneas al fichero entre la lectura y el reemplazo.
+        """
+        with self._cond:
+            data = self.replay(session_id)
+            if data is None:
+                return None
+            tmp = self.path(session_id) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"op": "reset", "model": data["model"], "history": data["history"]},
+                                   ensure_ascii=False) + "\n")
+                if not data["dirty"]:
+                    f.write(json.dumps({"op": "saved"}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path(session_id))
+            self._lengths[session_id] = (len(data["history"]), data["model"])
+            self._compacted[session_id] = self._versions.get(session_id, 0)
+        return {"model": data["model"], "history": data["history"]}
+
+    def discard(self, session_id):
+        with self._cond:
+            lines = self._buffers.pop(session_id, [])
+            self._pending -= sum(len(l) for l in lines)
+            if os.path.exists(self.path(session_id)):
+                os.remove(self.path(session_id))
+            self._versions.pop(session_id, None)
+            self._compacted.pop(session_id, None)
+        self._lengths.pop(session_id, None)
+
+
+def replay_file(path):
+    """
+    Aplica las operaciones de un fichero de journal. Ignora una última línea truncada.
+    `dirty` indica si hay cambios posteriores a la última marca "saved".
+    """
+    if not os.path.exists(path):
+        return None
+    data = {"model": None, "history": [], "dirty": False}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Escritura interrumpida por un cierre inesperado
+                break
+            op = record.get("op")
+            history = data["history"]
+            if op == "saved":
+                data["dirty"] = False
+                continue
+            data["dirty"] = True
+            if op == "reset":
+                data.update(model=record.get("model"), history=list(record.get("history", [])))
+            elif op == "append":
+                history.append({"role": record["role"], "content": record["content"]})
+            elif op == "delta" and history:
+                history[-1]["content"] += record["text"]
+            elif op == "set" and history:
+                history[-1]["content"] = record["content"]
+    return data
+
+
+def recover_sessions(journal_dir, chat_dir, store=None):
+    """
+    Recupera los journals que quedaron tras un cierre inesperado.
+
+    Cada sesión con mensajes sin guardar se guarda como
+    `Recuperado_<fecha>_<id>.json` en la carpeta de chats guardados (y se
+    indexa en `store`, si se pasa); todos los journals se eliminan.
+    """
+    if not os.path.isdir(journal_dir):
+        return []
+    recovered = []
+    for fname in os.listdir(journal_dir):
+        path = os.path.join(journal_dir, fname)
+        if fname.endswith(".tmp"):
+            os.remove(path)
+            continue
+        if not fname.endswith(".jsonl"):
+            continue
+        data = replay_file(path)
+        if data and data["history"] and data["dirty"]:
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(path)))
+            session_id = fname[:-len(".jsonl")]
+            out = os.path.join(chat_dir, f"Recuperado_{stamp}_{session_id[:8]}.json")
+            chat = {"model": data["model"], "history": data["history"]}
+            with open(out, "w", encoding="utf-8") as f:
+                json.dump(chat, f, ensure_ascii=False, indent=2)
+            if store is not None:
+                store.upsert(os.path.basename(out), chat)
+            recovered.append(out)
+            print(f"🩹 Chat recuperado tras cierre inesperado: {out}")
+        os.remove(path)
+    return recovered
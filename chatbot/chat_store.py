@@ -0,0 +1,199 @@
+# chatbot/chat_store.py
+
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    fname TEXT PRIMARY KEY,
+    model TEXT,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    n_messages INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chats_mtime ON chats (mtime DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    fname TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (fname, idx)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, fname UNINDEXED, idx UNINDEXED, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def _is_chat_file(fname):
+    return fname.endswith(".json") and not fname.startswith("_")
+
+
+class ChatStore:
+    """
+    Índice SQLite de los chats guardados en `chat_dir`.
+
+    Los ficheros JSON siguen siendo la fuente de verdad; el índice guarda
+    metadatos (modelo, mtime, nº de mensajes) y los mensajes con un índice
+    de texto completo (FTS5) para listar, buscar y cargar sin abrir cada JSON.
+    """
+
+    def __init__(self, chat_dir, db_path):
+        self.chat_dir = chat_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        try:
+            self._conn.executescript(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite compilado sin FTS5: la búsqueda cae a LIKE
+            self.has_fts = False
+        self._conn.commit()
+
+    # -- Sincronización con la carpeta ---------------------------------------
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, force=False):
+        """
+        Reconcilia el índice con los ficheros de la carpeta.
+
+        Sin `force` solo se recorre la carpeta si su mtime ha cambiado (se ha
+        creado, renombrado o borrado algún fichero), así que refrescar la
+        lista cuesta un único stat.
+        """
+        dir_mtime = str(os.stat(self.chat_dir).st_mtime_ns)
+        with self._lock:
+            if not force and self._get_meta("dir_mtime") == dir_mtime:
+                return
+            indexed = {
+                fname: (mtime, size)
+                for fname, mtime, size in self._conn.execute("SELECT fname, mtime, size FROM chats")
+            }
+            on_disk = {}
+            with os.scandir(self.chat_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and _is_chat_file(entry.name):
+                        st = entry.stat()
+                        on_disk[entry.name] = (st.st_mtime, st.st_size)
+
+            for fname in indexed.keys() - on_disk.keys():
+                self._delete(fname)
+            for fname, stat in on_disk.items():
+                if indexed.get(fname) != stat:
+                    try:
+                        with open(os.path.join(self.chat_dir, fname), "r", encoding="utf-8") as f:
+                            data = json.load(f)
+                    except (OSError, json.JSONDecodeError) as e:
+                        print(f"⚠️ No se pudo indexar '{fname}': {e}")
+                        continue
+                    self._upsert(fname, data, *stat)
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime', ?)", (dir_mtime,))
+            self._conn.commit()
+
+    # -- Escritura -------------------------------------------------------------
+
+    def _delete(self, fname):
+        self._conn.execute("DELETE FROM chats WHERE fname = ?", (fname,))
+        self._conn.execute("DELETE FROM messages WHERE fname = ?", (fname,))
+        if self.has_fts:
+            self._conn.execute("DELETE FROM messages_fts WHERE fname = ?", (fname,))
+
+    def _upsert(self, fname, data, mtime, size):
+        self._delete(fname)
+        history = data.get("history", [])
+        self._conn.execute(
+            "INSERT INTO chats VALUES (?, ?, ?, ?, ?)",
+            (fname, data.get("model"), mtime, size, len(history)),
+        )
+        rows = [(fname, i, m["role"], m["content"]) for i, m in enumerate(history)]
+        self._conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?)", rows)
+        if self.has_fts:
+            self._conn.executemany(
+                "INSERT INTO messages_fts (content, fname, idx) VALUES (?, ?, ?)",
+                [(content, f, i) for f, i, _, content in rows],
+            )
+
+    def upsert(self, fname, data):
+        """Indexa un chat recién escrito en disco."""
+        st = os.stat(os.path.join(self.chat_dir, fname))
+        with self._lock:
+            self._upsert(fname, data, st.st_mtime, st.st_size)
+            self._conn.commit()
+
+    def delete(self, fname):
+        with self._lock:
+            self._delete(fname)
+            self._conn.commit()
+
+    # -- Lectura ---------------------------------------------------------------
+
+    def list_chats(self, limit=50, offset=0):
+        """Nombres de fichero de los chats, del más reciente al más antiguo."""
+        self.sync()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT fname FROM chats ORDER BY mtime DESC LIMIT ? OFFSET ?", (limit, offset)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def search(self, query, limit=50):
+        """Chats con algún mensaje que contiene todos los términos de `query` (por prefijo)."""
+        terms = [t.replace('"', '') for t in query.split()]
+        terms = [t for t in terms if t]
+        if not terms:
+            return self.list_chats(limit)
+        self.sync()
+        with self._lock:
+            if self.has_fts:
+                match = " ".join(f'"{t}"*' for t in terms)
+                rows = self._conn.execute(
+                    """
+                    SELECT c.fname FROM chats c
+                    JOIN (SELECT DISTINCT fname FROM messages_fts WHERE messages_fts MATCH ?) m
+                      ON m.fname = c.fname
+                    ORDER BY c.mtime DESC LIMIT ?
+                    """,
+                    (match, limit),
+                ).fetchall()
+            else:
+                where = " AND ".join("content LIKE ?" for _ in terms)
+                rows = self._conn.execute(
+                    f"""
+                    SELECT c.fname FROM chats c
+                    WHERE c.fname IN (SELECT fname FROM messages WHERE {where})
+                    ORDER BY c.mtime DESC LIMIT ?
+                    """,
+                    [f"%{t}%" for t in terms] + [limit],
+                ).fetchall()
+        return [r[0] for r in rows]
+
+    def get_chat(self, fname):
+        """Devuelve (modelo, nº de mensajes) o None si el chat no está indexado."""
+        self.sync()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT model, n_messages FROM chats WHERE fname = ?", (fname,)
+            ).fetchone()
+        return row
+
+    def load_messages(self, fname, offset=0, limit=None):
+        """Mensajes del chat en orden, a partir de `offset` (paginable)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages WHERE fname = ? AND idx >= ? ORDER BY idx LIMIT ?",
+                (fname, offset, -1 if limit is None else limit),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
@@ -8,6 +8,16 @@ MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
     "Llama-3.2-3B-Instruct": {
         "repo_id": "meta-llama/Llama-3.2-3B-Instruct",
         "task": "text-generation",
+        # Tokens máximos del prompt (sistema + historial + mensaje)
+        "context_budget": 6144,
+        # Decodificación especulativa con un modelo borrador de la misma familia (opcional)
+        "speculative": {
+            "enabled": False,
+            "mode": "draft",
+            "draft_name": "Llama-3.2-1B-Instruct",
+            "draft_repo": "meta-llama/Llama-3.2-1B-Instruct",
+            "num_tokens": 5,
+        },
         "pipeline_kwargs": {
             "max_new_tokens": 1024,
             "temperature": 0.7,
@@ -17,6 +27,8 @@ MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
     "Instella-3B-Instruct": {
         "repo_id": "amd/Instella-3B-Instruct",
         "task": "text-generation",
+        # Tokens máximos del prompt (contexto de 4K menos max_new_tokens)
+        "context_budget": 3072,
         "pipeline_kwargs": {
             "max_new_tokens": 1024,
             "temperature": 0.6,
@@ -26,6 +38,15 @@ MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
     "Qwen2.5-3B-Instruct": {
         "repo_id": "Qwen/Qwen2.5-3B-Instruct",
         "task": "text-generation",
+        # Tokens máximos del prompt (sistema + historial + mensaje)
+        "context_budget": 6144,
+        "speculative": {
+            "enabled": False,
+            "mode": "draft",
+            "draft_name": "Qwen2.5-0.5B-Instruct",
+            "draft_repo": "Qwen/Qwen2.5-0.5B-Instruct",
+            "num_tokens": 5,
+        },
         "pipeline_kwargs": {
             "max_new_tokens": 1024,
             "temperature": 0.6,
@@ -35,6 +56,14 @@ MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
     "Stable-Code-Instruct-3B": {
         "repo_id": "stabilityai/stable-code-instruct-3b",
         "task": "text-generation",
+        # Tokens máximos del prompt (sistema + historial + mensaje)
+        "context_budget": 6144,
+        # El código repite mucho texto del prompt: los n-gramas del propio prompt sirven de borrador
+        "speculative": {
+            "enabled": True,
+            "mode": "prompt_lookup",
+            "num_tokens": 10,
+        },
         "pipeline_kwargs": {
             "max_new_tokens": 1024,
             "temperature": 0.2,
@@ -46,5 +75,43 @@ MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
 # Carpeta donde se guardarán los modelos descargados
 CACHE_DIR = os.path.abspath("./chatbot/models")
 
+# Presupuesto de memoria (MiB) del cache de prefijos (KV-cache) por modelo cargado
+PREFIX_CACHE_MB = 1024
+
+# Batching continuo: las conversaciones concurrentes comparten un único paso de decodificación.
+# Un modelo puede desactivarlo con "batching": False en su entrada de MODEL_CONFIGS.
+BATCHING = {
+    "enabled": True,
+    "max_batch_size": 8,
+}
+
+# KV-cache de generación por defecto. Un modelo puede cambiarlo con "kv_cache": {...} en su entrada:
+#   "dynamic"   -> fp16 en GPU (compatible con el cache de prefijos y el batching continuo)
+#   "quantized" -> KV-cache cuantizado (backend "quanto" con nbits 2/4, o "HQQ" con nbits hasta 8)
+#   "offloaded" -> las capas que no se están calculando esperan en memoria del host (solo CUDA)
+# Con "quantized"/"offloaded" cada petición se genera por separado, sin cache de prefijos ni batching.
+KV_CACHE = {
+    "mode": "dynamic",
+    "backend": "quanto",
+    "nbits": 4,
+    "residual_length": 128,     # últimos tokens que se mantienen sin cuantizar
+}
+
+# Cache en disco de respuestas deterministas (solo se usa con el modo greedy de la interfaz)
+RESPONSE_CACHE = {
+    "enabled": True,
+    "path": "chatbot/response_cache.sqlite3",
+    "max_mb": 64,
+}
+
+# Backend de CPU (se usa automáticamente si no hay CUDA)
+CPU_BACKEND = {
+    "dtype": "bfloat16",        # si no se cuantiza: "bfloat16" o "float32"
+    "quantize": True,           # cuantización dinámica int8 de las capas Linear
+    "cache_quantized": True,    # guarda el modelo ya cuantizado en CACHE_DIR/_cpu_int8
+    "intra_op_threads": None,   # None = todos los núcleos
+    "inter_op_threads": 1,
+}
+
 def default_model() -> str:
     return "Llama-3.2-3B-Instruct"
\ No newline at end of file
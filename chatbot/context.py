@@ -0,0 +1,85 @@
+# chatbot/context.py
+
+import threading
+from collections import OrderedDict
+
+# Máximo de textos con recuento cacheado por tokenizer
+MAX_CACHED_COUNTS = 20000
+
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+def format_message(role, content):
+    return f"{role.capitalize()}: {content}\n"
+
+
+class ContextWindow:
+    """
+    Construye el prompt respetando un presupuesto de tokens.
+
+    El recuento de tokens de cada mensaje se calcula una sola vez por
+    tokenizer y se reutiliza en los turnos siguientes, así que elegir qué
+    mensajes caben no obliga a re-tokenizar todo el historial. Se comparte
+    entre la interfaz y la API, que piden recuentos a la vez desde varios hilos.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def count(self, text):
+        with self._lock:
+            n = self._counts.get(text)
+            if n is not None:
+                self._counts.move_to_end(text)
+                self.stats["hits"] += 1
+                return n
+            self.stats["misses"] += 1
+        # La tokenización va fuera del lock: no bloquea los aciertos de otros hilos
+        n = len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+        with self._lock:
+            self._counts[text] = n
+            self._counts.move_to_end(text)
+            if len(self._counts) > MAX_CACHED_COUNTS:
+                self._counts.popitem(last=False)
+        return n
+
+    def build_prompt(self, system_prompt, history, message, budget):
+        """
+        Devuelve (prompt, mensajes_incluidos, tokens_estimados).
+
+        El prompt de sistema y el mensaje nuevo siempre se incluyen; del
+        historial se conservan los mensajes más recientes que quepan,
+        empezando siempre en un turno del usuario.
+        """
+        tail = format_message("user", message) + "Assistant:"
+        used = self.count(system_prompt) + self.count(tail)
+
+        kept = 0
+        for msg in reversed(history):
+            n = self.count(format_message(msg["role"], msg["content"]))
+            if used + n > budget:
+                break
+            used += n
+            kept += 1
+        # No empezar el contexto con una respuesta huérfana del asistente
+        while kept and history[len(history) - kept]["role"] != "user":
+            used -= self.count(format_message(history[len(history) - kept]["role"],
+                                              history[len(history) - kept]["content"]))
+            kept -= 1
+
+        selected = history[len(history) - kept:] if kept else []
+        prompt = system_prompt + "".join(format_message(m["role"], m["content"]) for m in selected) + tail
+        return prompt, kept, used
+
+
+def get_context_window(tokenizer):
+    """Un ContextWindow (con su cache de recuentos) por tokenizer."""
+    key = getattr(tokenizer, "name_or_path", None) or id(tokenizer)
+    with _windows_lock:
+        if key not in _windows:
+            _windows[key] = ContextWindow(tokenizer)
+        return _windows[key]
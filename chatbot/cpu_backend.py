@@ -0,0 +1,135 @@
+# chatbot/cpu_backend.py
+
+import json
+import os
+import time
+
+import torch
+import transformers
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from .config import MODEL_CONFIGS, CACHE_DIR, CPU_BACKEND
+
+_threads_configured = False
+
+
+def configure_threads():
+    """Ajusta los hilos de PyTorch para inferencia en CPU (una sola vez por proceso)."""
+    global _threads_configured
+    if _threads_configured:
+        return
+    intra = CPU_BACKEND["intra_op_threads"] or os.cpu_count() or 1
+    inter = CPU_BACKEND["inter_op_threads"]
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError:
+        # Solo se puede fijar antes de que PyTorch lance trabajo en paralelo
+        pass
+    _threads_configured = True
+    print(f"🧵 CPU: {torch.get_num_threads()} hilos intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def _cpu_dtype():
+    if CPU_BACKEND["dtype"] == "bfloat16":
+        return torch.bfloat16
+    return torch.float32
+
+
+def _quantized_path(internal_name):
+    return os.path.join(CACHE_DIR, "_cpu_int8", f"{internal_name}.pt")
+
+
+def _cache_signature(repo_id):
+    # Un cambio de versión invalida el pickle del modelo cuantizado
+    return {"repo_id": repo_id, "torch": torch.__version__, "transformers": transformers.__version__}
+
+
+def _load_quantized_cache(internal_name, repo_id):
+    path = _quantized_path(internal_name)
+    meta_path = path + ".json"
+    if not (os.path.exists(path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        if json.load(f) != _cache_signature(repo_id):
+            print(f"♻️ Cache int8 de '{internal_name}' desactualizado, se vuelve a cuantizar")
+            return None
+    try:
+        return torch.load(path, weights_only=False)
+    except Exception as e:
+        print(f"⚠️ No se pudo leer el cache int8 de '{internal_name}': {e}")
+        return None
+
+
+def _save_quantized_cache(internal_name, repo_id, model):
+    path = _quantized_path(internal_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save(model, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump(_cache_signature(repo_id), f)
+
+
+def load_cpu_model(internal_name, trust_remote=False):
+    """
+    Carga el modelo para CPU: fp32/bf16 y, si está activado, cuantización
+    dinámica int8 de las capas Linear (con cache en disco del resultado).
+    """
+    configure_threads()
+    config = MODEL_CONFIGS[internal_name]
+    repo_id = config["repo_id"]
+    model_dir = f"{CACHE_DIR}/{internal_name}"
+
+    if CPU_BACKEND["quantize"] and CPU_BACKEND["cache_quantized"]:
+        model = _load_quantized_cache(internal_name, repo_id)
+        if model is not None:
+            print(f"⚡ Modelo int8 de '{internal_name}' cargado desde cache")
+            return model.eval()
+
+    # La cuantización dinámica int8 parte de pesos fp32
+    dtype = torch.float32 if CPU_BACKEND["quantize"] else _cpu_dtype()
+    model = AutoModelForCausalLM.from_pretrained(repo_id, cache_dir=model_dir, trust_remote_code=trust_remote,
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True,
+    ).eval()
+
+    if CPU_BACKEND["quantize"]:
+        start = time.time()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        print(f"🗜️ Capas Linear cuantizadas a int8 en {time.time() - start:.1f}s")
+        if CPU_BACKEND["cache_quantized"]:
+            _save_quantized_cache(internal_name, repo_id, model)
+    return model
+
+
+def report_tokens_per_second(names=None, prompt="Explica qué es un modelo de lenguaje.", max_new_tokens=64):
+    """Mide tiempo de carga y tokens/s en CPU de cada modelo configurado."""
+    results = {}
+    for internal_name in names or MODEL_CONFIGS:
+        config = MODEL_CONFIGS[internal_name]
+        trust_remote = "Instella" in internal_name or config.get("trust_remote_code", False)
+        start = time.time()
+        tokenizer = AutoTokenizer.from_pretrained(config["repo_id"], cache_dir=f"{CACHE_DIR}/{internal_name}",
+                                                  trust_remote_code=trust_remote)
+        model = load_cpu_model(internal_name, trust_remote=trust_remote)
+        load_time = time.time() - start
+
+        inputs = tokenizer(prompt, return_tensors="pt")
+        start = time.time()
+        with torch.inference_mode():
+            out = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False,
+                                 pad_token_id=tokenizer.eos_token_id)
+        elapsed = time.time() - start
+        new_tokens = out.shape[1] - inputs["input_ids"].shape[1]
+        results[internal_name] = {
+            "load_s": round(load_time, 2),
+            "tokens": new_tokens,
+            "tokens_per_s": round(new_tokens / elapsed, 2),
+        }
+        print(f"📊 {internal_name}: carga {load_time:.1f}s | {new_tokens / elapsed:.2f} tok/s")
+        del model
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(report_tokens_per_second(), indent=2))
@@ -0,0 +1,113 @@
+# chatbot/kv_cache.py
+
+import importlib.util
+import json
+import sys
+
+import torch
+
+from .config import KV_CACHE, MODEL_CONFIGS
+
+# Paquete que necesita cada backend del KV-cache cuantizado
+QUANT_BACKENDS = {"quanto": "optimum.quanto", "HQQ": "hqq"}
+
+_warned = set()
+
+
+def _warn_once(key, message):
+    if key not in _warned:
+        _warned.add(key)
+        print(message)
+
+
+def _has_module(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def kv_cache_config(config):
+    """
+    Configuración efectiva del KV-cache de un modelo (KV_CACHE + su "kv_cache").
+
+    Si el modo pedido no se puede usar aquí (sin CUDA para "offloaded", sin el
+    paquete del backend para "quantized") se vuelve a "dynamic" avisando una vez.
+    """
+    kv = dict(KV_CACHE, **config.get("kv_cache", {}))
+    mode = kv["mode"]
+    if mode == "offloaded" and not torch.cuda.is_available():
+        _warn_once(mode, "⚠️ KV-cache 'offloaded' necesita CUDA: se usa el KV-cache normal")
+        kv["mode"] = "dynamic"
+    elif mode == "quantized":
+        module = QUANT_BACKENDS.get(kv["backend"])
+        if module is None or not _has_module(module):
+            _warn_once((mode, kv["backend"]),
+                       f"⚠️ KV-cache cuantizado con '{kv['backend']}' no disponible "
+                       f"(instala {module or 'un backend soportado'}): se usa el KV-cache normal")
+            kv["mode"] = "dynamic"
+    return kv
+
+
+def kv_cache_kwargs(kv):
+    """Argumentos extra de `model.generate` para el modo de KV-cache."""
+    if kv["mode"] == "quantized":
+        return {
+            "cache_implementation": "quantized",
+            "cache_config": {
+                "backend": kv["backend"],
+                "nbits": kv["nbits"],
+                "residual_length": kv["residual_length"],
+            },
+        }
+    if kv["mode"] == "offloaded":
+        return {"cache_implementation": "offloaded"}
+    return {}
+
+
+def report_peak_memory(name, lengths=(512, 1024, 2048, 4096), modes=("dynamic", "quantized", "offloaded"),
+                       max_new_tokens=32):
+    """
+    Mide la memoria GPU pico de generar con prompts de distintas longitudes en
+    cada modo de KV-cache. Devuelve {modo: {longitud: MiB por encima de los pesos}}.
+    """
+    from .model import MODEL_PATHS, load_model
+
+    if not torch.cuda.is_available():
+        print("⚠️ El informe de memoria pico necesita CUDA")
+        return {}
+
+    pipe = load_model(name)
+    model = pipe.model
+    config = MODEL_CONFIGS[MODEL_PATHS.get(name, name)]
+    vocab = model.config.vocab_size
+    torch.cuda.synchronize()
+    weights = torch.cuda.memory_allocated()
+
+    results = {}
+    for mode in modes:
+        kv = kv_cache_config({"kv_cache": dict(config.get("kv_cache", {}), mode=mode)})
+        if kv["mode"] != mode:
+            continue
+        results[mode] = {}
+        for length in lengths:
+            input_ids = torch.randint(100, vocab - 100, (1, length), device=model.device)
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+            try:
+                with torch.inference_mode():
+                    model.generate(input_ids, attention_mask=torch.ones_like(input_ids),
+                                   max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                   do_sample=False, pad_token_id=pipe.tokenizer.eos_token_id,
+                                   **kv_cache_kwargs(kv))
+                peak = round((torch.cuda.max_memory_allocated() - weights) / 1024**2, 1)
+            except torch.cuda.OutOfMemoryError:
+                peak = None
+            results[mode][length] = peak
+            print(f"📊 {mode:>9} | {length:>6} tokens | pico {'OOM' if peak is None else f'{peak} MiB'}")
+    return results
+
+
+if __name__ == "__main__":
+    from .config import default_model
+    print(json.dumps(report_peak_memory(sys.argv[1] if len(sys.argv) > 1 else default_model()), indent=2))
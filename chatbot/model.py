@@ -1,12 +1,23 @@
 # chatbot/model.py
 
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache, pipeline
 import torch
 from pathlib import Path
 import os
 import gc
+from threading import Thread, Lock, RLock
 
-from .config import MODEL_CONFIGS, CACHE_DIR
+from .config import MODEL_CONFIGS, CACHE_DIR, PREFIX_CACHE_MB, BATCHING
+from .prefix_cache import PrefixCache, repeat_cache
+from .scheduler import BatchScheduler, GenerationRequest
+from .cpu_backend import load_cpu_model
+from .kv_cache import kv_cache_config, kv_cache_kwargs
+from utils.model_cache import model_cache, TorchAdapter, IDLE_TIMEOUT_S, weights_nbytes
+from utils.model_store import snapshot_path
+from .speculative import (
+    speculative_config, load_draft_model, speculative_kwargs, ForwardCounter, SpeculativeStats
+)
+import time
 
 # Nombres amigables usados en la interfaz => nombres reales usados en MODEL_CONFIGS y HuggingFace
 MODEL_PATHS = {
@@ -22,6 +33,19 @@ LOCAL_PATHS = {
 
 _loaded_models = {}
 _current_model = None 
+_prefix_caches = {}
+_schedulers = {}
+_draft_models = {}
+_speculative = {}  # nombre interno -> (ForwardCounter, SpeculativeStats)
+_load_lock = Lock()
+# Protege los diccionarios de arriba: el cache de modelos llama a _forget desde otros hilos
+# (inactividad, presupuesto de VRAM). Solo se toma un momento, nunca mientras se carga o se mueve un modelo.
+_state_lock = RLock()
+
+# Fallos de una optimización (batching, cache de prefijos) antes de desactivarla para un modelo
+FEATURE_FAILURE_LIMIT = 3
+_feature_failures = {}  # (nombre interno, opción) -> fallos
+_feature_lock = Lock()
 
 def get_gpu_total_memory():
     if torch.cuda.is_available():
@@ -29,29 +53,101 @@ def get_gpu_total_memory():
     return 0
 
 def unload_model():
-    global _loaded_models, _current_model
-    if _current_model and _current_model in _loaded_models:
-        print(f"🔻 Descargando modelo anterior: {_current_model}")
-        del _loaded_models[_current_model]
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        _current_model = None
+    with _state_lock:
+        current = _current_model if _current_model in _loaded_models else None
+    if current:
+        print(f"🔻 Descargando modelo anterior: {current}")
+        internal_name = MODEL_PATHS.get(current, current)
+        if not model_cache.offload(_cache_key(internal_name)) and model_cache.busy(_cache_key(internal_name)):
+            return False
+        _forget(internal_name)
+        print(f"🗄️ Cache de modelos: {model_cache.summary()}")
         return True
     return False
 
+
+def _forget(internal_name):
+    """Olvida un modelo que sale de la GPU (lo llama también el cache de modelos al desalojarlo)."""
+    global _current_model
+    with _state_lock:
+        names = [n for n in _loaded_models if MODEL_PATHS.get(n, n) == internal_name]
+        if not names:
+            return
+        for name in names:
+            del _loaded_models[name]
+        if _current_model in names:
+            _current_model = None
+        scheduler = _schedulers.pop(internal_name, None)
+        # El cache de prefijos vive en la GPU: se descarta; los pesos bajan a RAM
+        prefix_cache = _prefix_caches.pop(internal_name, None)
+        _draft_models.pop(internal_name, None)
+        spec = _speculative.pop(internal_name, None)
+    # Parar el scheduler puede esperar a su hilo: fuera del lock
+    if scheduler is not None:
+        scheduler.stop()
+    # Una petición en curso puede conservar la referencia: no debe seguir reteniendo KV de este modelo
+    if prefix_cache is not None:
+        prefix_cache.close()
+    if spec is not None:
+        spec[0].remove()
+    gc.collect()
+
+
+def model_in_use(name):
+    """Mientras dura el bloque el modelo no sale de la GPU (ni por inactividad ni por presupuesto)."""
+    return model_cache.in_use(_cache_key(MODEL_PATHS.get(name, name)))
+
+
 def load_model(name):
+    # Con varias sesiones concurrentes solo un hilo puede cargar/descargar a la vez
+    with _load_lock:
+        return _load_model(name)
+
+def _load_model(name):
     global _loaded_models, _current_model
-    
-    if name in _loaded_models:
-        return _loaded_models[name]
-    
+
+    with _state_lock:
+        if name in _loaded_models:
+            return _loaded_models[name]
+
     unload_model()
     
-    total_mem = get_gpu_total_memory()
-    max_memory = {0: f"{int(total_mem * 0.9)}MiB"}
     internal_name = MODEL_PATHS.get(name, name)
     config = MODEL_CONFIGS[internal_name]
+    spec = speculative_config(config)
+
+    # Si sigue en RAM (o en la GPU) basta con copiarlo, sin volver a leerlo de disco
+    restored = model_cache.restore(_cache_key(internal_name))
+    if restored is not None:
+        pipe, draft = restored
+    else:
+        model_dir = f"{CACHE_DIR}/{internal_name}"
+        model_cache.make_room("chatbot", nbytes=weights_nbytes(snapshot_path(config["repo_id"], model_dir)))
+        pipe, draft = _load_from_disk(internal_name, config, spec)
+        model_cache.add(_cache_key(internal_name), (pipe, draft), TorchAdapter([pipe.model, draft]),
+                        group="chatbot", priority=config.get("priority", 0),
+                        idle_timeout=config.get("idle_timeout", IDLE_TIMEOUT_S),
+                        on_offload=lambda key: _forget(internal_name))
+
+    with _state_lock:
+        if draft is not None:
+            _draft_models[internal_name] = draft
+        if spec:
+            _speculative[internal_name] = (ForwardCounter(pipe.model), SpeculativeStats(spec["num_tokens"]))
+            print(f"🎯 Decodificación especulativa activa: {spec['mode']} ({spec['num_tokens']} tokens por paso)")
+
+        _loaded_models[name] = pipe
+        _current_model = name
+    return pipe
+
+
+def _cache_key(internal_name):
+    return f"chatbot:{internal_name}"
+
+
+def _load_from_disk(internal_name, config, spec):
+    total_mem = get_gpu_total_memory()
+    max_memory = {0: f"{int(total_mem * 0.9)}MiB"}
     repo_id = config["repo_id"]
     task = config["task"]
     kwargs = config["pipeline_kwargs"]
@@ -62,17 +158,218 @@ def load_model(name):
     trust_remote = "Instella" in internal_name or config.get("trust_remote_code", False)
         
     tokenizer = AutoTokenizer.from_pretrained(repo_id, cache_dir=model_dir, trust_remote_code=trust_remote)
-    model = AutoModelForCausalLM.from_pretrained(repo_id, cache_dir=model_dir, trust_remote_code=trust_remote,
-        device_map="auto",
-        torch_dtype=torch.float16,
-        max_memory=max_memory
-    )
-    pipe = pipeline(task=task, model=model, tokenizer=tokenizer,
-        device_map="auto",
-        torch_dtype=torch.float16,
-        **kwargs
-    )
-    
-    _loaded_models[name] = pipe
-    _current_model = name
-    return pipe
+    if not torch.cuda.is_available():
+        # Sin GPU: fp16 no está soportado/es muy lento, se usa el backend de CPU
+        print("🖥️ CUDA no disponible: usando backend de CPU")
+        model = load_cpu_model(internal_name, trust_remote=trust_remote)
+        pipe = pipeline(task=task, model=model, tokenizer=tokenizer, **kwargs)
+        max_memory = None
+    else:
+        model = AutoModelForCausalLM.from_pretrained(repo_id, cache_dir=model_dir, trust_remote_code=trust_remote,
+            device_map="auto",
+            torch_dtype=torch.float16,
+            max_memory=max_memory
+        )
+        pipe = pipeline(task=task, model=model, tokenizer=tokenizer,
+            device_map="auto",
+            torch_dtype=torch.float16,
+            **kwargs
+        )
+
+    draft = None
+    if spec and spec["mode"] == "draft":
+        draft = load_draft_model(spec, max_memory=max_memory)
+    return pipe, draft
+
+
+def get_prefix_cache(name):
+    internal_name = MODEL_PATHS.get(name, name)
+    # Mismo lock que _forget: dos primeras peticiones comparten un único cache
+    with _state_lock:
+        if internal_name not in _prefix_caches:
+            if not any(MODEL_PATHS.get(n, n) == internal_name for n in _loaded_models):
+                # El modelo ya salió de la GPU: un cache cerrado que no registra ni retiene nada
+                detached = PrefixCache(max_bytes=0)
+                detached.close()
+                return detached
+            _prefix_caches[internal_name] = PrefixCache(max_bytes=PREFIX_CACHE_MB * 1024**2)
+        return _prefix_caches[internal_name]
+
+def _feature_failed(internal_name, feature, error):
+    """
+    Una petición falló con `feature` activa y se repite sin ella. Un fallo
+    suelto (p. ej. sin memoria con un prompt muy largo) no cambia nada para
+    las demás peticiones: solo tras FEATURE_FAILURE_LIMIT fallos que no sean
+    de memoria se desactiva la opción para el modelo hasta reiniciar.
+    """
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        print(f"⚠️ Sin memoria con '{feature}' en '{internal_name}': solo esta petición sigue sin él")
+        return
+    with _feature_lock:
+        key = (internal_name, feature)
+        _feature_failures[key] = count = _feature_failures.get(key, 0) + 1
+    if count >= FEATURE_FAILURE_LIMIT:
+        MODEL_CONFIGS[internal_name][feature] = False
+        print(f"⛔ '{feature}' DESACTIVADO para '{internal_name}' tras {count} fallos (último: {error}). "
+              f"Vuelve a activarse al reiniciar el servidor.")
+    else:
+        print(f"⚠️ '{feature}' falló en '{internal_name}' ({count}/{FEATURE_FAILURE_LIMIT}), "
+              f"esta petición sigue sin él: {error}")
+
+def get_scheduler(name, model):
+    internal_name = MODEL_PATHS.get(name, name)
+    with _state_lock:
+        return _get_scheduler(name, internal_name, model)
+
+def _get_scheduler(name, internal_name, model):
+    if internal_name not in _schedulers:
+        def fallback(req, error):
+            _feature_failed(internal_name, "batching", error)
+            _generate_in_thread(name, model, req.input_ids, req.attention_mask, req.streamer, None,
+                                **req.generation_kwargs)
+        _schedulers[internal_name] = BatchScheduler(
+            model,
+            prefix_cache=get_prefix_cache(name) if MODEL_CONFIGS[internal_name].get("prefix_cache", True) else None,
+            max_batch_size=BATCHING["max_batch_size"],
+            fallback=fallback,
+        )
+    return _schedulers[internal_name]
+
+def scheduler_summary(name):
+    scheduler = _schedulers.get(MODEL_PATHS.get(name, name))
+    return scheduler.summary() if scheduler else None
+
+def _generate_in_thread(name, model, input_ids, attention_mask, streamer, past, **generation_kwargs):
+    internal_name = MODEL_PATHS.get(name, name)
+    prefix_cache = get_prefix_cache(name)
+
+    spec = speculative_config(MODEL_CONFIGS[internal_name])
+    if spec:
+        generation_kwargs.update(speculative_kwargs(spec, _draft_models.get(internal_name)))
+    kv = kv_cache_config(MODEL_CONFIGS[internal_name])
+    generation_kwargs.update(kv_cache_kwargs(kv))
+    # Un KV-cache cuantizado u offloaded no se puede trocear para el cache de prefijos
+    store_prefix = kv["mode"] == "dynamic"
+
+    def run():
+        kwargs = dict(generation_kwargs, inputs=input_ids, attention_mask=attention_mask, streamer=streamer)
+        counter, spec_stats = _speculative.get(internal_name, (None, None))
+        if counter is not None:
+            counter.start()
+            start = time.time()
+        try:
+            try:
+                out = model.generate(**kwargs, past_key_values=past, return_dict_in_generate=True)
+            except Exception as e:
+                if past is None:
+                    raise
+                _feature_failed(internal_name, "prefix_cache", e)
+                out = model.generate(**kwargs, return_dict_in_generate=True)
+            if (store_prefix and MODEL_CONFIGS[internal_name].get("prefix_cache", True)
+                    and getattr(out, "past_key_values", None) is not None):
+                # El cache cubre todos los tokens salvo el último generado
+                tokens = out.sequences[0].tolist()
+                prefix_cache.insert(tokens[:-1], out.past_key_values)
+            if counter is not None:
+                new_tokens = out.sequences.shape[1] - input_ids.shape[1]
+                spec_stats.record(new_tokens, counter.stop(), time.time() - start)
+        except Exception as e:
+            print(f"❌ Error durante la generación: {e}")
+            streamer.end()
+        finally:
+            if counter is not None:
+                counter.stop()
+
+    thread = Thread(target=run)
+    thread.start()
+    return thread
+
+def generate_stream(name, model, input_ids, attention_mask, streamer, **generation_kwargs):
+    """
+    Genera la respuesta en segundo plano escribiendo los tokens en `streamer`.
+
+    Reutiliza el KV-cache del prefijo más largo ya visto para este modelo. Si
+    el batching continuo está activo la petición se une al batch del
+    scheduler del modelo; si no, se lanza `model.generate` en un hilo.
+
+    Devuelve (manejador, tokens_reutilizados).
+    """
+    internal_name = MODEL_PATHS.get(name, name)
+    config = MODEL_CONFIGS[internal_name]
+
+    # El cache de prefijos y el scheduler trabajan con el KV-cache normal (DynamicCache)
+    dynamic_kv = kv_cache_config(config)["mode"] == "dynamic"
+
+    past, reused = (None, 0)
+    if dynamic_kv and config.get("prefix_cache", True):
+        past, reused = get_prefix_cache(name).lookup(input_ids[0].tolist())
+
+    # La decodificación especulativa verifica varios tokens por forward con generate(), sin batch
+    if (BATCHING["enabled"] and config.get("batching", True) and dynamic_kv
+            and not speculative_config(config)):
+        request = GenerationRequest(input_ids, attention_mask, streamer, past=past, reused=reused,
+                                    **generation_kwargs)
+        return get_scheduler(name, model).submit(request), reused
+
+    return _generate_in_thread(name, model, input_ids, attention_mask, streamer, past,
+                               **generation_kwargs), reused
+
+
+def generate_alternatives(name, model, input_ids, attention_mask, streamer, n, **generation_kwargs):
+    """
+    Genera `n` continuaciones muestreadas del mismo prompt en un único batch.
+
+    El prompt se procesa una sola vez (o se reutiliza del cache de prefijos) y
+    su KV-cache se replica en las `n` filas, que decodifican juntas. `streamer`
+    recibe los tokens de todas las filas (ver MultiSequenceStreamer).
+    Devuelve (hilo, tokens_reutilizados).
+
+    El prefill compartido necesita el KV-cache normal (DynamicCache) para
+    poder replicarlo; con un KV-cache cuantizado u offloaded (o si el prefill
+    compartido falla) se usa `num_return_sequences` con los argumentos del
+    modo de KV-cache configurado.
+    """
+    internal_name = MODEL_PATHS.get(name, name)
+    config = MODEL_CONFIGS[internal_name]
+    kv = kv_cache_config(config)
+    use_prefix = kv["mode"] == "dynamic" and config.get("prefix_cache", True)
+    generation_kwargs = dict(generation_kwargs, do_sample=True)
+
+    past, reused = (None, 0)
+    if use_prefix:
+        past, reused = get_prefix_cache(name).lookup(input_ids[0].tolist())
+
+    def run():
+        start = time.time()
+        shared = None
+        if use_prefix:
+            try:
+                # Prefill único de todo el prompt salvo el último token, que entra con generate()
+                cache = past if past is not None else DynamicCache()
+                if reused < input_ids.shape[1] - 1:
+                    with torch.inference_mode():
+                        model(input_ids=input_ids[:, reused:-1], attention_mask=attention_mask[:, :-1],
+                              past_key_values=cache, use_cache=True)
+                    get_prefix_cache(name).insert(input_ids[0, :-1].tolist(), cache)
+                # Si el cache ya cubre todo salvo el último token (p. ej. al repetir las alternativas), se replica tal cual
+                shared = repeat_cache(cache, n)
+            except Exception as e:
+                # Solo esta petición se repite por fila: el cache de prefijos sigue activo para las demás
+                print(f"⚠️ Prefill compartido fallido para '{internal_name}', esta petición se repite por fila: {e}")
+        try:
+            if shared is not None:
+                out = model.generate(inputs=input_ids.repeat(n, 1), attention_mask=attention_mask.repeat(n, 1),
+                                     past_key_values=shared, streamer=streamer, **generation_kwargs)
+            else:
+                out = model.generate(inputs=input_ids, attention_mask=attention_mask, num_return_sequences=n,
+                                     streamer=streamer, **generation_kwargs, **kv_cache_kwargs(kv))
+            new_tokens = out.shape[1] - input_ids.shape[1]
+            print(f"🎲 {n} alternativas en {time.time() - start:.1f}s | prompt de {input_ids.shape[1]} tokens "
+                  f"procesado {'una vez' if shared is not None else f'{n} veces'} | hasta {new_tokens} tokens por fila")
+        except Exception as e:
+            print(f"❌ Error durante la generación de alternativas: {e}")
+            streamer.end()
+
+    thread = Thread(target=run)
+    thread.start()
+    return thread, reused
@@ -1,30 +1,29 @@
 # chatbot/model_downloader.py
 import os
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from utils.model_store import ensure_snapshot, verify_in_background
 from .config import MODEL_CONFIGS, CACHE_DIR
 
+# Ficheros que necesita from_pretrained (pesos safetensors, configuración, tokenizer y código remoto).
+# Se descartan los checkpoints duplicados (.bin/.pth, carpeta original/) de algunos repos.
+ALLOW_PATTERNS = ["*.json", "*.safetensors", "*.py", "*.model", "*.txt", "*.tiktoken"]
+IGNORE_PATTERNS = ["original/*"]
+
+
 def ensure_models_downloaded():
+    verify = []
     for name, config in MODEL_CONFIGS.items():
-        repo_id = config["repo_id"]
         model_dir = os.path.join(CACHE_DIR, name)
+        # Se descargan los ficheros sin construir el modelo en memoria
+        ensure_snapshot(config["repo_id"], name, cache_dir=model_dir,
+                        allow_patterns=ALLOW_PATTERNS, ignore_patterns=IGNORE_PATTERNS)
+        verify.append((model_dir, name))
 
-        if not os.path.exists(model_dir) or not os.listdir(model_dir):
-            print(f"📥 Descargando modelo '{name}' desde {repo_id}...")
-
-            # Permitir código remoto solo si es necesario
-            trust_remote = "instella" in repo_id.lower() or "trust_remote_code" in config.get("pipeline_kwargs", {})
-
-            tokenizer = AutoTokenizer.from_pretrained(
-                repo_id,
-                cache_dir=model_dir,
-                trust_remote_code=trust_remote,
-            )
-            model = AutoModelForCausalLM.from_pretrained(
-                repo_id,
-                cache_dir=model_dir,
-                trust_remote_code=trust_remote,
-            )
+        # Modelo borrador para la decodificación especulativa, si está activa
+        spec = config.get("speculative")
+        if spec and spec.get("enabled", True) and spec["mode"] == "draft":
+            draft_dir = os.path.join(CACHE_DIR, spec["draft_name"])
+            ensure_snapshot(spec["draft_repo"], spec["draft_name"], cache_dir=draft_dir,
+                            allow_patterns=ALLOW_PATTERNS, ignore_patterns=IGNORE_PATTERNS)
+            verify.append((draft_dir, spec["draft_name"]))
 
-            print(f"✅ Modelo '{name}' descargado y guardado en {model_dir}")
-        else:
-            print(f"✅ Modelo '{name}' ya existe en caché.")
+    verify_in_background(verify)
@@ -0,0 +1,239 @@
+# chatbot/prefix_cache.py
+
+import threading
+from collections import OrderedDict
+
+from transformers import DynamicCache
+
+
+def _cache_to_tuples(cache):
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    return cache
+
+
+def slice_cache(cache, length):
+    """Devuelve una copia independiente del KV-cache con solo los primeros `length` tokens."""
+    layers = _cache_to_tuples(cache)
+    sliced = tuple(
+        (k[:, :, :length, :].clone(), v[:, :, :length, :].clone())
+        for k, v in layers
+    )
+    return DynamicCache.from_legacy_cache(sliced)
+
+
+def repeat_cache(cache, n):
+    """KV-cache de una fila repetido `n` veces en el eje del batch (copia nueva)."""
+    layers = _cache_to_tuples(cache)
+    return DynamicCache.from_legacy_cache(tuple(
+        (k.repeat_interleave(n, dim=0), v.repeat_interleave(n, dim=0))
+        for k, v in layers
+    ))
+
+
+def cache_nbytes(cache):
+    total = 0
+    for k, v in _cache_to_tuples(cache):
+        total += k.numel() * k.element_size() + v.numel() * v.element_size()
+    return total
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class _Node:
+    __slots__ = ("key", "children", "parent", "entry", "nbytes", "last_used")
+
+    def __init__(self, key=(), parent=None):
+        self.key = key            # tokens de la arista que llega a este nodo
+        self.children = {}        # primer token -> _Node
+        self.parent = parent
+        self.entry = None         # KV-cache que cubre todo el camino raíz -> nodo
+        self.nbytes = 0
+        self.last_used = 0
+
+
+class PrefixCache:
+    """
+    Árbol radix indexado por token IDs que guarda `past_key_values` reutilizables.
+
+    Cada entrada cubre el camino completo desde la raíz, así que cualquier
+    prompt que comparta un prefijo con ella puede reutilizar sus primeros
+    tokens (recortando el cache) y solo hacer prefill del resto.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.root = _Node()
+        self._lru = OrderedDict()  # id(nodo) -> nodo, del menos al más reciente
+        self._lock = threading.Lock()
+        self._tick = 0
+        # Tras close() (el modelo salió de la GPU) no se guarda nada más
+        self.closed = False
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "reused_tokens": 0,
+            "prefilled_tokens": 0,
+            "evictions": 0,
+            "entries": 0,
+            "bytes": 0,
+            "ttft_hit_total": 0.0,
+            "ttft_hit_count": 0,
+            "ttft_miss_total": 0.0,
+            "ttft_miss_count": 0,
+        }
+
+    # -- Búsqueda ----------------------------------------------------------
+
+    def _find_entry_below(self, node):
+        """Entrada más reciente dentro del subárbol de `node`."""
+        best = None
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.entry is not None and (best is None or current.last_used > best.last_used):
+                best = current
+            stack.extend(current.children.values())
+        return best
+
+    def lookup(self, token_ids):
+        """
+        Busca el prefijo cacheado más largo de `token_ids`.
+
+        Devuelve (cache, n_tokens) con una copia recortada lista para pasar a
+        `generate(past_key_values=...)`, o (None, 0) si no hay coincidencia.
+        Siempre deja al menos un token sin cachear para que haya prefill.
+        """
+        token_ids = list(token_ids)
+        with self._lock:
+            if self.closed:
+                return
+            node, pos = self.root, 0
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    break
+                common = _common_prefix(child.key, token_ids[pos:])
+                pos += common
+                node = child
+                if common < len(child.key):
+                    break
+
+            usable = min(pos, len(token_ids) - 1)
+            source = self._find_entry_below(node) if usable > 0 else None
+            if source is None:
+                self.stats["misses"] += 1
+                self.stats["prefilled_tokens"] += len(token_ids)
+                return None, 0
+
+            self._touch(source)
+            cache = slice_cache(source.entry, usable)
+            self.stats["hits"] += 1
+            self.stats["reused_tokens"] += usable
+            self.stats["prefilled_tokens"] += len(token_ids) - usable
+            return cache, usable
+
+    # -- Inserción y desalojo ----------------------------------------------
+
+    def insert(self, token_ids, cache):
+        """Guarda el KV-cache que cubre exactamente `token_ids`."""
+        token_ids = tuple(token_ids)
+        if not token_ids:
+            return
+        entry = slice_cache(cache, len(token_ids))
+        nbytes = cache_nbytes(entry)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if self.closed:
+                return
+            node, pos = self.root, 0
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    leaf = _Node(token_ids[pos:], node)
+                    node.children[token_ids[pos]] = leaf
+                    node, pos = leaf, len(token_ids)
+                    break
+                common = _common_prefix(child.key, token_ids[pos:])
+                if common < len(child.key):
+                    # Partir la arista: node -> mid -> child
+                    mid = _Node(child.key[:common], node)
+                    node.children[token_ids[pos]] = mid
+                    child.key = child.key[common:]
+                    child.parent = mid
+                    mid.children[child.key[0]] = child
+                    child = mid
+                node, pos = child, pos + common
+
+            if node.entry is not None:
+                self._drop(node)
+            node.entry = entry
+            node.nbytes = nbytes
+            self._touch(node)
+            self.stats["entries"] += 1
+            self.stats["bytes"] += nbytes
+            self._evict()
+
+    def _touch(self, node):
+        self._tick += 1
+        node.last_used = self._tick
+        self._lru[id(node)] = node
+        self._lru.move_to_end(id(node))
+
+    def _drop(self, node):
+        self._lru.pop(id(node), None)
+        self.stats["entries"] -= 1
+        self.stats["bytes"] -= node.nbytes
+        node.entry = None
+        node.nbytes = 0
+        # Poda de hojas vacías
+        while node is not self.root and node.entry is None and not node.children:
+            parent = node.parent
+            parent.children.pop(node.key[0], None)
+            node = parent
+
+    def _evict(self):
+        while self.stats["bytes"] > self.max_bytes and self._lru:
+            _, oldest = next(iter(self._lru.items()))
+            self._drop(oldest)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            for node in list(self._lru.values()):
+                self._drop(node)
+
+    def close(self):
+        """Vacía el cache y rechaza inserciones de peticiones que aún lo tengan a mano."""
+        with self._lock:
+            self.closed = True
+        self.clear()
+
+    # -- Métricas ----------------------------------------------------------
+
+    def record_ttft(self, seconds, hit):
+        kind = "hit" if hit else "miss"
+        with self._lock:
+            self.stats[f"ttft_{kind}_total"] += seconds
+            self.stats[f"ttft_{kind}_count"] += 1
+
+    def summary(self):
+        s = self.stats
+        lookups = s["hits"] + s["misses"]
+        hit_rate = s["hits"] / lookups if lookups else 0.0
+        ttft_hit = s["ttft_hit_total"] / s["ttft_hit_count"] if s["ttft_hit_count"] else 0.0
+        ttft_miss = s["ttft_miss_total"] / s["ttft_miss_count"] if s["ttft_miss_count"] else 0.0
+        return (
+            f"hits {s['hits']}/{lookups} ({hit_rate:.0%}) | "
+            f"tokens reutilizados {s['reused_tokens']} / prefill {s['prefilled_tokens']} | "
+            f"{s['entries']} entradas, {s['bytes'] / 1024**2:.0f} MiB | "
+            f"TTFT medio hit {ttft_hit:.2f}s vs miss {ttft_miss:.2f}s"
+        )
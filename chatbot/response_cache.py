@@ -0,0 +1,103 @@
+# chatbot/response_cache.py
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access);
+"""
+
+_CHUNK_RE = re.compile(r"\S+\s*|\s+")
+
+
+def normalize_text(text):
+    """Normaliza espacios para que diferencias triviales no cambien la clave."""
+    return " ".join(text.split())
+
+
+def is_cacheable(generation_params):
+    """Solo las generaciones reproducibles (greedy o con semilla fija) se cachean."""
+    return not generation_params.get("do_sample", True) or generation_params.get("seed") is not None
+
+
+def replay_chunks(text):
+    """Trocea una respuesta cacheada en fragmentos palabra a palabra para el streaming."""
+    return _CHUNK_RE.findall(text)
+
+
+class ResponseCache:
+    """
+    Cache LRU en disco (SQLite) de respuestas deterministas.
+
+    La clave combina modelo, prompt de sistema, historial normalizado,
+    mensaje y parámetros de generación; el tamaño total de las respuestas
+    guardadas se mantiene por debajo de `max_bytes`.
+    """
+
+    def __init__(self, db_path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(model, system_prompt, history, message, generation_params):
+        payload = {
+            "model": model,
+            "system": normalize_text(system_prompt),
+            "history": [[m["role"], normalize_text(m["content"])] for m in history],
+            "message": normalize_text(message),
+            "params": generation_params,
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        size = len(response.encode("utf-8"))
+        if not response or size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, size, time.time()),
+            )
+            self.stats["stores"] += 1
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+                ).fetchone()
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+                self.stats["evictions"] += 1
+            self._conn.commit()
+
+    def summary(self):
+        s = self.stats
+        lookups = s["hits"] + s["misses"]
+        rate = s["hits"] / lookups if lookups else 0.0
+        return f"hits {s['hits']}/{lookups} ({rate:.0%}) | {s['stores']} guardadas | {s['evictions']} desalojadas"
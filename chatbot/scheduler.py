@@ -0,0 +1,284 @@
+# chatbot/scheduler.py
+
+import queue
+import threading
+import time
+
+import torch
+from transformers import DynamicCache
+
+
+def _as_tuples(cache):
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    return cache
+
+
+def _left_pad(tensor, target_len, dim):
+    missing = target_len - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class GenerationRequest:
+    """Una petición de chat activa dentro del batch del scheduler."""
+
+    def __init__(self, input_ids, attention_mask, streamer, past=None, reused=0, **generation_kwargs):
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.streamer = streamer
+        self.past = past
+        self.reused = reused
+        self.generation_kwargs = generation_kwargs
+        self.generated = []
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BatchScheduler:
+    """
+    Bucle de generación con batching continuo para un modelo cargado.
+
+    Todas las peticiones activas comparten un único KV-cache con padding a la
+    izquierda y avanzan un token por iteración en un solo forward. Las nuevas
+    entran (prefill individual + fusión) y las terminadas salen entre pasos.
+    """
+
+    def __init__(self, model, prefix_cache=None, max_batch_size=8, fallback=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.fallback = fallback
+        self.pending = queue.Queue()
+        self.active = []
+        self.cache = None           # tuplas (k, v) por capa: [B, H, L, D]
+        self.attention_mask = None  # [B, L]
+        self.stats = {
+            "requests": 0,
+            "tokens": 0,
+            "steps": 0,
+            "batch_total": 0,
+            "busy_time": 0.0,
+        }
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    # -- API pública -------------------------------------------------------
+
+    def submit(self, request):
+        self.pending.put(request)
+        return request
+
+    def stop(self):
+        self._stop.set()
+        self.pending.put(None)
+        self._thread.join(timeout=5)
+        for req in self.active:
+            req.streamer.end()
+            req.done.set()
+        self.active, self.cache, self.attention_mask = [], None, None
+
+    def summary(self):
+        s = self.stats
+        avg_batch = s["batch_total"] / s["steps"] if s["steps"] else 0.0
+        tps = s["tokens"] / s["busy_time"] if s["busy_time"] else 0.0
+        return (
+            f"{s['requests']} peticiones | {s['tokens']} tokens en {s['steps']} pasos | "
+            f"batch medio {avg_batch:.2f} | {tps:.1f} tok/s agregados"
+        )
+
+    # -- Bucle principal ---------------------------------------------------
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if not self.active:
+                req = self.pending.get()
+                if req is None:
+                    break
+                self._admit(req)
+            while len(self.active) < self.max_batch_size:
+                try:
+                    req = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if req is None:
+                    return
+                self._admit(req)
+            if self.active:
+                try:
+                    self._step()
+                except Exception as e:
+                    print(f"❌ Error en el paso de decodificación del batch: {e}")
+                    for req in self.active:
+                        req.streamer.end()
+                        req.done.set()
+                    self.active, self.cache, self.attention_mask = [], None, None
+
+    def _device(self):
+        return self.model.device
+
+    @torch.inference_mode()
+    def _admit(self, req):
+        """Prefill de una petición nueva y fusión con el batch en curso."""
+        start = time.time()
+        input_ids = req.input_ids.to(self._device())
+        total = input_ids.shape[1]
+        try:
+            if req.past is not None:
+                out = self.model(
+                    input_ids=input_ids[:, req.reused:],
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=req.past,
+                    use_cache=True,
+                )
+            else:
+                out = self.model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), use_cache=True)
+        except Exception as e:
+            if self.fallback is None:
+                print(f"❌ Error en el prefill: {e}")
+                req.streamer.end()
+                req.done.set()
+                return
+            print(f"⚠️ Prefill en batch fallido, esta petición se genera con generate(): {e}")
+            self.fallback(req, e)
+            return
+        req.past = None
+        self.stats["requests"] += 1
+
+        # El streamer espera primero el prompt (skip_prompt=True)
+        req.streamer.put(input_ids[0].cpu())
+        layers = _as_tuples(out.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(input_ids[0].tolist(), DynamicCache.from_legacy_cache(layers))
+
+        token = self._sample(out.logits[:, -1, :], [req])[0]
+        if self._emit(req, token):
+            self.stats["busy_time"] += time.time() - start
+            return
+
+        mask = torch.ones((1, total), dtype=torch.long, device=input_ids.device)
+        if self.cache is None:
+            self.cache, self.attention_mask = layers, mask
+        else:
+            length = max(self.attention_mask.shape[1], total)
+            self.cache = tuple(
+                (
+                    torch.cat([_left_pad(bk, length, 2), _left_pad(nk, length, 2)], dim=0),
+                    torch.cat([_left_pad(bv, length, 2), _left_pad(nv, length, 2)], dim=0),
+                )
+                for (bk, bv), (nk, nv) in zip(self.cache, layers)
+            )
+            self.attention_mask = torch.cat(
+                [_left_pad(self.attention_mask, length, 1), _left_pad(mask, length, 1)], dim=0
+            )
+        self.active.append(req)
+        self.stats["busy_time"] += time.time() - start
+
+    @torch.inference_mode()
+    def _step(self):
+        """Un paso de decodificación para todas las peticiones activas."""
+        start = time.time()
+        device = self._device()
+        last = torch.tensor([[req.generated[-1]] for req in self.active], device=device)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((len(self.active), 1))], dim=1
+        )
+        out = self.model(
+            input_ids=last,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(self.cache),
+            use_cache=True,
+        )
+        self.cache = _as_tuples(out.past_key_values)
+        tokens = self._sample(out.logits[:, -1, :], self.active)
+
+        self.stats["steps"] += 1
+        self.stats["batch_total"] += len(self.active)
+        finished = [i for i, (req, tok) in enumerate(zip(self.active, tokens)) if self._emit(req, tok)]
+        if finished:
+            self._remove(finished)
+        self.stats["busy_time"] += time.time() - start
+
+    # -- Utilidades --------------------------------------------------------
+
+    def _sample(self, logits, requests):
+        tokens = []
+        config = self.model.generation_config
+        for row, req in zip(logits.float(), requests):
+            kw = req.generation_kwargs
+            do_sample = kw.get("do_sample", config.do_sample)
+            if not do_sample:
+                tokens.append(int(row.argmax()))
+                continue
+            temperature = kw.get("temperature", config.temperature) or 1.0
+            top_p = kw.get("top_p", config.top_p) or 1.0
+            probs = torch.softmax(row / temperature, dim=-1)
+            if top_p < 1.0:
+                sorted_probs, sorted_idx = probs.sort(descending=True)
+                keep = sorted_probs.cumsum(-1) - sorted_probs < top_p
+                sorted_probs = sorted_probs * keep
+                choice = torch.multinomial(sorted_probs / sorted_probs.sum(), 1)
+                tokens.append(int(sorted_idx[choice]))
+            else:
+                tokens.append(int(torch.multinomial(probs, 1)))
+        return tokens
+
+    def _eos_ids(self, req):
+        eos = req.generation_kwargs.get("eos_token_id", self.model.generation_config.eos_token_id)
+        if eos is None:
+            return set()
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    def _emit(self, req, token):
+        """Entrega el token al streamer. Devuelve True si la petición ha terminado."""
+        max_new = req.generation_kwargs.get("max_new_tokens", 1024)
+        if req.cancelled or token in self._eos_ids(req):
+            finished = True
+        else:
+            req.generated.append(token)
+            req.streamer.put(torch.tensor([token]))
+            self.stats["tokens"] += 1
+            finished = len(req.generated) >= max_new or any(
+                crit.matches_tail(req.generated)
+                for crit in req.generation_kwargs.get("stopping_criteria") or []
+                if hasattr(crit, "matches_tail")
+            )
+        if finished:
+            req.streamer.end()
+            req.done.set()
+        return finished
+
+    def _remove(self, rows):
+        """Saca del batch las filas terminadas y recorta el padding sobrante."""
+        if self.prefix_cache is not None:
+            for i in rows:
+                req = self.active[i]
+                pad = int((self.attention_mask[i] == 0).sum())
+                row = tuple((k[i:i + 1, :, pad:, :], v[i:i + 1, :, pad:, :]) for k, v in self.cache)
+                # Solo los tokens que ya han pasado por el modelo están en el cache
+                fed = row[0][0].shape[2]
+                tokens = (req.input_ids[0].tolist() + req.generated)[:fed]
+                self.prefix_cache.insert(tokens, DynamicCache.from_legacy_cache(row))
+
+        keep = [i for i in range(len(self.active)) if i not in rows]
+        self.active = [self.active[i] for i in keep]
+        if not self.active:
+            self.cache, self.attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        mask = self.attention_mask.index_select(0, index)
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.cache = tuple(
+            (k.index_select(0, index)[:, :, start:, :], v.index_select(0, index)[:, :, start:, :])
+            for k, v in self.cache
+        )
@@ -0,0 +1,106 @@
+# chatbot/speculative.py
+
+import threading
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from .config import CACHE_DIR
+
+
+def speculative_config(config):
+    """Devuelve la configuración de decodificación especulativa activa del modelo, o None."""
+    spec = config.get("speculative")
+    if spec and spec.get("enabled", True):
+        return spec
+    return None
+
+
+def load_draft_model(spec, max_memory=None):
+    """Carga el modelo borrador pequeño que propone tokens al modelo principal."""
+    repo_id = spec["draft_repo"]
+    draft_dir = f"{CACHE_DIR}/{spec['draft_name']}"
+    print(f"📥 Cargando modelo borrador '{spec['draft_name']}' desde {repo_id}...")
+    if torch.cuda.is_available():
+        kwargs = {"device_map": "auto", "torch_dtype": torch.float16}
+        if max_memory:
+            kwargs["max_memory"] = max_memory
+    else:
+        kwargs = {"torch_dtype": torch.float32}
+    draft = AutoModelForCausalLM.from_pretrained(repo_id, cache_dir=draft_dir, **kwargs)
+    draft.generation_config.num_assistant_tokens = spec["num_tokens"]
+    draft.generation_config.num_assistant_tokens_schedule = "constant"
+    return draft
+
+
+def speculative_kwargs(spec, draft_model=None):
+    """Argumentos extra para `model.generate` según el modo especulativo."""
+    if spec["mode"] == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": spec["num_tokens"]}
+    if spec["mode"] == "draft" and draft_model is not None:
+        return {"assistant_model": draft_model}
+    return {}
+
+
+class ForwardCounter:
+    """
+    Cuenta los forwards del modelo principal hechos desde cada hilo.
+
+    Con decodificación especulativa cada forward verifica varios tokens
+    propuestos; tokens / forwards mide cuántos se aceptan por paso.
+    """
+
+    def __init__(self, model):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._handle = model.register_forward_hook(self._hook)
+
+    def _hook(self, module, args, output):
+        ident = threading.get_ident()
+        with self._lock:
+            self._counts[ident] = self._counts.get(ident, 0) + 1
+
+    def start(self):
+        with self._lock:
+            self._counts[threading.get_ident()] = 0
+
+    def stop(self):
+        with self._lock:
+            return self._counts.pop(threading.get_ident(), 0)
+
+    def remove(self):
+        self._handle.remove()
+
+
+class SpeculativeStats:
+    """Estadísticas acumuladas de aceptación por modelo."""
+
+    def __init__(self, num_tokens):
+        self.num_tokens = num_tokens
+        self.tokens = 0
+        self.forwards = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, new_tokens, forwards, seconds):
+        if forwards <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            self.tokens += new_tokens
+            self.forwards += forwards
+            self.seconds += seconds
+        accepted = max(new_tokens - forwards, 0)
+        rate = accepted / (forwards * self.num_tokens)
+        print(
+            f"🎯 Especulativo: {new_tokens} tokens en {forwards} forwards, {new_tokens / seconds:.1f} tok/s "
+            f"({new_tokens / forwards:.2f} tok/forward, aceptación ~{rate:.0%}) | {self.summary()}"
+        )
+
+    def summary(self):
+        if not self.forwards:
+            return "sin datos"
+        accepted = max(self.tokens - self.forwards, 0)
+        return (
+            f"acumulado {self.tokens / self.seconds:.1f} tok/s, {self.tokens / self.forwards:.2f} tok/forward, "
+            f"aceptación ~{accepted / (self.forwards * self.num_tokens):.0%}"
+        )
@@ -0,0 +1,330 @@
+# chatbot/streaming.py
+
+import time
+from queue import Queue
+
+import torch
+from transformers import StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+from utils.cancellation import record_saved
+
+# Marcadores de rol del prompt: "User:" abre el turno siguiente (hay que parar),
+# "Assistant:" es un encabezado que a veces el modelo repite y se descarta.
+STOP_MARKERS = ("User:",)
+STRIP_MARKERS = ("Assistant:",)
+
+
+class RoleMarkerStoppingCriteria(StoppingCriteria):
+    """
+    Detiene la generación en cuanto el modelo empieza el turno del usuario.
+
+    Solo decodifica una ventana fija con los últimos tokens generados, así que
+    el coste por token no crece con la longitud de la respuesta.
+    """
+
+    def __init__(self, tokenizer, prompt_length, markers=STOP_MARKERS, window=8):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.markers = markers
+        self.window = window
+
+    def _has_marker(self, text):
+        return any(m in text for m in self.markers)
+
+    def matches_tail(self, generated_ids):
+        """Versión para listas de IDs generados (usada por el scheduler)."""
+        tail = generated_ids[-self.window:]
+        return self._has_marker(self.tokenizer.decode(tail, skip_special_tokens=True))
+
+    def __call__(self, input_ids, scores, **kwargs):
+        tails = input_ids[:, self.prompt_length:][:, -self.window:]
+        texts = self.tokenizer.batch_decode(tails, skip_special_tokens=True)
+        done = [self._has_marker(t) for t in texts]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """
+    Detiene la generación cuando se cancela la petición (el cliente se fue).
+
+    Sirve tanto para `generate()` como para el scheduler (`matches_tail`). Al
+    parar anota el cómputo ahorrado: los tokens que faltaban hasta
+    `max_new_tokens`, al ritmo que llevaba la propia respuesta.
+    """
+
+    def __init__(self, token, prompt_length, max_new_tokens):
+        self.token = token
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.start = time.perf_counter()
+        self.stopped = False
+
+    def _check(self, generated, rows=1):
+        if not self.token.cancelled:
+            return False
+        if not self.stopped:
+            self.stopped = True
+            elapsed = time.perf_counter() - self.start
+            saved = (self.max_new_tokens - generated) * rows
+            per_token = elapsed / (generated * rows) if generated else 0.0
+            record_saved("chat", saved, saved * per_token, time.perf_counter() - self.token.cancelled_at)
+        return True
+
+    def matches_tail(self, generated_ids):
+        return self._check(len(generated_ids))
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = self._check(input_ids.shape[1] - self.prompt_length, rows=input_ids.shape[0])
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+class IncrementalTextStreamer(BaseStreamer):
+    """
+    Streamer compatible con `TextIteratorStreamer` que detokeniza de forma incremental.
+
+    En cada token solo decodifica los tokens desde el último punto estable
+    (prefix_offset) y emite la diferencia, en lugar de re-decodificar toda
+    la línea acumulada. Los caracteres multibyte incompletos se retienen.
+    """
+
+    def __init__(self, tokenizer, skip_prompt=False, timeout=None, **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.skip_prompt = skip_prompt
+        self.timeout = timeout
+        self.decode_kwargs = decode_kwargs
+        self.next_tokens_are_prompt = True
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text_queue = Queue()
+        self.stop_signal = None
+
+    def _decode(self, tokens):
+        return self.tokenizer.decode(tokens, **self.decode_kwargs)
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            value = value[0]
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        self.next_tokens_are_prompt = False
+
+        self.tokens.extend(value.tolist())
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self.text_queue.put(new_text[len(prefix_text):], timeout=self.timeout)
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+
+    def end(self):
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+        if len(new_text) > len(prefix_text):
+            self.text_queue.put(new_text[len(prefix_text):], timeout=self.timeout)
+        self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value == self.stop_signal:
+            raise StopIteration()
+        return value
+
+
+class TurnStreamFilter:
+    """
+    Limpia la respuesta en streaming de forma incremental.
+
+    Equivale a `partial.split("User:")[0].split("Assistant:")[-1].strip()` pero
+    procesando solo cada fragmento nuevo: retiene el final del texto que aún
+    podría ser el comienzo de un marcador o espacios finales.
+    """
+
+    def __init__(self, stop_markers=STOP_MARKERS, strip_markers=STRIP_MARKERS):
+        self.stop_markers = stop_markers
+        self.strip_markers = strip_markers
+        self.text = ""
+        self.held = ""
+        self.stopped = False
+
+    def _held_suffix(self, pending):
+        """Longitud del final de `pending` que hay que retener."""
+        hold = 0
+        for marker in self.stop_markers + self.strip_markers:
+            for n in range(min(len(marker) - 1, len(pending)), 0, -1):
+                if pending.endswith(marker[:n]):
+                    hold = max(hold, n)
+                    break
+        # Los espacios finales solo se emiten si les sigue más texto
+        stripped = len(pending[:len(pending) - hold].rstrip())
+        return len(pending) - stripped
+
+    def feed(self, chunk):
+        """
+        Procesa un fragmento nuevo. Devuelve (delta, reset): si `reset` es True
+        el texto limpio se ha reemplazado entero y hay que usar `self.text`.
+        """
+        if self.stopped:
+            return "", False
+        pending = self.held + chunk
+        reset = False
+
+        cut = min((i for i in (pending.find(m) for m in self.stop_markers) if i >= 0), default=-1)
+        if cut >= 0:
+            pending = pending[:cut]
+            self.stopped = True
+
+        for marker in self.strip_markers:
+            idx = pending.rfind(marker)
+            if idx >= 0:
+                pending = pending[idx + len(marker):]
+                self.text = ""
+                reset = True
+
+        if self.stopped:
+            emit, self.held = pending.rstrip(), ""
+        else:
+            hold = self._held_suffix(pending)
+            emit, self.held = pending[:len(pending) - hold], pending[len(pending) - hold:]
+        if not self.text:
+            emit = emit.lstrip()
+        self.text += emit
+        return emit, reset
+
+    def finish(self):
+        """Emite lo retenido que no resultó ser un marcador (sin espacios finales)."""
+        if self.stopped:
+            return ""
+        emit = self.held.rstrip()
+        if not self.text:
+            emit = emit.lstrip()
+        self.held = ""
+        self.text += emit
+        return emit
+
+
+class AdaptiveFlusher:
+    """
+    Decide cuándo enviar a la interfaz el texto acumulado de la respuesta.
+
+    Si los tokens llegan despacio se envía cada uno; si llegan rápido se
+    agrupan con un intervalo que crece con el hueco entre `yield`s (lo que
+    tarda Gradio en volver a pedir al generador la siguiente actualización:
+    la contrapresión del servidor, no lo que tarda el navegador en pintarla)
+    y con el tamaño del mensaje que se reenvía. Los bytes son una estimación
+    del texto que cambia, no lo que viaja por la red.
+    """
+
+    MIN_INTERVAL = 0.05
+    MAX_INTERVAL = 0.5
+    # Presupuesto de bytes por segundo del mensaje que cambia
+    BYTES_PER_SECOND = 256 * 1024
+
+    def __init__(self, static_bytes=0):
+        self.static_bytes = static_bytes
+        self.interval = self.MIN_INTERVAL
+        self.gap = None
+        self.last_token = None
+        self.last_flush = 0.0
+        self.yielded_at = None
+        self.sent_chars = 0
+        self.yield_gaps = []
+        self.stats = {"flushes": 0, "estimated_delta_bytes": 0, "estimated_full_bytes": 0, "tokens": 0}
+
+    def token(self):
+        """Registra la llegada de un fragmento y actualiza la media del hueco entre fragmentos."""
+        now = time.perf_counter()
+        if self.last_token is not None:
+            gap = now - self.last_token
+            self.gap = gap if self.gap is None else 0.8 * self.gap + 0.2 * gap
+        self.last_token = now
+        self.stats["tokens"] += 1
+
+    def should_flush(self, text):
+        recent = sorted(self.yield_gaps[-16:])
+        yield_gap = recent[len(recent) // 2] if recent else 0.0
+        size = len(text.encode("utf-8"))
+        self.interval = min(self.MAX_INTERVAL,
+                            max(self.MIN_INTERVAL, 4 * yield_gap, size / self.BYTES_PER_SECOND))
+        if self.gap is not None and self.gap >= self.interval:
+            return True
+        return time.perf_counter() - self.last_flush >= self.interval
+
+    def flushed(self, text, replaced=False):
+        """
+        Anota un envío del texto completo `text`: se estima que solo cambia lo
+        nuevo desde el anterior, salvo que el texto se haya reemplazado (`replaced`).
+        """
+        self.stats["flushes"] += 1
+        sent = text if replaced else text[self.sent_chars:]
+        self.stats["estimated_delta_bytes"] += len(sent.encode("utf-8"))
+        self.stats["estimated_full_bytes"] += self.static_bytes + len(text.encode("utf-8"))
+        self.sent_chars = len(text)
+        self.yielded_at = self.last_flush = time.perf_counter()
+
+    def resumed(self):
+        """Llamar al volver del `yield`: el tiempo transcurrido es el hueco entre `yield`s."""
+        if self.yielded_at is not None:
+            self.yield_gaps.append(time.perf_counter() - self.yielded_at)
+            self.yielded_at = None
+
+    def summary(self):
+        s = self.stats
+        gaps = sorted(self.yield_gaps)
+        p50 = gaps[len(gaps) // 2] * 1000 if gaps else 0.0
+        worst = gaps[-1] * 1000 if gaps else 0.0
+        return (
+            f"{s['flushes']} envíos para {s['tokens']} fragmentos | ~{s['estimated_delta_bytes']} B de delta estimado "
+            f"(historial completo: ~{s['estimated_full_bytes']} B) | hueco entre yields p50 {p50:.1f}ms, máx {worst:.1f}ms"
+        )
+
+
+class MultiSequenceStreamer(BaseStreamer):
+    """
+    Streamer para generaciones con varias filas (p. ej. alternativas muestreadas).
+
+    Cada fila se detokeniza con su propio IncrementalTextStreamer y los
+    fragmentos salen por una única cola como pares (fila, texto).
+    """
+
+    def __init__(self, tokenizer, n, skip_prompt=False, timeout=None, **decode_kwargs):
+        self.rows = [IncrementalTextStreamer(tokenizer, skip_prompt=skip_prompt, **decode_kwargs)
+                     for _ in range(n)]
+        self.timeout = timeout
+        self.text_queue = Queue()
+        self.stop_signal = None
+
+    def _forward(self):
+        for i, row in enumerate(self.rows):
+            while not row.text_queue.empty():
+                text = row.text_queue.get_nowait()
+                if text != row.stop_signal:
+                    self.text_queue.put((i, text), timeout=self.timeout)
+
+    def put(self, value):
+        if len(value.shape) == 1:
+            value = value[:, None]
+        for i, row in enumerate(self.rows):
+            # generate() puede enviar el prompt antes de replicarlo en las n filas
+            row.put(value[i:i + 1] if value.shape[0] > 1 else value)
+        self._forward()
+
+    def end(self):
+        for row in self.rows:
+            row.end()
+        self._forward()
+        self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value == self.stop_signal:
+            raise StopIteration()
+        return value
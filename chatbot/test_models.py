@@ -4,11 +4,18 @@ import os
 import json
 import gc
 import time
+import uuid
+import argparse
 import logging
+import platform
+import threading
 import torch
+import transformers
 from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
 from chatbot.config import MODEL_CONFIGS, CACHE_DIR
-from chatbot.model import MODEL_PATHS
+from chatbot.model import MODEL_PATHS, load_model, unload_model, generate_stream
+from chatbot.context import get_context_window
+from chatbot.streaming import IncrementalTextStreamer
 
 # Configuración de logging
 logging.basicConfig(
@@ -183,5 +190,273 @@ def run_tests_and_save():
             torch.cuda.empty_cache()
         logger.info(f"🔻 Memoria vaciada tras prueba de ‘{alias}’\n")
 
+# ---------------------------------------------------------------------------
+# Benchmark de inferencia del chat
+# ---------------------------------------------------------------------------
+
+BENCH_DIR = "chatbot/benchmarks"
+
+FILLER_TEXT = (
+    "La inteligencia artificial estudia cómo construir sistemas capaces de aprender, razonar "
+    "y comunicarse en lenguaje natural a partir de grandes cantidades de datos. "
+)
+
+# Métricas comparadas con la referencia: True si más alto es peor
+COMPARED_METRICS = {
+    "ttft_ms.p50": True,
+    "ttft_ms.p95": True,
+    "itl_ms.p50": True,
+    "itl_ms.p95": True,
+    "itl_ms.p99": True,
+    "tokens_per_s": False,
+}
+COMPARED_MODEL_METRICS = {"load_s": True, "peak_mem_mib": True}
+
+
+class TimingStreamer(IncrementalTextStreamer):
+    """Streamer del chat que además anota cuándo llega cada token generado."""
+
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.token_times = []  # (instante, nº de tokens) por cada put
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            n = value.shape[-1] if len(value.shape) else 1
+            self.token_times.append((time.perf_counter(), n))
+        super().put(value)
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    """Percentiles por rango más cercano (en las mismas unidades que `values`)."""
+    if not values:
+        return {f"p{p}": None for p in ps}
+    ordered = sorted(values)
+    return {
+        f"p{p}": round(ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))], 3)
+        for p in ps
+    }
+
+
+def peak_memory_mib(device):
+    if device == "cuda":
+        return round(torch.cuda.max_memory_allocated() / 1024**2, 1)
+    import resource
+    # ru_maxrss está en KiB en Linux: es el máximo del proceso entero
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def register_local_model(path, context_budget=2048):
+    """Da de alta un modelo local (p. ej. uno diminuto para CPU) como si estuviera en MODEL_CONFIGS."""
+    name = os.path.basename(os.path.normpath(path))
+    MODEL_CONFIGS[name] = {
+        "repo_id": os.path.abspath(path),
+        "task": "text-generation",
+        "context_budget": context_budget,
+        "pipeline_kwargs": {},
+    }
+    return name
+
+
+def build_bench_prompt(tokenizer, n_tokens, tag):
+    """Prompt del chat con un mensaje de ~n_tokens; `tag` lo hace único para no reutilizar prefijos."""
+    filler_ids = tokenizer(FILLER_TEXT, add_special_tokens=False)["input_ids"]
+    ids = (filler_ids * (n_tokens // max(len(filler_ids), 1) + 1))[:n_tokens]
+    message = f"[{tag}] " + tokenizer.decode(ids)
+    prompt, _, _ = get_context_window(tokenizer).build_prompt(
+        DEFAULT_SYSTEM_PROMPT + "\n\n", [], message, budget=n_tokens * 2 + 512
+    )
+    return prompt
+
+
+def _run_request(name, model, tokenizer, prompt, max_new_tokens, out):
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    streamer = TimingStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    start = time.perf_counter()
+    generate_stream(name, model, inputs["input_ids"], inputs["attention_mask"], streamer,
+                    max_new_tokens=max_new_tokens, do_sample=False,
+                    eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.eos_token_id)
+    for _ in streamer:
+        pass
+    end = time.perf_counter()
+
+    times = streamer.token_times
+    itl = []
+    for (prev, _), (cur, n) in zip(times, times[1:]):
+        itl.extend([(cur - prev) * 1000 / n] * n)
+    out.append({
+        "prompt_tokens": inputs["input_ids"].shape[1],
+        "ttft_ms": (times[0][0] - start) * 1000 if times else None,
+        "itl_ms": itl,
+        "tokens": sum(n for _, n in times),
+        "seconds": end - start,
+    })
+
+
+def bench_level(name, model, tokenizer, prompt_tokens, concurrency, rounds, max_new_tokens):
+    """Lanza `rounds` tandas de `concurrency` peticiones simultáneas y agrega sus métricas."""
+    samples = []
+    wall = 0.0
+    for r in range(rounds):
+        prompts = [
+            build_bench_prompt(tokenizer, prompt_tokens, f"{r}-{i}-{uuid.uuid4().hex[:8]}")
+            for i in range(concurrency)
+        ]
+        threads = [
+            threading.Thread(target=_run_request, args=(name, model, tokenizer, p, max_new_tokens, samples))
+            for p in prompts
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall += time.perf_counter() - start
+
+    tokens = sum(s["tokens"] for s in samples)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "actual_prompt_tokens": round(sum(s["prompt_tokens"] for s in samples) / len(samples)),
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ttft_ms": percentiles([s["ttft_ms"] for s in samples if s["ttft_ms"] is not None]),
+        "itl_ms": percentiles([x for s in samples for x in s["itl_ms"]]),
+        "tokens_per_s": round(tokens / wall, 2) if wall else None,
+        "tokens": tokens,
+    }
+
+
+def run_benchmark(names, prompt_lengths, concurrency_levels, rounds=2, max_new_tokens=64):
+    """Benchmark del camino caliente del chat (load_model + generate_stream) para cada modelo."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "device": torch.cuda.get_device_name(0) if device == "cuda" else platform.processor() or "cpu",
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "max_new_tokens": max_new_tokens,
+            "rounds": rounds,
+        },
+        "models": {},
+    }
+
+    for name in names:
+        logger.info(f"🧪 Benchmark de '{name}' en {device}")
+        if device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        pipe = load_model(name)
+        load_s = time.perf_counter() - start
+        logger.info(f"  📦 Cargado en {load_s:.1f}s")
+
+        # Calentamiento: la primera petición compila kernels y reserva memoria
+        _run_request(name, pipe.model, pipe.tokenizer,
+                     build_bench_prompt(pipe.tokenizer, 16, "warmup"), 8, [])
+
+        runs = []
+        for n_tokens in prompt_lengths:
+            for concurrency in concurrency_levels:
+                res = bench_level(name, pipe.model, pipe.tokenizer, n_tokens, concurrency, rounds, max_new_tokens)
+                runs.append(res)
+                logger.info(
+                    f"  ⏱️ prompt {res['actual_prompt_tokens']} tok x{concurrency}: "
+                    f"TTFT p50 {res['ttft_ms']['p50']}ms | ITL p50/p95/p99 "
+                    f"{res['itl_ms']['p50']}/{res['itl_ms']['p95']}/{res['itl_ms']['p99']}ms | "
+                    f"{res['tokens_per_s']} tok/s"
+                )
+
+        report["models"][name] = {
+            "load_s": round(load_s, 2),
+            "peak_mem_mib": peak_memory_mib(device),
+            "runs": runs,
+        }
+        unload_model()
+    return report
+
+
+def _metric(run, path):
+    value = run
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare_reports(current, baseline, threshold=0.10):
+    """Lista de regresiones (empeoran más de `threshold` en relativo) respecto a la referencia."""
+    regressions = []
+
+    def check(label, metric, new, old, higher_is_worse):
+        if new is None or not old:
+            return
+        change = (new - old) / old if higher_is_worse else (old - new) / old
+        if change > threshold:
+            regressions.append({"where": label, "metric": metric, "baseline": old, "current": new,
+                                "change": round(change, 3)})
+
+    for name, model in current["models"].items():
+        base_model = baseline.get("models", {}).get(name)
+        if not base_model:
+            continue
+        for metric, worse in COMPARED_MODEL_METRICS.items():
+            check(name, metric, model.get(metric), base_model.get(metric), worse)
+        base_runs = {(r["prompt_tokens"], r["concurrency"]): r for r in base_model["runs"]}
+        for run in model["runs"]:
+            base_run = base_runs.get((run["prompt_tokens"], run["concurrency"]))
+            if base_run is None:
+                continue
+            label = f"{name} prompt={run['prompt_tokens']} x{run['concurrency']}"
+            for metric, worse in COMPARED_METRICS.items():
+                check(label, metric, _metric(run, metric), _metric(base_run, metric), worse)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ejemplos de conversación y benchmark de inferencia del chat")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("examples", help="Genera los chats de ejemplo de cada modelo (comportamiento por defecto)")
+
+    bench = sub.add_parser("bench", help="Mide TTFT, latencia entre tokens, tok/s, carga y memoria pico")
+    bench.add_argument("--models", nargs="*", default=None,
+                       help="Nombres de la interfaz (por defecto todos los de MODEL_PATHS)")
+    bench.add_argument("--model-path", action="append", default=[],
+                       help="Carpeta de un modelo local (p. ej. uno diminuto para CPU); se puede repetir")
+    bench.add_argument("--prompt-lengths", nargs="+", type=int, default=[128, 1024])
+    bench.add_argument("--concurrency", nargs="+", type=int, default=[1, 4])
+    bench.add_argument("--rounds", type=int, default=2)
+    bench.add_argument("--max-new-tokens", type=int, default=64)
+    bench.add_argument("--output", default=None, help="JSON de resultados (por defecto en chatbot/benchmarks/)")
+    bench.add_argument("--compare", default=None, help="JSON de referencia con el que comparar")
+    bench.add_argument("--threshold", type=float, default=0.10,
+                       help="Empeoramiento relativo a partir del cual se marca regresión")
+    args = parser.parse_args()
+
+    if args.command != "bench":
+        run_tests_and_save()
+        return
+
+    names = [register_local_model(p) for p in args.model_path]
+    if args.models is not None or not names:
+        names = (args.models or list(MODEL_PATHS)) + names
+
+    report = run_benchmark(names, args.prompt_lengths, args.concurrency, args.rounds, args.max_new_tokens)
+
+    output = args.output or os.path.join(BENCH_DIR, f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"💾 Resultados guardados en '{output}'")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.threshold)
+        for r in regressions:
+            logger.warning(f"📉 {r['where']}: {r['metric']} {r['baseline']} → {r['current']} (+{r['change']:.0%})")
+        if regressions:
+            raise SystemExit(1)
+        logger.info("✅ Sin regresiones respecto a la referencia")
+
+
 if __name__ == "__main__":
-    run_tests_and_save()
+    main()
@@ -1,15 +1,18 @@
 import gradio as gr
 import os
 import glob
-from .model import generate_image
-from images.utils.config import MODEL_CONFIGS
+from .model import generate_images
+from images.utils.config import MODEL_CONFIGS, BATCHING
 from images.utils.bootstrap import bootstrap_all
+from utils.cancellation import track, session_of, on_unload
 
 # Desactiva avisos de symlinks en Windows
 os.environ["HF_HUB_DISABLE_SYMLINKS_WARNING"] = "1"
 os.environ["HF_HUB_DISABLE_SYMLINKS"] = "1"
 
-bootstrap_all()
+def check_artifacts():
+    """Descarga checkpoints, VAE y upscalers que falten (el servidor lo lanza en segundo plano)."""
+    bootstrap_all()
 
 preset_options = {
     key: [f"{w}x{h}" for (w, h) in config["available_resolutions"]]
@@ -139,7 +142,10 @@ with gr.Blocks(css=custom_css, theme = 'Taithrah/Minimal') as demo:
             value=preset_options["realisticvision-v6"][1],
         )
 
-    seed_input = gr.Number(label="Seed (opcional, -1 = aleatoria)", value=-1, precision=0)
+    with gr.Row():
+        seed_input = gr.Textbox(label="Seed (opcional, -1 = aleatoria; varias separadas por comas)", value="-1")
+        num_images_input = gr.Slider(label="Imágenes por prompt", minimum=1, maximum=BATCHING["max_images"],
+                                     value=1, step=1)
     generate_btn = gr.Button("🎨 Generar Imagen")
     upscale_select = gr.Dropdown(
         label="Upscaler (opcional)",
@@ -147,19 +153,28 @@ with gr.Blocks(css=custom_css, theme = 'Taithrah/Minimal') as demo:
         value="none"
     )
 
-    output_base = gr.Image(label="Imagen Base (sin Hires.Fix)", interactive=False, format="png")
-    output_final = gr.Image(label="Imagen Final (con Hires.Fix y Upscaler si aplica)", interactive=False, format="png")
+    output_base = gr.Gallery(label="Imagen Base (sin Hires.Fix)", interactive=False, format="png", columns=[2])
+    output_final = gr.Gallery(label="Imagen Final (con Hires.Fix y Upscaler si aplica)", interactive=False,
+                              format="png", columns=[2])
 
     def update_resolution_options(model_key):
         resolutions = preset_options[model_key]
         return gr.update(choices=resolutions, value=resolutions[0])
 
-    def on_generate(prompt, model_key, resolution_str, seed, upscale_mode):
+    def on_generate(prompt, model_key, resolution_str, seed, num_images, upscale_mode, request: gr.Request = None):
         width, height = map(int, resolution_str.split("x"))
         resolution = (width, height)
-        seed = None if seed == -1 else int(seed)
-        image_base, image_final = generate_image(prompt, model_key, resolution, seed, upscaler_key=upscale_mode)
-        return image_base, image_final
+        try:
+            seeds = [int(s) for s in str(seed).replace(" ", "").split(",") if s] or None
+        except ValueError:
+            raise gr.Error(f"Seed no válida: '{seed}'. Usa números enteros separados por comas.")
+        # Si se cierra la pestaña el bucle de difusión para en el siguiente paso
+        with track("images", session_of(request)) as cancel:
+            results = generate_images(prompt, model_key, resolution, seeds=seeds, num_images=int(num_images),
+                                      upscaler_key=upscale_mode, cancel=cancel)
+        base = [(image_base, f"seed {seed}") for image_base, _, seed in results]
+        final = [(image_final, f"seed {seed}") for _, image_final, seed in results]
+        return base, final
 
     model_select.change(fn=update_resolution_options, inputs=model_select, outputs=resolution_radio)
 
@@ -200,14 +215,19 @@ with gr.Blocks(css=custom_css, theme = 'Taithrah/Minimal') as demo:
 
     generate_btn.click(
         fn=on_generate,
-        inputs=[prompt, model_select, resolution_radio, seed_input, upscale_select],
-        outputs=[output_base, output_final]
+        inputs=[prompt, model_select, resolution_radio, seed_input, num_images_input, upscale_select],
+        outputs=[output_base, output_final],
+        # Varias peticiones a la vez para que el agrupador pueda juntarlas en un batch
+        concurrency_limit=BATCHING["max_images"] if BATCHING["enabled"] else 1,
     ).then(
         fn=load_galleries,
         inputs=[],
         outputs=[gallery_base, gallery_final]
     )
 
+    # Al cerrar la pestaña se corta la generación que siguiera en curso
+    demo.unload(on_unload())
+
 
 def create_image_interface():
     return demo
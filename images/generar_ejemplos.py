@@ -67,7 +67,8 @@ def generar_imagen(prompt, model_key, idx):
             model_key=model_key,
             seed=42,
             denoising_strength=0.25,
-            upscale_factor=1.5
+            upscale_factor=1.5,
+            pipe=pipe
         )
     else:
         print("🔍 Aplicando Upscaler...")
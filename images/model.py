@@ -1,11 +1,16 @@
 import torch
 import os
 import time
+from threading import Lock
 from PIL import Image
 from images.utils.models import load_model
-from images.utils.config import MODEL_CONFIGS, NEGATIVE_PROMPT
+from images.utils.config import MODEL_CONFIGS, NEGATIVE_PROMPT, BATCHING
+from images.utils.batching import ImageJob, RequestCoalescer
+from images.utils.prompt_cache import prompt_cache
 from images.utils.upscaler import apply_upscale
-from images.utils.hires_fix import apply_hires_fix
+from images.utils.hires_fix import apply_hires_fix, forget_img2img_pipe
+from utils.model_cache import model_cache, DiffusersAdapter, IDLE_TIMEOUT_S, weights_nbytes
+from utils.cancellation import record_saved
 from PIL import ImageFilter
 
 # 🔍 Imports para logging de recursos
@@ -20,9 +25,27 @@ LOADED_MODELS = {}
 
 def get_or_load_model(model_key: str):
     if model_key not in LOADED_MODELS:
-        LOADED_MODELS[model_key] = load_model(model_key)
+        # Un solo modelo de imagen en la GPU: el anterior se aparca en RAM y vuelve con una copia
+        cache_key = f"images:{model_key}"
+        pipe = model_cache.restore(cache_key)
+        if pipe is None:
+            config = MODEL_CONFIGS[model_key]
+            vae = config.get("vae") or {}
+            model_cache.make_room("images", nbytes=weights_nbytes(config["path"]) + weights_nbytes(vae.get("path")))
+            pipe = load_model(model_key)
+            model_cache.add(cache_key, pipe, DiffusersAdapter(pipe), group="images",
+                            priority=config.get("priority", 0),
+                            idle_timeout=config.get("idle_timeout", IDLE_TIMEOUT_S),
+                            on_offload=lambda key: _forget(model_key))
+        LOADED_MODELS[model_key] = pipe
+        print(f"🗄️ Cache de modelos: {model_cache.summary()}")
     return LOADED_MODELS[model_key]
 
+def _forget(model_key):
+    """El modelo sale de la GPU: se olvida junto con su img2img de Hires.Fix (comparten pesos)."""
+    LOADED_MODELS.pop(model_key, None)
+    forget_img2img_pipe(model_key)
+
 def log_resource_usage():
     # RAM
     ram = psutil.virtual_memory()
@@ -41,69 +64,217 @@ def log_resource_usage():
     except Exception as e:
         print(f"⚠️ No se pudo obtener uso de VRAM: {e}")
 
-def generate_image(prompt: str, model_key: str, resolution: tuple, seed: int = None, upscaler_key: str = "none"):
+def resolve_seeds(seeds=None, num_images: int = 1):
+    """
+    Una seed por imagen. `seeds` puede ser None (todas aleatorias), un entero
+    (seed, seed+1, seed+2...) o una lista, que fija tantas imágenes como
+    elementos tenga como mínimo; si se queda corta se sigue desde la última.
+    None o -1 dentro de la lista = aleatoria.
+    """
+    if seeds is None or isinstance(seeds, int):
+        seeds = [seeds]
+    seeds = [None if s is None or int(s) == -1 else int(s) for s in seeds] or [None]
+    while len(seeds) < num_images:
+        seeds.append(None if seeds[-1] is None else seeds[-1] + 1)
+    return [torch.Generator().seed() if s is None else s for s in seeds]
+
+def generate_images(prompt: str, model_key: str, resolution: tuple, seeds=None, num_images: int = 1,
+                    upscaler_key: str = "none", cancel=None):
+    """
+    Genera `num_images` imágenes del prompt, cada una con su seed y su propio
+    generador (la misma seed da la misma imagen, vaya sola o en un batch).
+    Devuelve [(imagen_base, imagen_final, seed), ...]; vacía si se cancela.
+
+    Con BATCHING activado la petición pasa por el agrupador: las que llegan a
+    la vez con el mismo modelo y resolución comparten una llamada al pipeline.
+    """
+    job = ImageJob(prompt, model_key, resolution, resolve_seeds(seeds, num_images), upscaler_key, cancel)
+    if BATCHING["enabled"]:
+        return get_coalescer().submit(job).wait()
+    _run_batch([job])
+    return job.wait()
+
+def generate_image(prompt: str, model_key: str, resolution: tuple, seed: int = None, upscaler_key: str = "none",
+                   cancel=None):
+    results = generate_images(prompt, model_key, resolution, seeds=seed, upscaler_key=upscaler_key, cancel=cancel)
+    if not results:
+        return None, None
+    image_base, image_final, _ = results[0]
+    return image_base, image_final
+
+# --- Agrupación de peticiones ---
+
+_coalescer = None
+_coalescer_lock = Lock()
+# Tope de imágenes por batch rebajado tras quedarse sin memoria, por modelo
+_batch_limits = {}
+# Segundos por imagen base del último batch, por modelo (para estimar el cómputo ahorrado)
+_seconds_per_image = {}
+
+def get_coalescer():
+    global _coalescer
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = RequestCoalescer(
+                _run_batch,
+                max_batch=_max_batch,
+                window_s=BATCHING["window_ms"] / 1000,
+                on_dropped=_record_dropped,
+            )
+    return _coalescer
+
+def coalescer_summary():
+    return _coalescer.summary() if _coalescer else None
+
+def _max_batch(model_key):
+    return min(MODEL_CONFIGS[model_key].get("max_batch", 1), _batch_limits.get(model_key, float("inf")))
+
+def _record_dropped(job):
+    """Petición cancelada antes de llegar a la GPU: se ahorra la generación entera."""
+    images = len(job.seeds)
+    record_saved("images", MODEL_CONFIGS[job.model_key]["steps"] * images,
+                 _seconds_per_image.get(job.model_key, 0.0) * images,
+                 time.perf_counter() - job.cancel.cancelled_at)
+
+def _interrupt_on_cancel(tokens, steps, images=1):
+    """
+    callback_on_step_end de diffusers: cuando se han cancelado todas las
+    peticiones del batch, el bucle de difusión para en el siguiente paso.
+    """
+    start = time.perf_counter()
+
+    def callback(pipe, step, timestep, callback_kwargs):
+        if not pipe._interrupt and all(token.cancelled for token in tokens):
+            pipe._interrupt = True
+            done = step + 1
+            saved = steps - done
+            record_saved("images", saved * images, saved * (time.perf_counter() - start) / done,
+                         time.perf_counter() - max(token.cancelled_at for token in tokens))
+        return callback_kwargs
 
-    import threading
+    return callback
 
-    timeout_timer = threading.Timer(120, lambda: unload_model_images(model_key))
-    timeout_timer.start()
+def _run_batch(jobs):
+    """
+    Procesa peticiones con el mismo modelo y resolución: todas las imágenes
+    base en un batch del UNet y después Hires.Fix, upscaler y guardado por
+    imagen. Cada petición recibe sus resultados en cuanto están listos.
+    """
+    model_key = jobs[0].model_key
+    # El modelo no sale de la GPU (inactividad o presupuesto de VRAM) mientras se genera
+    with model_cache.in_use(f"images:{model_key}"):
+        start_total = time.perf_counter()
+        timestamp = int(time.time())
+        config = MODEL_CONFIGS[model_key]
+        width, height = jobs[0].resolution
+        pipe = get_or_load_model(model_key)
+        items = [(job, seed) for job in jobs for seed in job.seeds]
 
-    start_total = time.perf_counter()
+        print(f"\n🖼️ Generando {len(items)} imagen(es) de {len(jobs)} petición(es) con:")
+        print(f"📌 Modelo: {model_key}")
+        print(f"📐 Resolución: {width}x{height}")
+        print(f"⚙️ Steps: {config['steps']} | CFG: {config['cfg_scale']}")
+        print(f"🎲 Seeds: {', '.join(str(seed) for _, seed in items)}")
+        print(f"🧠 Upscaler: {', '.join(sorted({job.upscaler_key for job in jobs}))}")
+
+        print("\n🧪 Estado de recursos antes de generar:")
+        log_resource_usage()
+
+        # Generación
+        start_pipe = time.perf_counter()
+        images = _generate_base(pipe, model_key, items, width, height)
+        elapsed = time.perf_counter() - start_pipe
+        _seconds_per_image[model_key] = elapsed / len(items)
+        print(f"🕒 Tiempo generación base: {elapsed:.2f} s ({len(items) / elapsed * 60:.1f} imágenes/min)")
+
+        position = 0
+        for job in jobs:
+            job_images = images[position:position + len(job.seeds)]
+            position += len(job.seeds)
+            if job.cancelled:
+                # Nadie va a ver las imágenes: ni se guardan ni se aplican Hires.Fix/upscaler
+                print("⏹️ Generación cancelada: se descartan Hires.Fix, upscaler y guardado")
+                job.finish([])
+                continue
+            job.finish([
+                _finish_image(job, image_base, seed, pipe, timestamp)
+                for image_base, seed in zip(job_images, job.seeds)
+            ])
+
+        print(f"🔤 Cache de prompts: {prompt_cache.summary()}")
+        print(f"🕒 Tiempo TOTAL: {time.perf_counter() - start_total:.2f} s")
+
+def _generate_base(pipe, model_key, items, width, height):
+    """
+    Imágenes base de `items` [(petición, seed)] en una sola llamada al
+    pipeline (o varias si superan el tope de batch del modelo), con un
+    generador por imagen. Si no caben en memoria se parte
+    el batch en dos mitades y se rebaja el tope del modelo para los siguientes.
+    """
+    limit = _max_batch(model_key)
+    if len(items) > limit:
+        # Una petición con más imágenes que el tope va en varios batches seguidos
+        chunks = [items[i:i + limit] for i in range(0, len(items), limit)]
+        return [image for chunk in chunks for image in _generate_base(pipe, model_key, chunk, width, height)]
 
-    timestamp = int(time.time())
     config = MODEL_CONFIGS[model_key]
-    width, height = resolution
     steps = config["steps"]
-    guidance_scale = config["cfg_scale"]
-    pipe = get_or_load_model(model_key)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    generator = torch.Generator(device="cuda" if torch.cuda.is_available() else "cpu")
-    if seed is not None:
-        generator.manual_seed(seed)
-        print(f"🎲 Usando seed fija: {seed}")
-    else:
-        seed = generator.seed()
-        print(f"🎲 Usando seed aleatoria: {seed}")
-
-    print(f"\n🖼️ Generando imagen con:")
-    print(f"📌 Modelo: {model_key}")
-    print(f"📐 Resolución: {width}x{height}")
-    print(f"⚙️ Steps: {steps} | CFG: {guidance_scale}")
-    print(f"🧠 Upscaler: {upscaler_key}")
-
-    print("\n🧪 Estado de recursos antes de generar:")
-    log_resource_usage()
-
-    # Generación
-    start_pipe = time.perf_counter()
-    result = pipe(
-        prompt=prompt,
-        height=height,
-        width=width,
-        num_inference_steps=steps,
-        guidance_scale=guidance_scale,
-        generator=generator,
-        negative_prompt=NEGATIVE_PROMPT
-    )
-    print(f"🕒 Tiempo generación base: {time.perf_counter() - start_pipe:.2f} s")
-
-    image_base = result.images[0]
-    filename_base = f"output_{model_key}_{timestamp}_base.png"
-    save_path_base = os.path.join("images\\outputs", filename_base)
+    prompts = [job.prompt for job, _ in items]
+    shared_prompt = len(set(prompts)) == 1
+    jobs = list(dict.fromkeys(job for job, _ in items))
+    extra = {}
+    if all(job.cancel is not None for job in jobs):
+        extra["callback_on_step_end"] = _interrupt_on_cancel([job.cancel for job in jobs], steps, len(items))
+    try:
+        # Embeddings del prompt y de NEGATIVE_PROMPT desde el cache: los text encoders solo ven textos nuevos
+        embeds = prompt_cache.pipeline_kwargs(pipe, model_key, prompts[:1] if shared_prompt else prompts,
+                                              negative_prompt=NEGATIVE_PROMPT)
+        result = pipe(
+            # Mismo prompt para todo el batch: una sola fila de embeddings que el pipeline repite
+            num_images_per_prompt=len(items) if shared_prompt else 1,
+            height=height,
+            width=width,
+            num_inference_steps=steps,
+            guidance_scale=config["cfg_scale"],
+            generator=[torch.Generator(device=device).manual_seed(seed) for _, seed in items],
+            **embeds,
+            **extra
+        )
+        return result.images
+    except torch.cuda.OutOfMemoryError:
+        if len(items) == 1:
+            raise
+        torch.cuda.empty_cache()
+        half = len(items) // 2
+        _batch_limits[model_key] = min(half, _batch_limits.get(model_key, half))
+        print(f"⚠️ Sin memoria con {len(items)} imágenes por batch: se reintenta en dos mitades")
+        return (_generate_base(pipe, model_key, items[:half], width, height)
+                + _generate_base(pipe, model_key, items[half:], width, height))
+
+def _finish_image(job, image_base, seed, pipe, timestamp):
+    """Hires.Fix, upscaler y guardado de una imagen base. Devuelve (imagen_base, imagen_final, seed)."""
+    model_key = job.model_key
+    config = MODEL_CONFIGS[model_key]
+    prefix = f"output_{model_key}_{timestamp}_{seed}"
+
+    save_path_base = os.path.join("images\\outputs", f"{prefix}_base.png")
     image_base.save(save_path_base, format="PNG")
-    
+
     # Aplicar hires.fix solo a SD1.5
     if config["type"] == "sd15_safetensors":
-        print("✨ Aplicando Hires.Fix...")
+        print(f"✨ Aplicando Hires.Fix (seed {seed})...")
         try:
             start_hires = time.perf_counter()
             image_final = apply_hires_fix(
                 image=image_base,
-                prompt=prompt,
+                prompt=job.prompt,
                 model_key=model_key,
                 seed=seed,
                 denoising_strength=0.25,
-                upscale_factor=1.5
+                upscale_factor=1.5,
+                pipe=pipe
             )
             print(f"✅ Hires.Fix aplicado con éxito")
             print(f"🕒 Tiempo Hires.Fix: {time.perf_counter() - start_hires:.2f} s")
@@ -118,6 +289,10 @@ def generate_image(prompt: str, model_key: str, resolution: tuple, seed: int = N
         image_final = image_base
 
     # Upscaler si se indica
+    if job.cancelled:
+        print("⏹️ Generación cancelada: se omite el upscaler")
+        return image_base, image_final, seed
+    upscaler_key = job.upscaler_key
     if upscaler_key and upscaler_key.lower() != "none":
         print(f"🔍 Aplicando upscaler '{upscaler_key}'...")
         try:
@@ -131,20 +306,8 @@ def generate_image(prompt: str, model_key: str, resolution: tuple, seed: int = N
             print(f"⚠️ Error aplicando upscale: {e}")
 
     # Guardar imagen final
-    filename_final = f"output_{model_key}_{timestamp}_final.png"
-    save_path_final = os.path.join("images\\outputs", filename_final)
+    save_path_final = os.path.join("images\\outputs", f"{prefix}_final.png")
     image_final.save(save_path_final, format="PNG")
     print(f"💾 Imagen guardada automáticamente en: {save_path_final}")
 
-    print(f"🕒 Tiempo TOTAL: {time.perf_counter() - start_total:.2f} s")
-
-    timeout_timer.cancel()
-    def unload_model_images(model_key):
-        if model_key in LOADED_MODELS:
-            print(f"⏱️ Imagenes: modelo '{model_key}' superó los 2 minutos. Descargando...")
-            del LOADED_MODELS[model_key]
-            import torch, gc
-            torch.cuda.empty_cache()
-            gc.collect()
-
-    return image_base, image_final
\ No newline at end of file
+    return image_base, image_final, seed
@@ -0,0 +1,143 @@
+# File: images/test_downloader.py
+#
+# Pruebas del motor de descargas (images/utils/downloader.py) contra un
+# servidor HTTP local con soporte de rangos. No necesita red ni GPU:
+#
+#   python -m images.test_downloader
+#   python -m pytest images/test_downloader.py
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from images.utils.downloader import DownloadError, download
+
+PART_SIZE = 64 * 1024
+PAYLOAD = os.urandom(PART_SIZE * 10 + 1234)
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Sirve PAYLOAD en /model.bin con HEAD, GET y Range; puede cortar un rango a medias."""
+
+    server_version = "RangeTest/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length, start=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if start is not None:
+            self.send_header("Content-Range", f"bytes {start}-{start + length - 1}/{len(PAYLOAD)}")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(PAYLOAD))
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if not match:
+            self.server.requests.append(None)
+            self._headers(200, len(PAYLOAD))
+            self.wfile.write(PAYLOAD)
+            return
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(PAYLOAD) - 1
+        body = PAYLOAD[start:end + 1]
+        self.server.requests.append(start)
+        self._headers(206, len(body), start)
+        if start in self.server.fail_once:
+            # Fallo inyectado: se envía la mitad del rango y se corta la conexión
+            self.server.fail_once.discard(start)
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class LocalServer:
+    def __enter__(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.httpd.requests = []
+        self.httpd.fail_once = set()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.httpd.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/model.bin"
+        return self.httpd
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_parallel_download():
+    with LocalServer() as httpd, tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, "model.bin")
+        digest = download(httpd.url, dest, sha256=PAYLOAD_SHA256, workers=4, part_size=PART_SIZE)
+        assert digest == PAYLOAD_SHA256
+        assert _read(dest) == PAYLOAD
+        # Una petición por parte y nada a medias en disco
+        assert sorted(httpd.requests) == list(range(0, len(PAYLOAD), PART_SIZE))
+        assert not os.path.exists(dest + ".part") and not os.path.exists(dest + ".part.json")
+
+
+def test_resume_after_failure():
+    with LocalServer() as httpd, tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, "model.bin")
+        failed = 5 * PART_SIZE
+        httpd.fail_once.add(failed)
+        try:
+            download(httpd.url, dest, sha256=PAYLOAD_SHA256, workers=1, part_size=PART_SIZE)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("la descarga con un rango cortado debería fallar")
+        assert not os.path.exists(dest) and os.path.exists(dest + ".part")
+
+        # El segundo intento solo pide las partes que no se completaron
+        first_attempt = list(httpd.requests)
+        httpd.requests.clear()
+        assert download(httpd.url, dest, sha256=PAYLOAD_SHA256, workers=1, part_size=PART_SIZE) == PAYLOAD_SHA256
+        assert _read(dest) == PAYLOAD
+        completed = set(first_attempt) - {failed}
+        assert failed in httpd.requests and not completed & set(httpd.requests)
+
+
+def test_sha256_mismatch_removes_part():
+    with LocalServer() as httpd, tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, "model.bin")
+        try:
+            download(httpd.url, dest, sha256="0" * 64, workers=4, part_size=PART_SIZE)
+        except DownloadError:
+            pass
+        else:
+            raise AssertionError("un SHA-256 distinto debería rechazar la descarga")
+        assert not os.path.exists(dest)
+        assert not os.path.exists(dest + ".part") and not os.path.exists(dest + ".part.json")
+
+
+def test_truncated_legacy_file_is_replaced():
+    with LocalServer() as httpd, tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, "model.bin")
+        # Las descargas antiguas escribían directamente en `dest`: un corte dejaba el fichero a medias
+        with open(dest, "wb") as f:
+            f.write(PAYLOAD[:len(PAYLOAD) // 3])
+        assert download(httpd.url, dest, sha256=PAYLOAD_SHA256, workers=4, part_size=PART_SIZE) == PAYLOAD_SHA256
+        assert _read(dest) == PAYLOAD
+        assert httpd.requests, "el fichero truncado no debería darse por bueno"
+
+
+if __name__ == "__main__":
+    for test in (test_parallel_download, test_resume_after_failure, test_sha256_mismatch_removes_part,
+                 test_truncated_legacy_file_is_replaced):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,158 @@
+# images/utils/batching.py
+#
+# Agrupador de peticiones de imagen. Cada petición (un prompt, una o varias
+# seeds) entra en una cola; un único hilo de trabajo junta las que comparten
+# modelo y resolución y las lanza como un solo batch del UNet, que aprovecha
+# mucho mejor la GPU que varias llamadas de una imagen. Después reparte los
+# resultados entre quienes los pidieron.
+
+import threading
+import time
+
+
+class ImageJob:
+    """Una petición de generación esperando su batch (una imagen por seed)."""
+
+    def __init__(self, prompt, model_key, resolution, seeds, upscaler_key="none", cancel=None):
+        self.prompt = prompt
+        self.model_key = model_key
+        self.resolution = tuple(resolution)
+        self.seeds = list(seeds)
+        self.upscaler_key = upscaler_key
+        self.cancel = cancel
+        self.submitted_at = time.perf_counter()
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def key(self):
+        """Solo se agrupan peticiones con el mismo modelo y resolución."""
+        return self.model_key, self.resolution
+
+    @property
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.cancelled
+
+    def finish(self, results=None, error=None):
+        self.results = results if results is not None else []
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+
+class RequestCoalescer:
+    """
+    Cola de `ImageJob` con un hilo que los agrupa en batches.
+
+    `run(jobs)` procesa un grupo (mismo modelo y resolución) y llama a
+    `job.finish` para cada petición. `max_batch(model_key)` da el tope de
+    imágenes por batch. Si la GPU está libre se esperan `window_s` segundos
+    a que lleguen más peticiones; con la GPU ocupada la cola ya se va
+    llenando sola. Las peticiones canceladas mientras esperan se descartan
+    sin generar (`on_dropped(job)`).
+    """
+
+    def __init__(self, run, max_batch, window_s=0.05, on_dropped=None):
+        self.run = run
+        self.max_batch = max_batch
+        self.window_s = window_s
+        self.on_dropped = on_dropped
+        self.pending = []
+        self.stats = {
+            "requests": 0,
+            "images": 0,
+            "batches": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "busy_time": 0.0,
+            "wait_time": 0.0,
+        }
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name="images-coalescer", daemon=True)
+        self._thread.start()
+
+    # -- API pública -------------------------------------------------------
+
+    def submit(self, job):
+        with self._cond:
+            self.pending.append(job)
+            self._cond.notify()
+        return job
+
+    def summary(self):
+        s = self.stats
+        avg_batch = s["images"] / s["batches"] if s["batches"] else 0.0
+        per_minute = s["images"] / s["busy_time"] * 60 if s["busy_time"] else 0.0
+        avg_wait = s["wait_time"] / s["requests"] if s["requests"] else 0.0
+        return (
+            f"{s['requests']} peticiones | {s['images']} imágenes en {s['batches']} batches "
+            f"(batch medio {avg_batch:.2f}, {s['coalesced']} agrupados) | {per_minute:.1f} imágenes/min | "
+            f"{avg_wait:.2f}s de espera media en cola | {s['dropped']} canceladas en cola"
+        )
+
+    # -- Bucle principal ---------------------------------------------------
+
+    def _loop(self):
+        while True:
+            group = self._take()
+            if not group:
+                continue
+            start = time.perf_counter()
+            try:
+                self.run(group)
+            except Exception as e:
+                print(f"❌ Error en el batch de imágenes: {e}")
+                for job in group:
+                    if not job.done.is_set():
+                        job.finish(error=e)
+            s = self.stats
+            s["requests"] += len(group)
+            s["images"] += sum(len(job.seeds) for job in group)
+            s["batches"] += 1
+            s["coalesced"] += len(group) > 1
+            s["busy_time"] += time.perf_counter() - start
+            s["wait_time"] += sum(start - job.submitted_at for job in group)
+            print(f"🧵 Batches de imágenes: {self.summary()}")
+
+    def _take(self):
+        """Siguiente grupo: la petición más antigua y las de su misma clave que quepan en el batch."""
+        with self._cond:
+            while not self.pending:
+                self._cond.wait()
+            first = self.pending[0]
+            limit = max(1, self.max_batch(first.model_key))
+            # Ventana para que se sumen más peticiones (no se espera si la primera ya lleva tiempo en cola)
+            while True:
+                remaining = first.submitted_at + self.window_s - time.perf_counter()
+                queued = sum(len(job.seeds) for job in self.pending if job.key == first.key)
+                if remaining <= 0 or queued >= limit:
+                    break
+                self._cond.wait(remaining)
+
+            group, used, dropped = [], 0, []
+            for job in list(self.pending):
+                if job.key != first.key:
+                    continue
+                if job.cancelled:
+                    self.pending.remove(job)
+                    dropped.append(job)
+                    continue
+                # Una petición nunca se parte entre batches; si sola ya supera el tope, el run la divide
+                if group and used + len(job.seeds) > limit:
+                    continue
+                group.append(job)
+                used += len(job.seeds)
+                self.pending.remove(job)
+
+        for job in dropped:
+            self.stats["dropped"] += 1
+            if self.on_dropped is not None:
+                self.on_dropped(job)
+            job.finish([])
+        return group
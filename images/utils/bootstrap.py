@@ -1,12 +1,19 @@
 import os
 from pathlib import Path
-import requests
+from utils.model_store import ensure_file, verify_in_background
+from images.utils.downloader import download, download_many
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 MODELS_BASE = BASE_DIR / "models"
 UPSCALERS_BASE = BASE_DIR / "upscalers"
 VAE_BASE = BASE_DIR / "vae"
 
+# Artefactos que se descargan a la vez
+MAX_PARALLEL_ARTIFACTS = 3
+
+# Artefactos comprobados en este arranque (para la verificación por hash en segundo plano)
+_downloaded = []
+
 RAW_MODEL_FILES = {
     "realisticvision-v6": {
         "url": "https://huggingface.co/SG161222/Realistic_Vision_V6.0_B1_noVAE/resolve/main/Realistic_Vision_V6.0_NV_B1.safetensors",
@@ -35,18 +42,18 @@ UPSCALERS = {
 }
 
 
-def download_file(url, dest_path):
+def download_file(url, dest_path, sha256=None):
+    """Descarga (o da por buena) una única pieza; ver images.utils.downloader."""
     dest_path.parent.mkdir(parents=True, exist_ok=True)
-    if dest_path.exists():
-        print(f"✅ Ya existe: {dest_path.name}")
-        return
-    print(f"⬇️ Descargando: {dest_path.name}")
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(dest_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-    print(f"✅ Descargado: {dest_path.name}")
+    ensure_file(str(dest_path), dest_path.name, lambda dest: download(url, dest, sha256=sha256), source=url)
+    _downloaded.append((str(dest_path.parent), dest_path.name))
+
+def _artifacts():
+    """(url, destino) de todos los modelos, VAE y upscalers."""
+    items = [(info["url"], info["dest"]) for info in RAW_MODEL_FILES.values()]
+    items += [(url, VAE_BASE / name) for name, url in VAE.items()]
+    items += [(url, UPSCALERS_BASE / name) for name, url in UPSCALERS.items()]
+    return items
 
 def check_models():
     for info in RAW_MODEL_FILES.values():
@@ -62,10 +69,15 @@ def check_vae():
 
 def bootstrap_all():
     print("🔧 Iniciando verificación de modelos, upscalers y VAE...\n")
-    check_models()
-    check_vae()
-    check_upscalers()
-    print("\n✅ Todo listo.")
+    # Modelos, VAE y upscalers se descargan a la vez (cada uno, además, por rangos en paralelo)
+    errors = download_many([
+        (lambda url=url, dest=dest: download_file(url, dest)) for url, dest in _artifacts()
+    ], max_parallel=MAX_PARALLEL_ARTIFACTS)
+    verify_in_background(list(_downloaded))
+    if errors:
+        print(f"\n⚠️ {len(errors)} descargas fallaron; se reintentarán (reanudando) en el próximo arranque.")
+    else:
+        print("\n✅ Todo listo.")
 
 if __name__ == "__main__":
     bootstrap_all()
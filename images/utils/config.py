@@ -16,6 +16,12 @@ NEGATIVE_PROMPT = (
 )
 
 
+# Memoria máxima (en CPU) para los embeddings de prompts ya codificados (images/utils/prompt_cache.py)
+PROMPT_CACHE_MB = 64
+
+# Guardar junto a cada checkpoint una copia ya convertida a formato diffusers fp16
+# (images/utils/snapshots.py): solo la primera carga convierte el .safetensors original
+CHECKPOINT_SNAPSHOTS = True
 
 MODEL_CONFIGS = {
     "realisticvision-v6": {
@@ -37,7 +43,8 @@ MODEL_CONFIGS = {
         "default_resolution": (512, 512),
         "steps": 25,
         "cfg_scale": 7.0,
-        "sampler": "dpmpp_2m_karras"
+        "sampler": "dpmpp_2m_karras",
+        "max_batch": 8
     },
     "juggernautxl": {
         "name": "Juggernaut XL v9",
@@ -53,6 +60,18 @@ MODEL_CONFIGS = {
         "default_resolution": (1024, 1024),
         "steps": 35,
         "cfg_scale": 7.0,
-        "sampler": "dpmpp_2m_karras"
+        "sampler": "dpmpp_2m_karras",
+        "max_batch": 4
     },
 }
+
+# Generación por lotes: las peticiones en cola con el mismo modelo y resolución
+# se agrupan en una sola llamada al pipeline (un único batch del UNet).
+#   "max_images" -> imágenes por petición que se pueden pedir desde la interfaz
+#   "window_ms"  -> cuánto se espera a que lleguen más peticiones antes de lanzar el batch
+# El tope de imágenes por batch es "max_batch" en la entrada de cada modelo.
+BATCHING = {
+    "enabled": True,
+    "max_images": 4,
+    "window_ms": 50,
+}
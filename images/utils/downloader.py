@@ -0,0 +1,191 @@
+# images/utils/downloader.py
+#
+# Descargas grandes (checkpoints de varios GB) en paralelo por rangos HTTP,
+# reanudables y verificadas con SHA-256. El fichero final solo aparece
+# (rename atómico) cuando está completo y verificado.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+# Tamaño de cada rango que descarga un hilo y de cada escritura en disco
+PART_SIZE = 64 * 1024 * 1024
+WRITE_CHUNK = 4 * 1024 * 1024
+WORKERS = 8
+TIMEOUT = (10, 60)
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _probe(session, url):
+    """HEAD siguiendo redirecciones: (tamaño o None, admite rangos, sha256 anunciado o None)."""
+    r = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    r.raise_for_status()
+    size = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+    ranges = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+    # Hugging Face anuncia el SHA-256 de los ficheros LFS en X-Linked-ETag (antes de redirigir al CDN)
+    etag = next((resp.headers["X-Linked-ETag"] for resp in [r] + r.history if "X-Linked-ETag" in resp.headers), "")
+    etag = etag.strip('"').lower()
+    return size, ranges, etag if _SHA256_RE.match(etag) else None
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(WRITE_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class _Progress:
+    """Rangos ya completos de un `.part`, guardados junto a él para poder reanudar."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.done = set()
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("size") == size:
+                self.done = set(data["done"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def mark(self, start):
+        with self._lock:
+            self.done.add(start)
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"size": self.size, "done": sorted(self.done)}, f)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def _fetch_range(session, url, part_path, start, end, progress):
+    headers = {"Range": f"bytes={start}-{end}"}
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise DownloadError(f"el servidor ignoró el rango {start}-{end}")
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            written = 0
+            for chunk in r.iter_content(chunk_size=WRITE_CHUNK):
+                f.write(chunk)
+                written += len(chunk)
+    if written != end - start + 1:
+        raise DownloadError(f"rango {start}-{end} incompleto ({written} B)")
+    progress.mark(start)
+    return written
+
+
+def _download_ranges(session, url, part_path, size, workers, part_size):
+    progress = _Progress(part_path + ".json", size)
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+        progress.done.clear()
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+
+    pending = [s for s in range(0, size, part_size) if s not in progress.done]
+    if len(pending) < -(-size // part_size):
+        print(f"⏯️ Reanudando {os.path.basename(part_path)}: faltan {len(pending)} de {-(-size // part_size)} partes")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_fetch_range, session, url, part_path, s, min(s + part_size, size) - 1, progress)
+            for s in pending
+        ]
+        for fut in as_completed(futures):
+            fut.result()
+
+
+def _download_stream(session, url, part_path, ranges):
+    """Descarga secuencial (servidor sin rangos o tamaño desconocido); reanuda si se puede."""
+    offset = os.path.getsize(part_path) if ranges and os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            offset = 0
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=WRITE_CHUNK):
+                f.write(chunk)
+
+
+def download(url, dest, sha256=None, workers=WORKERS, part_size=PART_SIZE, session=None):
+    """
+    Descarga `url` en `dest` y devuelve el SHA-256 del fichero.
+
+    Si el servidor admite rangos se descarga en paralelo sobre `dest.part`
+    (preasignado) y el progreso por partes queda en `dest.part.json`, de modo
+    que una descarga interrumpida continúa donde se quedó. El hash se compara
+    con `sha256` o con el que anuncie el servidor; solo si coincide se
+    renombra `dest.part` a `dest`.
+    """
+    dest = str(dest)
+    part_path = dest + ".part"
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    session = session or requests.Session()
+
+    size, ranges, announced = _probe(session, url)
+    expected = (sha256 or announced or "").lower() or None
+
+    # Un fichero previo solo vale si está completo (las descargas antiguas escribían directamente en `dest`)
+    if os.path.exists(dest) and size is not None and os.path.getsize(dest) == size:
+        digest = _sha256(dest)
+        if not expected or digest == expected:
+            print(f"✅ Ya existe: {os.path.basename(dest)}")
+            return digest
+        print(f"⚠️ {os.path.basename(dest)} no coincide con el SHA-256 esperado, se vuelve a descargar")
+
+    start = time.time()
+    print(f"⬇️ Descargando: {os.path.basename(dest)}"
+          + (f" ({size / 1024**2:.0f} MiB, {workers} conexiones)" if size and ranges else ""))
+    if size and ranges:
+        _download_ranges(session, url, part_path, size, workers, part_size)
+    else:
+        _download_stream(session, url, part_path, ranges)
+
+    if size is not None and os.path.getsize(part_path) != size:
+        raise DownloadError(f"{os.path.basename(dest)}: tamaño {os.path.getsize(part_path)} B, se esperaban {size} B")
+    digest = _sha256(part_path)
+    if expected and digest != expected:
+        for p in (part_path, part_path + ".json"):
+            if os.path.exists(p):
+                os.remove(p)
+        raise DownloadError(f"{os.path.basename(dest)}: SHA-256 {digest} no coincide con {expected}")
+
+    os.replace(part_path, dest)
+    if os.path.exists(part_path + ".json"):
+        os.remove(part_path + ".json")
+    elapsed = time.time() - start
+    total = os.path.getsize(dest)
+    print(f"✅ Descargado: {os.path.basename(dest)} en {elapsed:.1f}s ({total / 1024**2 / max(elapsed, 1e-6):.1f} MiB/s)"
+          + (" · SHA-256 verificado" if expected else ""))
+    return digest
+
+
+def download_many(jobs, max_parallel=3):
+    """
+    Ejecuta varias descargas a la vez. `jobs` es una lista de funciones sin
+    argumentos; devuelve la lista de errores (vacía si todo fue bien).
+    """
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        futures = {pool.submit(job): job for job in jobs}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"❌ Error en la descarga: {e}")
+                errors.append(e)
+    return errors
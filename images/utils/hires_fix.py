@@ -10,6 +10,10 @@ from diffusers import (
 )
 
 from images.utils.config import MODEL_CONFIGS
+from images.utils.prompt_cache import prompt_cache
+
+# Pipelines img2img por modelo, construidos sobre los componentes del txt2img ya cargado
+_IMG2IMG_PIPES = {}
 
 def upscale_cv2(image: Image.Image, scale=2) -> Image.Image:
     img_np = np.array(image.convert("RGB"))  # asegúrate de estar en RGB
@@ -19,21 +23,54 @@ def upscale_cv2(image: Image.Image, scale=2) -> Image.Image:
     img_upscaled = cv2.resize(img_np, new_size, interpolation=cv2.INTER_CUBIC)
     return Image.fromarray(img_upscaled)
 
+def get_img2img_pipe(model_key: str, base_pipe):
+    """
+    Pipeline img2img que comparte UNet, VAE, text encoders y tokenizers con
+    `base_pipe` (no se lee nada de disco ni se duplica memoria). Solo el
+    scheduler es una instancia nueva con la misma configuración (p. ej.
+    DPM++ 2M Karras). Se cachea por modelo mientras el txt2img sea el mismo.
+    """
+    cached = _IMG2IMG_PIPES.get(model_key)
+    if cached is not None and cached.unet is base_pipe.unet:
+        return cached
+
+    model_type = MODEL_CONFIGS[model_key]["type"]
+    if model_type == "sdxl_safetensors":
+        pipeline_class = StableDiffusionXLImg2ImgPipeline
+        extra = {}
+    else:
+        pipeline_class = StableDiffusionImg2ImgPipeline
+        extra = {"requires_safety_checker": False}
+
+    components = dict(base_pipe.components)
+    components["scheduler"] = base_pipe.scheduler.from_config(base_pipe.scheduler.config)
+    pipe = pipeline_class(**components, **extra)
+    _IMG2IMG_PIPES[model_key] = pipe
+    print(f"♻️ Hires.Fix: img2img de '{model_key}' creado a partir del modelo ya cargado")
+    return pipe
+
+def forget_img2img_pipe(model_key: str):
+    """Suelta el img2img de un modelo (se llama cuando su txt2img sale de la GPU)."""
+    _IMG2IMG_PIPES.pop(model_key, None)
+
 def apply_hires_fix(
     prompt: str,
     model_key: str,
     image: Image.Image,
     seed: int = None,
     denoising_strength: float = 0.45,
-    upscale_factor: float = 2.0
+    upscale_factor: float = 2.0,
+    pipe=None
 ) -> Image.Image:
     """
     Aplica Hires.Fix adaptativamente según el modelo (SD 1.5 o SDXL).
 
+    `pipe` es el txt2img ya cargado del modelo (por defecto, el de
+    `images.model`): el img2img reutiliza sus componentes y su VAE.
+
     Retorna una imagen mejorada.
     """
     config = MODEL_CONFIGS[model_key]
-    model_path = config["path"]
     model_type = config["type"]
     guidance_scale = config["cfg_scale"]
     steps = 40
@@ -50,34 +87,27 @@ def apply_hires_fix(
 
     if model_type == "sdxl_safetensors":
         print("⚙️ Usando Hires.Fix con SDXL (img2img pipeline)...")
-        pipe = StableDiffusionXLImg2ImgPipeline.from_single_file(
-            model_path,
-            torch_dtype=torch.float16,
-            variant="fp16",
-            safety_checker=None
-        ).to(device)
-
     elif model_type == "sd15_safetensors":
         print("⚙️ Usando Hires.Fix con SD 1.5...")
-        pipe = StableDiffusionImg2ImgPipeline.from_single_file(
-            model_path,
-            torch_dtype=torch.float16,
-            variant="fp16",
-            safety_checker=None
-        ).to(device)
-
     else:
         print(f"⚠️ Hires.Fix no compatible con el modelo '{model_type}'.")
         return image
 
-    result = pipe(
-        prompt=prompt,
+    if pipe is None:
+        from images.model import get_or_load_model
+        pipe = get_or_load_model(model_key)
+    img2img = get_img2img_pipe(model_key, pipe)
+
+    # Los embeddings del prompt ya están en el cache desde la generación base
+    embeds = prompt_cache.pipeline_kwargs(img2img, model_key, prompt,
+                                          negative_prompt=config.get("negative_prompt", None))
+    result = img2img(
         image=image_resized,
         strength=denoising_strength,
         guidance_scale=guidance_scale,
         num_inference_steps=steps,
         generator=generator,
-        negative_prompt=config.get("negative_prompt", None),
+        **embeds,
     )
 
     print(f"✅ Hires.Fix aplicado con éxito (resolución final: {result.images[0].size})")
@@ -7,7 +7,8 @@ from diffusers import (
 )
 import torch
 import os
-from images.utils.config import MODEL_CONFIGS
+from images.utils.config import MODEL_CONFIGS, CHECKPOINT_SNAPSHOTS
+from images.utils.snapshots import snapshot_dir, read_snapshot, write_snapshot, discard_snapshot
 import time
 
 def load_model(model_key):
@@ -21,29 +22,55 @@ def load_model(model_key):
     if not os.path.exists(model_path):
         raise FileNotFoundError(f"❌ El archivo del modelo no existe: {model_path}")
 
-    start = time.time()
-
     # Elegir la clase de pipeline según el tipo
     if model_type == "sdxl_safetensors":
         pipeline_class = StableDiffusionXLPipeline
+        extra = {}
     else:
         pipeline_class = StableDiffusionPipeline
+        extra = {"safety_checker": None}
 
-    pipe = pipeline_class.from_single_file(
-        model_path,
-        torch_dtype=torch.float16,
-        variant="fp16",
-        safety_checker=None
-    )
-    print(f"✅ Modelo {model_key} cargado en {round(time.time() - start, 2)}s")
-
-    if vae_path:
-        print(f"📦 Cargando VAE desde: {vae_path}")
-        vae = AutoencoderKL.from_single_file(str(vae_path["path"]), torch_dtype=torch.float16)
-        pipe.vae = vae
-        print("✅ VAE asignado al pipeline.")
-    else:
-        print("⚠️ VAE no especificado, se usará el por defecto.")
+    # Snapshot ya convertido (formato diffusers fp16): se mapea en memoria sin reconvertir nada
+    pipe = None
+    snapshot = read_snapshot(config) if CHECKPOINT_SNAPSHOTS else None
+    if snapshot is not None:
+        start = time.time()
+        try:
+            pipe = pipeline_class.from_pretrained(str(snapshot_dir(config)), torch_dtype=torch.float16, **extra)
+        except Exception as e:
+            print(f"⚠️ Snapshot de {model_key} no válido ({e}); se convierte de nuevo")
+            discard_snapshot(config)
+        else:
+            elapsed = time.time() - start
+            before = snapshot["single_file_load_s"]
+            print(f"⚡ Modelo {model_key} cargado desde el snapshot convertido en {elapsed:.2f}s "
+                  f"(desde el checkpoint original: {before:.2f}s, x{before / max(elapsed, 1e-3):.1f})")
+            if vae_path:
+                print("✅ VAE incluido en el snapshot.")
+
+    if pipe is None:
+        start = time.time()
+        pipe = pipeline_class.from_single_file(
+            model_path,
+            torch_dtype=torch.float16,
+            variant="fp16",
+            **extra
+        )
+        print(f"✅ Modelo {model_key} cargado en {round(time.time() - start, 2)}s")
+
+        if vae_path:
+            print(f"📦 Cargando VAE desde: {vae_path}")
+            vae = AutoencoderKL.from_single_file(str(vae_path["path"]), torch_dtype=torch.float16)
+            pipe.vae = vae
+            print("✅ VAE asignado al pipeline.")
+        else:
+            print("⚠️ VAE no especificado, se usará el por defecto.")
+
+        single_file_s = time.time() - start
+        print(f"🕒 Carga en frío desde el checkpoint original: {single_file_s:.2f}s")
+        # Antes de cambiar el sampler: el snapshot guarda el scheduler original del checkpoint
+        if CHECKPOINT_SNAPSHOTS:
+            write_snapshot(pipe, config, single_file_s)
 
     # Sampler
     sampler = config.get("sampler", "").lower()
@@ -56,6 +83,9 @@ def load_model(model_key):
     else:
         print("⚠️ Sampler no reconocido, se usa el default del modelo.")
 
+    # Con varias imágenes por batch, el VAE decodifica de una en una (el pico de memoria no crece con el batch)
+    pipe.vae.enable_slicing()
+
     pipe.to("cuda" if torch.cuda.is_available() else "cpu")
     print(f"🚀 Modelo listo en dispositivo: {'cuda' if torch.cuda.is_available() else 'cpu'}")
 
@@ -0,0 +1,143 @@
+# images/utils/prompt_cache.py
+#
+# Cache LRU de embeddings de texto. NEGATIVE_PROMPT es siempre el mismo y
+# repetir una generación con otra seed o resolución no cambia el prompt, así
+# que el/los text encoders (dos en SDXL) no tienen por qué volver a pasar por
+# los mismos textos. Los pipelines reciben `prompt_embeds` y compañía
+# directamente en lugar de las cadenas.
+
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from images.utils.config import PROMPT_CACHE_MB
+
+
+def _nbytes(entry):
+    return sum(t.numel() * t.element_size() for t in entry.values())
+
+
+def _is_sdxl(pipe):
+    return getattr(pipe, "text_encoder_2", None) is not None
+
+
+class PromptEmbedCache:
+    """
+    Embeddings por (modelo, texto), del menos al más reciente, con un tope de
+    `max_bytes`. Se guardan en CPU: no ocupan VRAM y siguen valiendo aunque el
+    modelo salga de la GPU y vuelva (los pesos son los mismos).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (modelo, texto) -> {"embeds": tensor, "pooled": tensor (SDXL)}
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "entries": 0,
+            "bytes": 0,
+            "encode_time": 0.0,
+        }
+
+    # -- Búsqueda ----------------------------------------------------------
+
+    def get(self, pipe, model_key, text):
+        """Embeddings de un texto: del cache o pasándolo por los text encoders de `pipe`."""
+        key = (model_key, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+
+        start = time.perf_counter()
+        entry = self._encode(pipe, text)
+        with self._lock:
+            self.stats["misses"] += 1
+            self.stats["encode_time"] += time.perf_counter() - start
+            self._store(key, entry)
+        return entry
+
+    def pipeline_kwargs(self, pipe, model_key, prompts, negative_prompt=None):
+        """
+        kwargs de embeddings para llamar a `pipe` (txt2img o img2img): una fila
+        por texto de `prompts` y el mismo negativo en todas. Con
+        `negative_prompt=None` se hace lo mismo que haría diffusers: ceros en
+        SDXL si el modelo lo pide (`force_zeros_for_empty_prompt`) y, si no,
+        el embedding del texto vacío.
+        """
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        device = pipe._execution_device
+        dtype = (pipe.text_encoder_2 if _is_sdxl(pipe) else pipe.text_encoder).dtype
+        positive = [self.get(pipe, model_key, text) for text in prompts]
+        zero_negative = (negative_prompt is None and _is_sdxl(pipe)
+                         and getattr(pipe.config, "force_zeros_for_empty_prompt", False))
+        negative = None if zero_negative else self.get(pipe, model_key, negative_prompt or "")
+
+        def rows(name, entry_list):
+            return torch.cat([entry[name] for entry in entry_list]).to(device=device, dtype=dtype)
+
+        kwargs = {"prompt_embeds": rows("embeds", positive)}
+        if _is_sdxl(pipe):
+            kwargs["pooled_prompt_embeds"] = rows("pooled", positive)
+        if zero_negative:
+            kwargs["negative_prompt_embeds"] = torch.zeros_like(kwargs["prompt_embeds"])
+            kwargs["negative_pooled_prompt_embeds"] = torch.zeros_like(kwargs["pooled_prompt_embeds"])
+        else:
+            kwargs["negative_prompt_embeds"] = rows("embeds", [negative] * len(prompts))
+            if _is_sdxl(pipe):
+                kwargs["negative_pooled_prompt_embeds"] = rows("pooled", [negative] * len(prompts))
+        return kwargs
+
+    # -- Codificación ------------------------------------------------------
+
+    @torch.inference_mode()
+    def _encode(self, pipe, text):
+        # Sin CFG, encode_prompt solo codifica `text`: es exactamente lo que el
+        # pipeline calcularía para él, ya sea como prompt o como negativo
+        device = pipe._execution_device
+        if _is_sdxl(pipe):
+            embeds, _, pooled, _ = pipe.encode_prompt(
+                prompt=text, device=device, num_images_per_prompt=1, do_classifier_free_guidance=False
+            )
+            return {"embeds": embeds.cpu(), "pooled": pooled.cpu()}
+        embeds, _ = pipe.encode_prompt(
+            prompt=text, device=device, num_images_per_prompt=1, do_classifier_free_guidance=False
+        )
+        return {"embeds": embeds.cpu()}
+
+    # -- Memoria -----------------------------------------------------------
+
+    def _store(self, key, entry):
+        nbytes = _nbytes(entry)
+        if nbytes > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = entry
+        self.stats["entries"] += 1
+        self.stats["bytes"] += nbytes
+        while self.stats["bytes"] > self.max_bytes:
+            _, oldest = self._entries.popitem(last=False)
+            self.stats["entries"] -= 1
+            self.stats["bytes"] -= _nbytes(oldest)
+            self.stats["evictions"] += 1
+
+    def summary(self):
+        s = self.stats
+        lookups = s["hits"] + s["misses"]
+        rate = s["hits"] / lookups if lookups else 0.0
+        per_encode = s["encode_time"] / s["misses"] if s["misses"] else 0.0
+        return (
+            f"hits {s['hits']}/{lookups} ({rate:.0%}) | {s['entries']} textos, "
+            f"{s['bytes'] / 1024**2:.1f}/{self.max_bytes / 1024**2:.0f} MB | "
+            f"~{s['hits'] * per_encode:.2f}s de codificación ahorrados | {s['evictions']} desalojados"
+        )
+
+
+# Cache compartido por txt2img y Hires.Fix
+prompt_cache = PromptEmbedCache(max_bytes=PROMPT_CACHE_MB * 1024**2)
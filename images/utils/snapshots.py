@@ -0,0 +1,89 @@
+# images/utils/snapshots.py
+#
+# Cache de conversión de checkpoints. `from_single_file` tiene que leer el
+# .safetensors original y convertir sus claves a los módulos de diffusers en
+# cada carga (y lo mismo con el VAE suelto). La primera vez se guarda el
+# pipeline ya convertido en formato diffusers fp16 en una carpeta oculta junto
+# al checkpoint; las siguientes cargas lo leen con `from_pretrained`, que mapea
+# los .safetensors en memoria. Si el checkpoint o el VAE cambian (tamaño o
+# fecha de modificación) o cambia la versión de diffusers, se vuelve a convertir.
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import diffusers
+
+SNAPSHOT_VERSION = 1
+_SOURCE_FILE = "localhub_source.json"
+
+
+def snapshot_dir(config):
+    """Carpeta del snapshot: `.<checkpoint>.diffusers` junto al .safetensors (oculta para los manifiestos)."""
+    path = Path(config["path"])
+    return path.parent / f".{path.stem}.diffusers"
+
+
+def _file_signature(path):
+    if not path:
+        return None
+    stat = os.stat(path)
+    return {"name": Path(path).name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def source_signature(config):
+    """Lo que invalida el snapshot: checkpoint, VAE suelto y versión de diffusers."""
+    vae = config.get("vae") or {}
+    return {
+        "version": SNAPSHOT_VERSION,
+        "diffusers": diffusers.__version__,
+        "checkpoint": _file_signature(config["path"]),
+        "vae": _file_signature(vae.get("path")),
+    }
+
+
+def read_snapshot(config):
+    """Datos del snapshot si existe y corresponde a los ficheros actuales; None si hay que convertir."""
+    try:
+        with open(snapshot_dir(config) / _SOURCE_FILE, "r", encoding="utf-8") as f:
+            info = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    return info if info.get("source") == source_signature(config) else None
+
+
+def write_snapshot(pipe, config, single_file_s):
+    """
+    Guarda `pipe` (UNet, VAE, text encoders y scheduler) en formato diffusers.
+    Se escribe en una carpeta temporal y se cambia de nombre al final: una
+    conversión a medias nunca se toma por buena.
+    """
+    target = snapshot_dir(config)
+    tmp = target.with_name(target.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    start = time.time()
+    try:
+        pipe.save_pretrained(tmp, safe_serialization=True)
+        info = {
+            "source": source_signature(config),
+            "single_file_load_s": round(single_file_s, 2),
+            "convert_s": round(time.time() - start, 2),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open(tmp / _SOURCE_FILE, "w", encoding="utf-8") as f:
+            json.dump(info, f, indent=2)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+    except Exception as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        print(f"⚠️ No se pudo guardar el snapshot convertido ({e}); se seguirá usando el checkpoint original")
+        return None
+    size_gb = sum(f.stat().st_size for f in target.rglob("*") if f.is_file()) / 1024**3
+    print(f"💾 Snapshot diffusers fp16 guardado en {target} ({size_gb:.2f} GB, {info['convert_s']}s)")
+    return info
+
+
+def discard_snapshot(config):
+    shutil.rmtree(snapshot_dir(config), ignore_errors=True)
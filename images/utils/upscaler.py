@@ -1,119 +1,213 @@
 from pathlib import Path
 from PIL import Image
 import numpy as np
+import cv2
+import psutil
 import torch
 import time
 
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from realesrgan.archs.srvgg_arch import SRVGGNetCompact
-from realesrgan import RealESRGANer
+
+from utils.model_cache import model_cache, TorchAdapter
 
 # Rutas
 BASE_DIR = Path(__file__).resolve().parent.parent
 UPSCALERS_DIR = BASE_DIR / "upscalers"
 
 # Modelos disponibles
+# "px_bytes": memoria aproximada de activaciones por píxel de entrada en fp16 (para elegir el tamaño de tile)
 UPSCALE_MODELS = {
     "realistic": {
         "name": "RealESRGAN_x4plus",
         "file": "RealESRGAN_x4plus.pth",
-        "scale": 1.75
+        "px_bytes": 6000,
     },
     "anime": {
         "name": "RealESRGAN_x4plus_anime_6B",
         "file": "RealESRGAN_x4plus_anime_6B.pth",
-        "scale": 1.75
+        "px_bytes": 6000,
     },
     "general": {
         "name": "realesr-general-x4v3",
         "file": "realesr-general-x4v3.pth",
-        "scale": 1.75
+        "px_bytes": 1500,
     },
 }
 
-def apply_upscale(image: Image.Image, mode: str = "realistic") -> Image.Image:
-    if mode not in UPSCALE_MODELS:
-        raise ValueError(f"Modo '{mode}' no válido. Usa: {list(UPSCALE_MODELS.keys())}")
+# Escala final del upscale y escala nativa de las redes
+DESIRED_SCALE = 1.99
+NET_SCALE = 4
 
-    config = UPSCALE_MODELS[mode]
-    model_path = UPSCALERS_DIR / config["file"]
-    internal_scale = config["scale"]
-    desired_scale = 1.99
+# Tiles: solapamiento (contexto a cada lado), límites de tamaño y máximo de tiles por batch
+TILE_PAD = 16
+TILE_MIN = 128
+TILE_MAX = 1024
+TILE_BATCH_MAX = 8
+# Fracción de la memoria libre que se reserva para las activaciones
+MEMORY_FRACTION = 0.5
 
-    if not model_path.exists():
-        raise FileNotFoundError(f"No se encontró el modelo de upscale: {model_path.name}")
+# Tile que provocó falta de memoria por modo: no se vuelve a intentar uno mayor
+_tile_limits = {}
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+def _build_model(config):
     # Selección de arquitectura según nombre del modelo
     if config["name"] == "realesr-general-x4v3":
         print("📐 Arquitectura detectada: SRVGGNetCompact")
-        model = SRVGGNetCompact(
+        return SRVGGNetCompact(
             num_in_ch=3, num_out_ch=3, num_feat=64,
             num_conv=32, upscale=4, act_type='prelu'
         )
-    elif config["name"] == "RealESRGAN_x4plus_anime_6B":
+    if config["name"] == "RealESRGAN_x4plus_anime_6B":
         print("📐 Arquitectura detectada: RRDBNet (anime, 6 bloques)")
-        model = RRDBNet(
+        return RRDBNet(
             num_in_ch=3, num_out_ch=3,
             num_feat=64, num_block=6,
             num_grow_ch=32
         )
-    elif config["name"] == "RealESRGAN_x4plus":
-        print("📐 Arquitectura detectada: RRDBNet (realistic, 23 bloques)")
-        model = RRDBNet(
-            num_in_ch=3, num_out_ch=3,
-            num_feat=64, num_block=23,
-            num_grow_ch=32
-        )
+    print("📐 Arquitectura detectada: RRDBNet (realistic, 23 bloques)")
+    return RRDBNet(
+        num_in_ch=3, num_out_ch=3,
+        num_feat=64, num_block=23,
+        num_grow_ch=32
+    )
+
 
-    # Cargar pesos si hay modelo explícito
+def get_upscaler(mode: str):
+    """
+    Red del upscaler lista en el dispositivo, cargada una sola vez.
+
+    Vive en el cache de modelos compartido (grupo "upscalers"): si otro
+    upscaler ocupa la GPU, este se aparca en RAM y vuelve con una copia.
+    fp16 en CUDA, fp32 en CPU.
+    """
+    key = f"upscaler:{mode}"
+    model = model_cache.restore(key)
     if model is not None:
-        try:
-            state_dict = torch.load(model_path, map_location=device)
-            if isinstance(state_dict, dict):
-                if "params_ema" in state_dict:
-                    state_dict = state_dict["params_ema"]
-                elif "params" in state_dict:
-                    state_dict = state_dict["params"]
-            model.load_state_dict(state_dict, strict=False)
-            print(f"✅ Modelo '{mode}' cargado con strict=False en {device}")
-        except Exception as e:
-            raise RuntimeError(f"❌ Error al cargar pesos para '{mode}': {e}")
-    else:
-        print(f"📦 Modelo '{mode}' se cargará automáticamente en RealESRGANer")
-
-    # Inicializar el upsampler
-    upsampler = RealESRGANer(
-        model_path=str(model_path),
-        model=model,
-        scale=internal_scale,
-        tile=0,
-        tile_pad=10,
-        pre_pad=0,
-        half=True,
-        device=device
-    )
+        return model
 
-    # Aplicar upscale
-    img_np = np.array(image.convert("RGB"))
-    print(f"🔧 Iniciando upscale con outscale={desired_scale}...")
-    start_time = time.time()
+    config = UPSCALE_MODELS[mode]
+    model_path = UPSCALERS_DIR / config["file"]
+    if not model_path.exists():
+        raise FileNotFoundError(f"No se encontró el modelo de upscale: {model_path.name}")
 
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+    model = _build_model(config)
     try:
-        output_np, _ = upsampler.enhance(img_np, outscale=desired_scale)
+        state_dict = torch.load(model_path, map_location="cpu")
+        if isinstance(state_dict, dict):
+            if "params_ema" in state_dict:
+                state_dict = state_dict["params_ema"]
+            elif "params" in state_dict:
+                state_dict = state_dict["params"]
+        model.load_state_dict(state_dict, strict=False)
     except Exception as e:
-        raise RuntimeError(f"❌ Error durante upscale con RealESRGANer: {e}")
+        raise RuntimeError(f"❌ Error al cargar pesos para '{mode}': {e}")
+    model.eval().requires_grad_(False)
+    model = model.to(device=device, dtype=dtype)
+    print(f"✅ Modelo '{mode}' cargado en {device} ({str(dtype).replace('torch.', '')})")
+
+    model_cache.add(key, model, TorchAdapter([model]), group="upscalers")
+    return model
+
+
+def _free_memory(device):
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    return psutil.virtual_memory().available
+
+
+def _plan_tiles(mode, device, dtype, height, width):
+    """(alto, ancho, batch): tamaño del tile (sin solapamiento) y tiles por forward según la memoria libre."""
+    px_bytes = UPSCALE_MODELS[mode]["px_bytes"] * (2 if dtype == torch.float32 else 1)
+    budget = _free_memory(device) * MEMORY_FRACTION
+
+    side = int((budget / px_bytes) ** 0.5) - 2 * TILE_PAD
+    side = max(TILE_MIN, min(TILE_MAX, _tile_limits.get(mode, TILE_MAX), side)) // 32 * 32
+    tile_h, tile_w = min(side, height), min(side, width)
+
+    per_tile = (tile_h + 2 * TILE_PAD) * (tile_w + 2 * TILE_PAD) * px_bytes
+    batch = int(max(1, min(TILE_BATCH_MAX, budget // per_tile)))
+    return tile_h, tile_w, batch
+
+
+def _tile_origins(size, tile):
+    # Todos los tiles tienen el mismo tamaño (el último se apoya en el borde) para poder agruparlos
+    starts = list(range(0, max(size - tile, 0) + 1, tile))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+@torch.inference_mode()
+def _upscale_tiled(model, img, tile_h, tile_w, batch):
+    """
+    Inferencia por tiles con solapamiento: cada tile se procesa con TILE_PAD
+    píxeles de contexto a cada lado y solo se conserva su centro, así no se
+    ven costuras. Los tiles se agrupan de `batch` en `batch` en un mismo
+    forward. Devuelve la imagen x4 en CPU (uint8, C x H x W).
+    """
+    _, _, height, width = img.shape
+    pad_mode = "reflect" if min(height, width) > TILE_PAD else "replicate"
+    padded = torch.nn.functional.pad(img, (TILE_PAD,) * 4, mode=pad_mode)
+    out = torch.empty((3, height * NET_SCALE, width * NET_SCALE), dtype=torch.uint8)
+
+    origins = [(y, x) for y in _tile_origins(height, tile_h) for x in _tile_origins(width, tile_w)]
+    core = slice(TILE_PAD * NET_SCALE, None)
+    for i in range(0, len(origins), batch):
+        group = origins[i:i + batch]
+        tiles = torch.cat([
+            padded[:, :, y:y + tile_h + 2 * TILE_PAD, x:x + tile_w + 2 * TILE_PAD] for y, x in group
+        ])
+        result = model(tiles).clamp_(0, 1).mul_(255).round_().to(torch.uint8).cpu()
+        for (y, x), tile in zip(group, result):
+            center = tile[:, core, core][:, :tile_h * NET_SCALE, :tile_w * NET_SCALE]
+            out[:, y * NET_SCALE:(y + tile_h) * NET_SCALE, x * NET_SCALE:(x + tile_w) * NET_SCALE] = center
+    return out, len(origins)
 
-    end_time = time.time()
-    print(f"✅ Upscale finalizado en {end_time - start_time:.2f} s")
 
-    upscaled = Image.fromarray(output_np)
-
-    # Reescalar si es necesario
-    if internal_scale > desired_scale:
-        new_size = tuple((s * desired_scale // internal_scale) for s in upscaled.size)
-        print(f"🔧 Reescalando de {upscaled.size} a {new_size} (forzado x2 final)")
-        upscaled = upscaled.resize(new_size, Image.LANCZOS)
+def apply_upscale(image: Image.Image, mode: str = "realistic") -> Image.Image:
+    if mode not in UPSCALE_MODELS:
+        raise ValueError(f"Modo '{mode}' no válido. Usa: {list(UPSCALE_MODELS.keys())}")
 
-    return upscaled
+    start_time = time.time()
+    with model_cache.in_use(f"upscaler:{mode}"):
+        model = get_upscaler(mode)
+        load_time = time.time() - start_time
+        param = next(model.parameters())
+        device, dtype = param.device, param.dtype
+
+        img_np = np.array(image.convert("RGB"))
+        height, width = img_np.shape[:2]
+        img = torch.from_numpy(img_np).permute(2, 0, 1).unsqueeze(0).to(device=device, dtype=dtype).div_(255)
+
+        tile_h, tile_w, batch = _plan_tiles(mode, device, dtype, height, width)
+        while True:
+            print(f"🔧 Iniciando upscale con outscale={DESIRED_SCALE} (tiles {tile_w}x{tile_h}, batch {batch})...")
+            try:
+                output, n_tiles = _upscale_tiled(model, img, tile_h, tile_w, batch)
+                break
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                if batch > 1:
+                    batch = max(1, batch // 2)
+                elif max(tile_h, tile_w) > TILE_MIN:
+                    tile_h = min(height, max(TILE_MIN, tile_h // 2))
+                    tile_w = min(width, max(TILE_MIN, tile_w // 2))
+                    _tile_limits[mode] = max(tile_h, tile_w)
+                else:
+                    raise RuntimeError("❌ Sin memoria para el upscale ni con el tile mínimo")
+                print(f"⚠️ Sin memoria: se reintenta con tiles {tile_w}x{tile_h} y batch {batch}")
+
+    # De x4 a la escala final (x1.99) con Lanczos
+    output_np = output.permute(1, 2, 0).numpy()
+    final_size = (int(width * DESIRED_SCALE), int(height * DESIRED_SCALE))
+    output_np = cv2.resize(output_np, final_size, interpolation=cv2.INTER_LANCZOS4)
+
+    print(f"✅ Upscale finalizado en {time.time() - start_time:.2f} s "
+          f"(carga {load_time:.2f} s, {n_tiles} tiles, {str(dtype).replace('torch.', '')} en {device})")
+    return Image.fromarray(output_np)
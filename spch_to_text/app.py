@@ -3,21 +3,28 @@
 import os
 import gradio as gr
 from spch_to_text.model import (
-    load_model, transcribe_audio, ensure_model_downloaded
+    load_model, transcribe_audio, ensure_model_downloaded, model_in_use, MODELS, MODEL_DIR, STATE
 )
+from utils.model_store import verify_in_background
 from spch_to_text.utils.audio import delete_temp_files
+from utils.cancellation import track, session_of, on_unload
 
-state = {"model": None, "mode": None}
+# Mismo estado que el modelo: si el cache de modelos lo saca de la GPU, la app lo ve
+state = STATE
 
 custom_css = open("spch_to_text/custom_style.css", "r", encoding="utf-8").read()
 
-# Descarga modelos al iniciar
-for key in ["turbo", "accurate"]:
-    try:
-        print(f"🔍 Verificando modelo: {key}")
-        ensure_model_downloaded(key)
-    except Exception as e:
-        print(f"❌ Error al descargar el modelo '{key}': {e}")
+def check_artifacts():
+    """Descarga los modelos que falten (con manifiesto válido basta un stat por fichero)."""
+    for key in ["turbo", "accurate"]:
+        try:
+            print(f"🔍 Verificando modelo: {key}")
+            ensure_model_downloaded(key)
+        except Exception as e:
+            print(f"❌ Error al descargar el modelo '{key}': {e}")
+    verify_in_background([
+        (os.path.join(MODEL_DIR, m["name"]), m["name"]) for m in MODELS.values()
+    ])
 
 def init_model(mode_choice):
     print(f"🚀 Inicializando modelo: {mode_choice}")
@@ -30,15 +37,15 @@ def init_model(mode_choice):
         print(f"❌ Error cargando el modelo: {e}")
         return f"❌ Error al cargar modelo: {e}"
 
-def process(audio_path, mode_choice, language_choice):
-    
-    import threading
-
-    timeout_timer = threading.Timer(120, lambda: unload_model_audio())
-    timeout_timer.start()
-
+def process(audio_path, mode_choice, language_choice, request: gr.Request = None):
     if not audio_path:
         return "⚠️ Por favor sube un archivo de audio.", None, None
+    # El modelo no sale de la GPU (inactividad o presupuesto de VRAM) mientras se transcribe;
+    # si se cierra la pestaña la transcripción para en el siguiente segmento
+    with model_in_use(mode_choice), track("whisper", session_of(request)) as cancel:
+        return _process(audio_path, mode_choice, language_choice, cancel)
+
+def _process(audio_path, mode_choice, language_choice, cancel):
     print(f"📥 Audio recibido: {audio_path}")
 
     if state["model"] is None or state["mode"] != mode_choice:
@@ -47,7 +54,9 @@ def process(audio_path, mode_choice, language_choice):
     try:
         lang = None if language_choice == "Auto" else language_choice.lower()
         print(f"🌍 Idioma seleccionado: {lang or 'auto'}")
-        full_text, timestamps = transcribe_audio(state["model"], audio_path, lang)
+        full_text, timestamps = transcribe_audio(state["model"], audio_path, lang, cancel)
+        if cancel.cancelled:
+            return full_text, None, None
 
         srt_output = "\n".join([
             f"{i+1}\n{format_srt_time(t['start'])} --> {format_srt_time(t['end'])}\n{t['text']}\n"
@@ -62,24 +71,12 @@ def process(audio_path, mode_choice, language_choice):
         with open(srt_file, "w", encoding="utf-8") as f:
             f.write(srt_output)
 
-        timeout_timer.cancel()
         print(f"✅ Transcripción finalizada: {txt_file}, {srt_file}")
         return full_text, txt_file, srt_file
     except Exception as e:
         print(f"❌ Error durante transcripción: {e}")
         return f"❌ Error: {e}", None, None
 
-def unload_model_audio():
-    from spch_to_text.model import STATE
-    if STATE["model"] is not None:
-        print("⏱️ Audio: modelo superó los 2 minutos. Descargando de VRAM...")
-        STATE["model"] = None
-        STATE["mode"] = None
-        import torch, gc
-        torch.cuda.empty_cache()
-        gc.collect()
-
-
 def reset_app():
     print("🔁 Reseteando aplicación...")
     delete_temp_files()
@@ -171,5 +168,6 @@ Obtendrás el texto transcrito y los subtítulos listos para usar (.srt).
         )
 
         demo.load(lambda: init_model("auto"), None, status)
+        demo.unload(on_unload())
 
     return demo
@@ -1,9 +1,12 @@
 # spch_to_text/model.py
 
 import os
+import time
 import torch
 from faster_whisper import WhisperModel
-from huggingface_hub import snapshot_download
+from utils.model_store import ensure_snapshot
+from utils.model_cache import model_cache, CTranslate2Adapter, IDLE_TIMEOUT_S, weights_nbytes
+from utils.cancellation import record_saved
 from spch_to_text.utils.audio import to_wav16k_mono
 
 # Configuración de modelos
@@ -24,24 +27,10 @@ MODELS = {
 MODEL_DIR = "spch_to_text/models"
 
 def ensure_model_downloaded(model_key: str):
-    """Descarga manual del modelo completo desde Hugging Face."""
+    """Garantiza los ficheros del modelo (manifiesto + descarga fichero a fichero si falta algo)."""
     model_data = MODELS[model_key]
-    model_name = MODELS[model_key]["name"]
     local_path = os.path.join(MODEL_DIR, model_data["name"])
-
-    if not os.path.exists(local_path):
-        print(f"📥 Descargando modelo '{model_data['name']}' desde HuggingFace...")
-        snapshot_download(
-            repo_id=model_data["repo"],
-            local_dir=local_path,
-            local_dir_use_symlinks=False,
-            resume_download=True
-        )
-        print(f"✅ Modelo descargado en: {local_path}")
-    else:
-        print(f"✅ Modelo ya descargado: {model_name}")
-        
-    return local_path
+    return ensure_snapshot(model_data["repo"], model_data["name"], local_dir=local_path)
 
 def detect_mode(requested="auto"):
     if requested in MODELS:
@@ -59,30 +48,51 @@ def load_model(requested_mode):
     device = "cuda" if torch.cuda.is_available() else "cpu"
     compute_type = "float16" if device == "cuda" else "int8"
 
-    print(f"🚀 Cargando modelo '{mode}' en {device.upper()} ({compute_type}) desde: {model_path}")
-
-    model = WhisperModel(
-        model_size_or_path=model_path,
-        device=device,
-        compute_type=compute_type
-    )
+    # Si el modelo anterior sigue en la GPU baja a RAM; este vuelve de RAM si ya se había usado
+    cache_key = f"whisper:{mode}"
+    model = model_cache.restore(cache_key)
+    if model is None:
+        model_cache.make_room("whisper", nbytes=weights_nbytes(model_path))
+        print(f"🚀 Cargando modelo '{mode}' en {device.upper()} ({compute_type}) desde: {model_path}")
+        model = WhisperModel(
+            model_size_or_path=model_path,
+            device=device,
+            compute_type=compute_type
+        )
+        model_cache.add(cache_key, model, CTranslate2Adapter(model.model, model_path), group="whisper",
+                        priority=MODELS[mode].get("priority", 0),
+                        idle_timeout=MODELS[mode].get("idle_timeout", IDLE_TIMEOUT_S),
+                        on_offload=lambda key: _forget(mode))
     STATE["model"] = model
     STATE["mode"] = mode
     
     return model, mode
 
-def transcribe_audio(model, audio_path, language=None):
-    """Convierte a WAV, transcribe y devuelve texto + timestamps."""
+def transcribe_audio(model, audio_path, language=None, cancel=None):
+    """
+    Convierte a WAV, transcribe y devuelve texto + timestamps. Con `cancel`
+    la transcripción para en el siguiente segmento si se cancela la petición
+    (faster-whisper decodifica los segmentos a medida que se piden).
+    """
     os.makedirs("spch_to_text/temp", exist_ok=True)
     wav_path = os.path.join("spch_to_text/temp", "input.wav")
     to_wav16k_mono(audio_path, wav_path)
 
+    start = time.perf_counter()
     segments, info = model.transcribe(wav_path, beam_size=5, language=language)
     print(f"⏱️  Duración: {info.duration:.2f} segundos")
 
     full_text = ""
     timestamps = []
     for segment in segments:
+        if cancel is not None and cancel.cancelled:
+            # Audio que ya no se transcribe, al ritmo que llevaba esta petición
+            elapsed = time.perf_counter() - start
+            saved = info.duration - segment.start
+            rate = elapsed / segment.start if segment.start > 0 else 0.0
+            record_saved("whisper", saved, saved * rate, time.perf_counter() - cancel.cancelled_at)
+            segments.close()
+            break
         full_text += segment.text.strip() + " "
         timestamps.append({
             "start": segment.start,
@@ -98,9 +108,19 @@ STATE = {"model": None, "mode": None}
 def unload_model():
     if STATE["model"] is not None:
         print(f"🔻 Descargando modelo de la VRAM ({STATE['mode']})")
-        STATE["model"] = None
-        STATE["mode"] = None
-        torch.cuda.empty_cache()
+        if not model_cache.offload(f"whisper:{STATE['mode']}") and model_cache.busy(f"whisper:{STATE['mode']}"):
+            return False
+        _forget(STATE["mode"])
         return True
     return False
 
+def _forget(mode):
+    """Olvida el modelo cuando sale de la GPU (también si lo desaloja el cache de modelos)."""
+    if STATE["mode"] == mode:
+        STATE["model"] = None
+        STATE["mode"] = None
+
+def model_in_use(mode):
+    """Mientras dura el bloque el modelo no sale de la GPU (ni por inactividad ni por presupuesto)."""
+    return model_cache.in_use(f"whisper:{detect_mode(mode)}")
+
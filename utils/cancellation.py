@@ -0,0 +1,120 @@
+# utils/cancellation.py
+#
+# Cancelación de inferencias en curso cuando el cliente se desconecta.
+# Cada petición lleva un CancelToken que consultan los bucles de trabajo
+# (stopping criteria del chat, callback por paso de diffusers, segmentos de
+# Whisper). Los tokens se agrupan por sesión de Gradio para poder cancelar
+# todo lo de una pestaña cuando se cierra (evento `unload`).
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CancelToken:
+    """Marca compartida entre la petición y el hilo que hace el trabajo."""
+
+    def __init__(self, app):
+        self.app = app
+        self.reason = None
+        self.cancelled_at = None
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cliente desconectado"):
+        if not self._event.is_set():
+            self.reason = reason
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            print(f"🛑 {self.app}: cancelando ({reason})")
+
+
+# Cómputo ahorrado por app: peticiones canceladas, trabajo que no se hizo y su tiempo estimado
+STATS = {}
+_UNITS = {"chat": "tokens", "images": "pasos", "whisper": "s de audio"}
+_lock = threading.Lock()
+
+
+def record_saved(app, saved_units, saved_s, stop_latency_s=None):
+    """
+    Anota una cancelación: `saved_units` es el trabajo que ya no se hace
+    (tokens, pasos de difusión, segundos de audio) y `saved_s` su tiempo
+    estimado al ritmo observado en la propia petición.
+    """
+    with _lock:
+        s = STATS.setdefault(app, {"cancelled": 0, "saved_units": 0.0, "saved_s": 0.0, "stop_latency_s": 0.0})
+        s["cancelled"] += 1
+        s["saved_units"] += max(saved_units, 0)
+        s["saved_s"] += max(saved_s, 0.0)
+        if stop_latency_s is not None:
+            s["stop_latency_s"] += stop_latency_s
+    print(f"♻️ Cancelación: {summary(app)}")
+
+
+def summary(app):
+    s = STATS.get(app)
+    if not s:
+        return f"{app}: sin cancelaciones"
+    latency = s["stop_latency_s"] / s["cancelled"]
+    return (
+        f"{app}: {s['cancelled']} canceladas | ~{s['saved_units']:.0f} {_UNITS.get(app, 'unidades')} "
+        f"y ~{s['saved_s']:.1f}s de cómputo ahorrados | {latency * 1000:.0f} ms de media hasta parar"
+    )
+
+
+# --- Tokens por sesión de Gradio ---
+
+_sessions = {}
+
+
+@contextmanager
+def track(app, session=None):
+    """Token de cancelación para una petición; se registra bajo `session` mientras dura."""
+    token = CancelToken(app)
+    with _lock:
+        _sessions.setdefault(session, set()).add(token)
+    try:
+        yield token
+    finally:
+        with _lock:
+            tokens = _sessions.get(session)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del _sessions[session]
+
+
+def cancel_session(session, reason="pestaña cerrada"):
+    """Cancela todo lo que esté en curso para una sesión (se engancha a `demo.unload`)."""
+    if session is None:
+        return 0
+    with _lock:
+        tokens = list(_sessions.get(session, ()))
+    for token in tokens:
+        token.cancel(reason)
+    return len(tokens)
+
+
+def session_of(request):
+    """session_hash de la petición de Gradio (None fuera de Gradio)."""
+    return getattr(request, "session_hash", None) if request is not None else None
+
+
+def on_unload(then=None):
+    """
+    Función para `demo.unload`: al cerrar la pestaña se cancela lo que siga en
+    curso en esa sesión. `then(session_hash)` permite a cada app limpiar además
+    su propio estado de la pestaña.
+    """
+    import gradio as gr
+
+    def cancel(request: gr.Request):
+        session = session_of(request)
+        cancel_session(session)
+        if then is not None and session is not None:
+            then(session)
+
+    return cancel
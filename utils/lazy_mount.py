@@ -0,0 +1,180 @@
+# utils/lazy_mount.py
+#
+# Montaje diferido de las mini-apps en el servidor FastAPI.
+# Importar una mini-app arrastra torch, transformers, diffusers, faster_whisper,
+# realesrgan... y comprobar sus artefactos puede tardar minutos. El servidor
+# arranca sin nada de eso: un hilo en segundo plano importa cada app y la
+# monta; mientras tanto su ruta responde con una página de "calentando" y
+# `/status` muestra en qué punto está cada una.
+
+import asyncio
+import threading
+import time
+import traceback
+from contextlib import AsyncExitStack
+
+WARMING_PAGE = """<!DOCTYPE html>
+<html lang="es"><head><meta charset="UTF-8"><meta http-equiv="refresh" content="2">
+<title>LocalHub</title><link rel="stylesheet" href="/static/index.css"></head>
+<body><header><h1>⏳ {name}</h1><p>{message}</p></header></body></html>"""
+
+
+class _Mount:
+    def __init__(self, prefix, name, factory, kind):
+        self.prefix = prefix
+        self.name = name
+        self.factory = factory
+        self.kind = kind
+        self.app = None
+        self.state = "pending"
+        self.seconds = None
+        self.error = None
+        self.started = False
+
+    def matches(self, path):
+        return path == self.prefix or path.startswith(self.prefix + "/")
+
+
+class LazyMounts:
+    """
+    Registro de rutas montadas en diferido. `gradio(prefix, name, factory)`
+    registra una interfaz de Gradio (`factory` devuelve el Blocks) y
+    `router(prefix, name, factory)` un APIRouter de FastAPI. `check(name, fn)`
+    añade una comprobación (p. ej. de artefactos) que corre tras montar todo.
+    """
+
+    def __init__(self):
+        self.mounts = []
+        self.checks = []
+        self.check_status = {}
+        self.started_at = time.time()
+        self._thread = None
+        self._exit_stack = AsyncExitStack()
+        self._start_lock = None
+
+    def gradio(self, prefix, name, factory):
+        self.mounts.append(_Mount(prefix, name, factory, "gradio"))
+
+    def router(self, prefix, name, factory):
+        self.mounts.append(_Mount(prefix, name, factory, "router"))
+
+    def check(self, name, fn):
+        self.checks.append((name, fn))
+        self.check_status[name] = {"state": "pending", "seconds": None, "error": None}
+
+    # --- Calentamiento en segundo plano ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._warm_up, name="lazy-mount-warmup", daemon=True)
+            self._thread.start()
+
+    def _warm_up(self):
+        for mount in self.mounts:
+            self._build(mount)
+        for name, fn in self.checks:
+            status = self.check_status[name]
+            status["state"] = "running"
+            start = time.time()
+            try:
+                fn()
+                status["state"] = "ok"
+            except Exception as e:
+                traceback.print_exc()
+                status.update(state="error", error=str(e))
+            status["seconds"] = round(time.time() - start, 2)
+        print(f"✅ Calentamiento de LocalHub terminado en {time.time() - self.started_at:.1f}s")
+
+    def _build(self, mount):
+        from fastapi import FastAPI
+
+        mount.state = "warming"
+        start = time.time()
+        try:
+            sub = FastAPI()
+            if mount.kind == "gradio":
+                import gradio as gr
+                gr.mount_gradio_app(sub, mount.factory(), path=mount.prefix)
+            else:
+                sub.include_router(mount.factory())
+            mount.app = sub
+            mount.state = "ready"
+        except Exception as e:
+            traceback.print_exc()
+            mount.state = "error"
+            mount.error = str(e)
+        mount.seconds = round(time.time() - start, 2)
+        print(f"{'🟢' if mount.state == 'ready' else '🔴'} {mount.name} ({mount.prefix}) en {mount.seconds}s")
+
+    # --- Estado ---
+
+    def status(self):
+        return {
+            "ready": all(m.state == "ready" for m in self.mounts)
+                     and all(c["state"] == "ok" for c in self.check_status.values()),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "mounts": {
+                m.prefix: {"app": m.name, "state": m.state, "seconds": m.seconds, "error": m.error}
+                for m in self.mounts
+            },
+            "checks": self.check_status,
+        }
+
+    # --- Despacho de peticiones ---
+
+    async def _ensure_started(self, mount):
+        # El lifespan de la sub-app (colas de Gradio, etc.) se arranca en el event loop la primera vez
+        if mount.started:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if not mount.started:
+                await self._exit_stack.enter_async_context(mount.app.router.lifespan_context(mount.app))
+                mount.started = True
+
+    async def close(self):
+        await self._exit_stack.aclose()
+
+    async def dispatch(self, scope, receive, send):
+        """Atiende la petición si es de una ruta diferida. False si no le corresponde."""
+        if scope["type"] not in ("http", "websocket"):
+            return False
+        mount = next((m for m in self.mounts if m.matches(scope["path"])), None)
+        if mount is None:
+            return False
+        if mount.state == "ready":
+            await self._ensure_started(mount)
+            await mount.app(scope, receive, send)
+            return True
+
+        if scope["type"] == "websocket":
+            await send({"type": "websocket.close", "code": 1013})
+            return True
+        from starlette.responses import HTMLResponse, JSONResponse
+
+        if mount.state == "error":
+            message = f"No se pudo cargar: {mount.error}"
+        else:
+            message = f"Cargando... ({time.time() - self.started_at:.0f}s)"
+        if mount.kind == "router":
+            response = JSONResponse({"detail": message, "status": mount.state}, status_code=503,
+                                    headers={"Retry-After": "2"})
+        else:
+            if mount.state != "error":
+                message += ". La página se recarga sola."
+            response = HTMLResponse(WARMING_PAGE.format(name=mount.name, message=message), status_code=503)
+        await response(scope, receive, send)
+        return True
+
+
+class LazyMountMiddleware:
+    """Middleware ASGI que desvía a las mini-apps montadas en diferido."""
+
+    def __init__(self, app, mounts):
+        self.app = app
+        self.mounts = mounts
+
+    async def __call__(self, scope, receive, send):
+        if not await self.mounts.dispatch(scope, receive, send):
+            await self.app(scope, receive, send)
@@ -0,0 +1,442 @@
+# utils/model_cache.py
+#
+# Cache de modelos por niveles compartido por las tres apps:
+#   gpu  -> el modelo está listo en el acelerador
+#   host -> los pesos esperan en RAM (pinned): volver a la GPU es una copia
+#   disk -> no queda nada en memoria: hay que cargarlo de nuevo desde disco
+# Un modelo que sale de la GPU baja a "host"; solo la presión de memoria
+# (presupuesto de RAM o RAM libre del sistema) lo manda a "disk".
+#
+# También es el gestor de residencia en la GPU: un presupuesto global de VRAM
+# para los modelos de las tres apps (se desaloja por prioridad y LRU), un
+# contador de uso por petición (un modelo en uso nunca se desaloja) y un
+# tiempo máximo de inactividad por modelo.
+#
+# Las copias entre niveles y los avisos a las apps (`on_offload`) se hacen sin
+# el lock del cache: mientras tanto el modelo está "offloading" o "restoring"
+# y quien lo necesite espera solo a ese modelo, no al resto del cache.
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psutil
+import torch
+
+# Presupuesto de RAM para modelos aparcados en "host" (por defecto, la mitad de la RAM total)
+HOST_BUDGET_BYTES = int(float(os.getenv("MODEL_CACHE_HOST_GB", "0")) * 1024**3) or psutil.virtual_memory().total // 2
+# RAM libre mínima que se deja al sistema antes de desalojar modelos a disco
+MIN_FREE_RAM_BYTES = 4 * 1024**3
+# Presupuesto de VRAM para pesos de modelos (por defecto, el 85% de la GPU; sin CUDA no se aplica)
+GPU_BUDGET_BYTES = int(float(os.getenv("MODEL_CACHE_GPU_GB", "0")) * 1024**3) or (
+    int(torch.cuda.get_device_properties(0).total_memory * 0.85) if torch.cuda.is_available() else 0
+)
+# Segundos sin uso tras los que un modelo sale de la GPU (se puede cambiar por modelo con "idle_timeout")
+IDLE_TIMEOUT_S = int(os.getenv("MODEL_IDLE_TIMEOUT_S", "120"))
+REAPER_INTERVAL_S = 5
+
+TIERS = ("gpu", "host", "disk")
+
+
+def _module_nbytes(module):
+    total = 0
+    for t in list(module.parameters()) + list(module.buffers()):
+        total += t.numel() * t.element_size()
+    return total
+
+
+def _pin_module(module):
+    """Fija en memoria (pinned) los pesos de un módulo ya en CPU para copias rápidas a la GPU."""
+    for t in list(module.parameters()) + list(module.buffers()):
+        if t.device.type == "cpu" and not t.is_pinned():
+            t.data = t.data.pin_memory()
+
+
+def weights_nbytes(path):
+    """Tamaño en disco de los pesos (fichero o carpeta): estimación de lo que ocupará en la GPU."""
+    if not path or not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            if name.endswith((".safetensors", ".bin")):
+                total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+
+def _single_device(module):
+    """False si accelerate repartió el modelo entre GPU/CPU/disco (no se puede mover entero)."""
+    device_map = getattr(module, "hf_device_map", None)
+    if not device_map:
+        return True
+    return len({str(d) for d in device_map.values()}) == 1 and not {"cpu", "disk"} & {str(d) for d in device_map.values()}
+
+
+# Sin CUDA los modelos ya viven en RAM: "aparcar" uno es no moverlo y restaurarlo es inmediato.
+
+class TorchAdapter:
+    """Mueve entre niveles una lista de nn.Module (modelo de transformers, borrador, ...)."""
+
+    def __init__(self, modules):
+        self.modules = [m for m in modules if m is not None]
+        self.on_gpu = torch.cuda.is_available()
+
+    def can_swap(self):
+        return not self.on_gpu or all(_single_device(m) for m in self.modules)
+
+    def nbytes(self):
+        return sum(_module_nbytes(m) for m in self.modules)
+
+    def to_host(self):
+        if self.on_gpu:
+            for m in self.modules:
+                m.to("cpu")
+                _pin_module(m)
+
+    def to_device(self):
+        if self.on_gpu:
+            for m in self.modules:
+                m.to("cuda", non_blocking=True)
+            torch.cuda.synchronize()
+
+
+class DiffusersAdapter:
+    """Pipeline de diffusers: se mueve entero con `pipe.to` y se fijan los pesos de cada componente."""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.on_gpu = torch.cuda.is_available()
+
+    def _modules(self):
+        return [c for c in self.pipe.components.values() if isinstance(c, torch.nn.Module)]
+
+    def can_swap(self):
+        return True
+
+    def nbytes(self):
+        return sum(_module_nbytes(m) for m in self._modules())
+
+    def to_host(self):
+        if self.on_gpu:
+            self.pipe.to("cpu")
+            for m in self._modules():
+                _pin_module(m)
+
+    def to_device(self):
+        if self.on_gpu:
+            self.pipe.to("cuda")
+            torch.cuda.synchronize()
+
+
+class CTranslate2Adapter:
+    """Modelos de CTranslate2 (faster-whisper): `unload_model(to_cpu=True)` deja los pesos en RAM."""
+
+    def __init__(self, ct2_model, model_path):
+        self.model = ct2_model
+        self.model_path = model_path
+        self.on_gpu = getattr(ct2_model, "device", "cpu") == "cuda"
+
+    def can_swap(self):
+        return True
+
+    def nbytes(self):
+        path = os.path.join(self.model_path, "model.bin")
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def to_host(self):
+        if self.on_gpu:
+            self.model.unload_model(to_cpu=True)
+
+    def to_device(self):
+        if self.on_gpu:
+            self.model.load_model()
+
+
+class _Entry:
+    def __init__(self, value, adapter, group, priority, idle_timeout, on_offload):
+        self.value = value
+        self.adapter = adapter
+        self.group = group
+        self.tier = "gpu"
+        # Sin marcar mientras el modelo se mueve entre niveles ("offloading"/"restoring")
+        self.settled = threading.Event()
+        self.settled.set()
+        self.nbytes = adapter.nbytes()
+        self.priority = priority
+        self.idle_timeout = idle_timeout
+        # La app olvida sus referencias al modelo cuando sale de la GPU
+        self.on_offload = on_offload
+
+
+class TieredModelCache:
+    """
+    Registro de modelos cargados con su nivel actual (gpu/host/disk).
+
+    `restore(key)` devuelve el modelo listo en el acelerador si sigue en
+    memoria (o None si hay que cargarlo de disco); `add` registra uno recién
+    cargado y `offload` lo baja a RAM. Mientras una petición usa un modelo
+    (`with in_use(key)`) no se desaloja ni por presupuesto ni por inactividad.
+    Estadísticas de aciertos y de tiempo de cada movimiento por nivel en `stats`.
+    """
+
+    def __init__(self, host_budget=HOST_BUDGET_BYTES, gpu_budget=GPU_BUDGET_BYTES):
+        self.host_budget = host_budget
+        self.gpu_budget = gpu_budget
+        self._entries = OrderedDict()
+        self._refs = {}
+        self._last_used = {}
+        self._lock = threading.RLock()
+        self._reaper = None
+        self.stats = {
+            "hits": {tier: 0 for tier in TIERS},
+            "swap_s": {"to_host": 0.0, "to_device": 0.0},
+            "swaps": {"to_host": 0, "to_device": 0},
+            "evictions": 0,
+            "gpu_evictions": 0,
+            "idle_offloads": 0,
+        }
+
+    @contextmanager
+    def in_use(self, key):
+        """Marca el modelo como en uso durante el bloque (también antes de cargarlo)."""
+        with self._lock:
+            self._refs[key] = self._refs.get(key, 0) + 1
+            self._last_used[key] = time.monotonic()
+            entry = self._entries.get(key)
+        try:
+            # Si ya estaba saliendo de la GPU se espera a que termine: la app lo habrá olvidado y lo pedirá con restore()
+            if entry is not None and entry.tier == "offloading":
+                entry.settled.wait()
+            yield
+        finally:
+            with self._lock:
+                self._refs[key] -= 1
+                if not self._refs[key]:
+                    del self._refs[key]
+                self._last_used[key] = time.monotonic()
+
+    def busy(self, key):
+        return self._refs.get(key, 0) > 0
+
+    def tier(self, key):
+        entry = self._entries.get(key)
+        return entry.tier if entry else "disk"
+
+    def restore(self, key):
+        """El modelo en el acelerador si está en gpu/host; None (fallo de nivel disk) si no."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.stats["hits"]["disk"] += 1
+                    return None
+                if entry.settled.is_set():
+                    self._entries.move_to_end(key)
+                    self._last_used[key] = time.monotonic()
+                    if entry.tier == "gpu":
+                        self.stats["hits"]["gpu"] += 1
+                        return entry.value
+                    entry.tier = "restoring"
+                    entry.settled.clear()
+                    victims = self._plan_room(entry.group, exclude=key, nbytes=entry.nbytes)
+                    break
+            # Otro hilo lo está moviendo: se espera a que termine y se vuelve a mirar
+            entry.settled.wait()
+
+        try:
+            self._offload_claimed(victims, incoming=key)
+            start = time.perf_counter()
+            entry.adapter.to_device()
+            elapsed = time.perf_counter() - start
+        except BaseException:
+            with self._lock:
+                entry.tier = "host"
+                entry.settled.set()
+            raise
+        with self._lock:
+            entry.tier = "gpu"
+            self.stats["swap_s"]["to_device"] += elapsed
+            self.stats["swaps"]["to_device"] += 1
+            self.stats["hits"]["host"] += 1
+            entry.settled.set()
+        print(f"⚡ '{key}' restaurado desde RAM en {elapsed:.2f}s ({entry.nbytes / 1024**3:.2f} GB)")
+        return entry.value
+
+    def add(self, key, value, adapter, group=None, priority=0, idle_timeout=IDLE_TIMEOUT_S, on_offload=None):
+        """
+        Registra un modelo recién cargado (en el acelerador). Con el presupuesto
+        de VRAM lleno salen antes los de menor `priority` y, a igualdad, los
+        usados hace más tiempo; `on_offload(key)` se llama cuando sale de la GPU.
+        """
+        entry = _Entry(value, adapter, group, priority, idle_timeout, on_offload)
+        with self._lock:
+            victims = self._plan_room(group, exclude=key, nbytes=entry.nbytes)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._last_used[key] = time.monotonic()
+            self._start_reaper()
+        self._offload_claimed(victims)
+
+    def make_room(self, group, nbytes=0):
+        """Libera la GPU antes de cargar desde disco un modelo de `group` que ocupará ~`nbytes`."""
+        with self._lock:
+            victims = self._plan_room(group, nbytes=nbytes)
+        self._offload_claimed(victims)
+
+    def _plan_room(self, group, exclude=None, nbytes=0):
+        """
+        Con el lock tomado: elige y reserva ("offloading") los modelos que deben
+        salir de la GPU. Quien llama los mueve después con `_offload_claimed`.
+        """
+        victims = []
+        # Un modelo por app en la GPU: los demás del mismo grupo bajan a RAM
+        if group is not None:
+            for key, entry in list(self._entries.items()):
+                if key != exclude and entry.group == group and entry.tier == "gpu" and self._claim(key):
+                    victims.append(key)
+        if not self.gpu_budget:
+            return victims
+        # Presupuesto de VRAM: salen (prioridad, LRU) los necesarios para que quepan `nbytes` más
+        while True:
+            resident = [(k, e) for k, e in self._entries.items()
+                        if e.tier in ("gpu", "restoring") and k != exclude]
+            used = sum(e.nbytes for _, e in resident)
+            if used + nbytes <= self.gpu_budget:
+                return victims
+            candidates = [(k, e) for k, e in resident if e.tier == "gpu" and not self.busy(k)]
+            if not candidates:
+                print(f"⚠️ Presupuesto de VRAM superado ({(used + nbytes) / 1024**3:.2f} GB de "
+                      f"{self.gpu_budget / 1024**3:.2f} GB) y todos los modelos residentes están en uso")
+                return victims
+            key, _ = min(candidates, key=lambda item: (item[1].priority, self._last_used.get(item[0], 0.0)))
+            print(f"🧹 '{key}' sale de la GPU para dejar sitio ({nbytes / 1024**3:.2f} GB)")
+            self.stats["gpu_evictions"] += 1
+            self._claim(key)
+            victims.append(key)
+
+    def _claim(self, key):
+        """Con el lock tomado: marca un modelo de la GPU como "offloading". False si está en uso."""
+        entry = self._entries[key]
+        if self.busy(key):
+            print(f"⏳ '{key}' está en uso: se queda en la GPU")
+            return False
+        entry.tier = "offloading"
+        entry.settled.clear()
+        return True
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_idle, name="model-cache-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_idle(self):
+        # Un único hilo para todas las apps: baja a RAM los modelos sin uso durante su idle_timeout
+        while True:
+            time.sleep(REAPER_INTERVAL_S)
+            now = time.monotonic()
+            idle_keys = []
+            with self._lock:
+                for key, entry in list(self._entries.items()):
+                    if entry.tier != "gpu" or not entry.idle_timeout or self.busy(key):
+                        continue
+                    idle = now - self._last_used.get(key, now)
+                    if idle >= entry.idle_timeout and self._claim(key):
+                        print(f"⏱️ '{key}' lleva {idle:.0f}s sin usarse. Sale de la VRAM...")
+                        self.stats["idle_offloads"] += 1
+                        idle_keys.append(key)
+            self._offload_claimed(idle_keys)
+
+    def offload(self, key, incoming=None):
+        """
+        Baja el modelo a RAM pinned (o lo descarta si no se puede mover). True si estaba en GPU.
+        `incoming` es el modelo que está a punto de subir desde RAM: no cuenta para el presupuesto.
+        Un modelo en uso no se mueve (devuelve False).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.tier != "gpu" or not self._claim(key):
+                return False
+        self._offload_claimed([key], incoming)
+        return True
+
+    def _offload_claimed(self, keys, incoming=None):
+        """
+        Mueve a RAM los modelos ya reservados ("offloading"), sin el lock del
+        cache: el aviso a la app (`on_offload`, que puede parar hilos) y la
+        copia de varios GB no bloquean a los demás modelos.
+        """
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            try:
+                if entry.on_offload is not None:
+                    entry.on_offload(key)
+                swap = entry.adapter.can_swap()
+                if swap:
+                    start = time.perf_counter()
+                    entry.adapter.to_host()
+                    elapsed = time.perf_counter() - start
+            except Exception as e:
+                print(f"❌ No se pudo aparcar '{key}' en RAM, se descarta: {e}")
+                swap = False
+            if not swap:
+                self.drop(key)
+                entry.settled.set()
+                continue
+            # Nivel y marca cambian juntos: quien espera nunca ve un "offloading" ya terminado
+            with self._lock:
+                entry.tier = "host"
+                entry.settled.set()
+                self.stats["swap_s"]["to_host"] += elapsed
+                self.stats["swaps"]["to_host"] += 1
+                self._enforce_host_budget(incoming)
+            print(f"📦 '{key}' aparcado en RAM en {elapsed:.2f}s ({entry.nbytes / 1024**3:.2f} GB)")
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _enforce_host_budget(self, incoming=None):
+        """Desaloja a disco los modelos en RAM menos usados si se pasa el presupuesto o falta RAM."""
+        for key, entry in list(self._entries.items()):
+            host_bytes = sum(e.nbytes for k, e in self._entries.items() if e.tier == "host" and k != incoming)
+            low_ram = psutil.virtual_memory().available < MIN_FREE_RAM_BYTES
+            if host_bytes <= self.host_budget and not low_ram:
+                break
+            if entry.tier == "host" and key != incoming:
+                print(f"💽 '{key}' desalojado de la RAM (presión de memoria)")
+                self.stats["evictions"] += 1
+                self.drop(key)
+
+    def drop(self, key):
+        """Olvida el modelo por completo (la próxima vez se carga desde disco)."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            entry.value = entry.adapter = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+    def summary(self):
+        s = self.stats
+        tiers = {t: [k for k, e in self._entries.items() if e.tier == t] for t in ("gpu", "host")}
+        avg = {
+            d: (s["swap_s"][d] / s["swaps"][d] if s["swaps"][d] else 0.0) for d in ("to_host", "to_device")
+        }
+        return (
+            f"aciertos gpu {s['hits']['gpu']} / host {s['hits']['host']} / disco {s['hits']['disk']} | "
+            f"GPU→RAM {avg['to_host']:.2f}s, RAM→GPU {avg['to_device']:.2f}s de media | "
+            f"{s['evictions']} desalojos de RAM, {s['gpu_evictions']} de GPU, {s['idle_offloads']} por inactividad | "
+            f"en GPU: {tiers['gpu']} | en RAM: {tiers['host']}"
+        )
+
+
+# Instancia compartida por chatbot, imágenes y transcriptor
+model_cache = TieredModelCache()
@@ -0,0 +1,283 @@
+# utils/model_store.py
+#
+# Manifiestos de los modelos descargados (ficheros, tamaños y hashes).
+# Al arrancar basta con un stat por fichero para saber si un artefacto está
+# completo; el hash SHA-256 se calcula (y se comprueba) en segundo plano.
+# Las instalaciones anteriores a los manifiestos no pasan por la red: el
+# manifiesto se crea a partir de los ficheros que ya hay en disco.
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zipfile
+
+MANIFEST_VERSION = 1
+
+# Comprobación profunda (SHA-256 de cada fichero) en segundo plano al arrancar
+DEEP_VERIFY = os.getenv("MODEL_STORE_DEEP_VERIFY", "0") == "1"
+
+_HASH_CHUNK = 8 * 1024 * 1024
+_manifest_lock = threading.Lock()
+
+
+def manifest_path(root, artifact):
+    return os.path.join(root, f".{artifact}.manifest.json")
+
+
+def read_manifest(root, artifact):
+    try:
+        with open(manifest_path(root, artifact), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def write_manifest(root, artifact, manifest):
+    path = manifest_path(root, artifact)
+    with _manifest_lock:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def _walk_files(root):
+    """Ficheros bajo `root` (rutas relativas), sin carpetas ocultas ni manifiestos."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if name.startswith(".") or name.endswith((".tmp", ".part", ".incomplete", ".lock")):
+                continue
+            yield os.path.relpath(os.path.join(dirpath, name), root)
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def looks_complete(path):
+    """
+    Comprobación local y barata de que un fichero de pesos no está truncado:
+    un .safetensors debe medir lo que declara su cabecera y un .pth/.pt/.ckpt
+    en formato zip debe tener el directorio central al final. El resto se da
+    por bueno.
+    """
+    try:
+        if path.endswith(".safetensors"):
+            with open(path, "rb") as f:
+                (header_len,) = struct.unpack("<Q", f.read(8))
+                header = json.loads(f.read(header_len))
+            end = max((t["data_offsets"][1] for k, t in header.items() if k != "__metadata__"), default=0)
+            return os.path.getsize(path) == 8 + header_len + end
+        if path.endswith((".pth", ".pt", ".ckpt")):
+            # Los pickles antiguos de torch no son zip: no hay nada barato que mirar
+            with open(path, "rb") as f:
+                is_zip = f.read(4) == b"PK\x03\x04"
+            return not is_zip or zipfile.is_zipfile(path)
+    except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+        return False
+    return True
+
+
+def seed_manifest(root, artifact, files, source=None):
+    """
+    Crea el manifiesto de un artefacto que ya estaba en disco (instalación
+    anterior a los manifiestos) solo con stat, sin red ni hashes. Quien
+    llama ya ha descartado los ficheros truncados (`looks_complete`).
+    """
+    files = list(files)
+    if not files:
+        return None
+    manifest = record_manifest(root, artifact, files=files, source=source)
+    print(f"📋 '{artifact}' ya estaba descargado: manifiesto creado a partir de {len(files)} ficheros locales")
+    return manifest
+
+
+def record_manifest(root, artifact, files=None, source=None):
+    """
+    Guarda el manifiesto de un artefacto recién descargado: tamaño y mtime de
+    cada fichero (`files` relativos a `root`; por defecto todos). Los hashes
+    se rellenan después con `verify_deep`.
+    """
+    entries = {}
+    for rel in files if files is not None else _walk_files(root):
+        st = os.stat(os.path.join(root, rel))
+        entries[rel.replace(os.sep, "/")] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "artifact": artifact,
+        "source": source,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": entries,
+    }
+    write_manifest(root, artifact, manifest)
+    return manifest
+
+
+def verify_quick(root, artifact):
+    """True si el manifiesto existe y todos sus ficheros tienen el tamaño registrado (solo stat)."""
+    manifest = read_manifest(root, artifact)
+    if not manifest or not manifest["files"]:
+        return False
+    for rel, info in manifest["files"].items():
+        try:
+            st = os.stat(os.path.join(root, rel))
+        except OSError:
+            print(f"⚠️ '{artifact}': falta {rel}")
+            return False
+        if st.st_size != info["size"]:
+            print(f"⚠️ '{artifact}': {rel} mide {st.st_size} B en lugar de {info['size']} B")
+            return False
+    return True
+
+
+def verify_deep(root, artifact):
+    """
+    Comprueba el SHA-256 de cada fichero del manifiesto. Los ficheros sin hash
+    (o modificados desde que se calculó) se hashean y se anota el resultado; si
+    un hash ya registrado no coincide, se borra el fichero y el manifiesto
+    para que se vuelva a descargar en el siguiente arranque.
+    """
+    manifest = read_manifest(root, artifact)
+    if not manifest:
+        return False
+    ok = True
+    for rel, info in manifest["files"].items():
+        path = os.path.join(root, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            ok = False
+            break
+        digest = sha256_file(path)
+        if info.get("sha256") and info.get("mtime_ns") == st.st_mtime_ns and digest != info["sha256"]:
+            print(f"❌ '{artifact}': {rel} está corrupto (SHA-256 distinto); se volverá a descargar")
+            real = os.path.realpath(path)
+            for p in {real, path}:
+                if os.path.lexists(p):
+                    os.remove(p)
+            ok = False
+            break
+        info.update(sha256=digest, size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+    if ok:
+        write_manifest(root, artifact, manifest)
+        print(f"🔐 '{artifact}': {len(manifest['files'])} ficheros verificados por hash")
+    else:
+        try:
+            os.remove(manifest_path(root, artifact))
+        except OSError:
+            pass
+    return ok
+
+
+def verify_in_background(entries):
+    """Lanza `verify_deep` en un hilo para cada (root, artifact) si DEEP_VERIFY está activo."""
+    if not DEEP_VERIFY or not entries:
+        return None
+
+    def run():
+        for root, artifact in entries:
+            try:
+                verify_deep(root, artifact)
+            except Exception as e:
+                print(f"⚠️ No se pudo verificar '{artifact}': {e}")
+
+    thread = threading.Thread(target=run, name="model-store-verify", daemon=True)
+    thread.start()
+    return thread
+
+
+def snapshot_path(repo_id, cache_dir):
+    """Carpeta del snapshot ya descargado de `repo_id` dentro de una caché de Hugging Face, o None."""
+    repo_dir = os.path.join(cache_dir, "models--" + repo_id.replace("/", "--"))
+    try:
+        with open(os.path.join(repo_dir, "refs", "main"), "r", encoding="utf-8") as f:
+            return os.path.join(repo_dir, "snapshots", f.read().strip())
+    except OSError:
+        return None
+
+
+def ensure_snapshot(repo_id, artifact, cache_dir=None, local_dir=None, allow_patterns=None,
+                    ignore_patterns=None):
+    """
+    Garantiza que los ficheros de `repo_id` están descargados sin instanciar el modelo.
+
+    Con manifiesto válido solo cuesta un stat por fichero. Si no, descarga
+    fichero a fichero con `snapshot_download` (reanudable) y registra el
+    manifiesto. Con `cache_dir` se usa la estructura de caché de Hugging
+    Face (la que lee `from_pretrained(cache_dir=...)`); con `local_dir`, una
+    carpeta plana. Devuelve la carpeta con los ficheros del modelo.
+    """
+    root = local_dir or cache_dir
+    os.makedirs(root, exist_ok=True)
+    existing = local_dir or snapshot_path(repo_id, cache_dir)
+    if verify_quick(root, artifact):
+        print(f"✅ '{artifact}' ya está descargado (manifiesto verificado)")
+        return existing
+
+    # Ficheros locales utilizables si no se puede llegar a Hugging Face (ninguno si alguno está truncado)
+    usable = []
+    if existing and os.path.isdir(existing):
+        usable = [os.path.relpath(os.path.join(existing, rel), root) for rel in _walk_files(existing)]
+        if not all(looks_complete(os.path.join(root, rel)) for rel in usable):
+            usable = []
+    if usable and read_manifest(root, artifact) is None and seed_manifest(root, artifact, usable, source=repo_id):
+        return existing
+
+    from huggingface_hub import snapshot_download
+
+    print(f"📥 Descargando '{artifact}' desde {repo_id}...")
+    start = time.time()
+    kwargs = {"local_dir": local_dir} if local_dir else {"cache_dir": cache_dir}
+    try:
+        path = snapshot_download(repo_id=repo_id, allow_patterns=allow_patterns, ignore_patterns=ignore_patterns,
+                                 **kwargs)
+    except Exception as e:
+        if not usable:
+            raise
+        # Sin red (o sin Hugging Face) se sigue con lo que ya hay en disco
+        print(f"⚠️ No se pudo comprobar '{artifact}' con {repo_id} ({e}); se usan los ficheros locales")
+        return existing
+    files = [os.path.relpath(os.path.join(path, rel), root) for rel in _walk_files(path)]
+    record_manifest(root, artifact, files=files, source=repo_id)
+    print(f"✅ '{artifact}' listo en {time.time() - start:.1f}s ({len(files)} ficheros)")
+    return path
+
+
+def ensure_file(dest, artifact, fetch, source=None):
+    """
+    Garantiza un artefacto de un único fichero (`dest`). Si su manifiesto no
+    cuadra se llama a `fetch(dest)`, que lo descarga (o valida el que haya) y
+    puede devolver su SHA-256 para dejarlo ya anotado en el manifiesto. Un
+    fichero que ya estaba en disco sin manifiesto se da por bueno con stat
+    (y la comprobación local de `looks_complete`), sin red.
+    """
+    root = os.path.dirname(dest)
+    name = os.path.basename(dest)
+    os.makedirs(root, exist_ok=True)
+    if verify_quick(root, artifact):
+        print(f"✅ Ya existe: {name}")
+        return dest
+    present = os.path.isfile(dest) and looks_complete(dest)
+    if present and read_manifest(root, artifact) is None and seed_manifest(root, artifact, [name], source=source):
+        return dest
+    try:
+        digest = fetch(dest)
+    except Exception as e:
+        if not present:
+            raise
+        print(f"⚠️ No se pudo comprobar {name} ({e}); se usa el fichero local")
+        return dest
+    manifest = record_manifest(root, artifact, files=[name], source=source)
+    if digest:
+        manifest["files"][name]["sha256"] = digest
+        write_manifest(root, artifact, manifest)
+    return dest
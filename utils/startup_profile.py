@@ -0,0 +1,85 @@
+# utils/startup_profile.py
+#
+# Perfil del tiempo de importación de `app.py` (python -X importtime).
+# Falla si importar el servidor tarda más del presupuesto o si arrastra
+# alguno de los módulos pesados que deben cargarse en segundo plano.
+#
+#   python -m utils.startup_profile [--budget 1.0] [--top 15]
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Módulos que no pueden importarse al arrancar el servidor
+HEAVY_MODULES = (
+    "torch", "transformers", "diffusers", "faster_whisper", "ctranslate2", "realesrgan", "basicsr",
+    "pynvml", "gradio", "accelerate",
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SNIPPET = (
+    "import time; start = time.perf_counter(); import app; "
+    "print(f'IMPORT_SECONDS={time.perf_counter() - start:.4f}')"
+)
+
+
+def profile_import():
+    """Importa `app` en un proceso limpio. Devuelve (segundos, {módulo: (propio_us, acumulado_us)})."""
+    env = dict(os.environ)
+    # El token solo se comprueba, no se usa al importar
+    env.setdefault("HF_HUB_TOKEN", "profile")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SNIPPET],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stdout + result.stderr)
+        raise SystemExit(f"❌ No se pudo importar app.py (código {result.returncode})")
+
+    seconds = None
+    for line in result.stdout.splitlines():
+        if line.startswith("IMPORT_SECONDS="):
+            seconds = float(line.split("=", 1)[1])
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(own), int(cumulative))
+    return seconds, modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perfil de importación del servidor LocalHub")
+    parser.add_argument("--budget", type=float, default=1.0, help="segundos máximos para importar app.py")
+    parser.add_argument("--top", type=int, default=15, help="módulos más lentos a mostrar")
+    args = parser.parse_args(argv)
+
+    seconds, modules = profile_import()
+    print(f"⏱️ Importar app.py: {seconds:.3f}s (presupuesto {args.budget:.2f}s, {len(modules)} módulos)")
+    # Solo paquetes de primer nivel: su acumulado ya incluye los submódulos
+    top_level = sorted(
+        ((name, cum) for name, (_, cum) in modules.items() if "." not in name),
+        key=lambda item: item[1], reverse=True,
+    )
+    for name, cum in top_level[:args.top]:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+
+    heavy = sorted({name.split(".")[0] for name in modules} & set(HEAVY_MODULES))
+    failed = False
+    if heavy:
+        print(f"❌ Módulos pesados importados al arrancar: {', '.join(heavy)}")
+        failed = True
+    if seconds > args.budget:
+        print(f"❌ La importación supera el presupuesto ({seconds:.3f}s > {args.budget:.2f}s)")
+        failed = True
+    if not failed:
+        print("✅ Arranque dentro del presupuesto")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())